@@ -41,16 +41,38 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 """
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 APPSTORE_MAINTENANCE       = False
 APPSTORE_PLATFORM_ID       = os.getenv('APPSTORE_PLATFORM_ID', default = 'NEPTUNE3')
 APPSTORE_PLATFORM_VERSION  = int(os.getenv('APPSTORE_PLATFORM_VERSION', default = '2'))
 APPSTORE_DOWNLOAD_EXPIRY   = int(os.getenv('APPSTORE_DOWNLOAD_EXPIRY', default = '10'))     # in minutes
+APPSTORE_DOWNLOAD_CACHE_SIZE = int(os.getenv('APPSTORE_DOWNLOAD_CACHE_SIZE', default = '0')) # in MiB, 0 means unlimited
+APPSTORE_ICON_CACHE_SIZE   = int(os.getenv('APPSTORE_ICON_CACHE_SIZE', default = '16'))     # in MiB per server process, 0 disables the icon cache
+APPSTORE_ICON_SIZES        = os.getenv('APPSTORE_ICON_SIZES', default = '64,128')        # comma-separated sizes in pixels of the app icon variants created at upload
+APPSTORE_ASYNC_UPLOAD      = os.getenv('APPSTORE_ASYNC_UPLOAD', default = '0') == '1'       # validate uploaded packages in process-uploads workers
+APPSTORE_UPLOAD_SESSION_EXPIRY = int(os.getenv('APPSTORE_UPLOAD_SESSION_EXPIRY', default = '1440')) # in minutes
+APPSTORE_ASYNC_PURCHASE    = os.getenv('APPSTORE_ASYNC_PURCHASE', default = '0') == '1'     # sign purchased packages in a worker pool
+APPSTORE_SIGNING_WORKERS   = int(os.getenv('APPSTORE_SIGNING_WORKERS', default = '0'))    # 0 means one per CPU
+APPSTORE_SIGNING_QUEUE_SIZE = int(os.getenv('APPSTORE_SIGNING_QUEUE_SIZE', default = '100'))
+APPSTORE_AUTH_CACHE_TTL    = int(os.getenv('APPSTORE_AUTH_CACHE_TTL', default = '300'))    # in seconds to remember verified basic auth credentials, 0 disables
 APPSTORE_BIND_TO_DEVICE_ID = os.getenv('APPSTORE_BIND_TO_DEVICE_ID', default = '1') == '1' # unique downloads for each device
 APPSTORE_NO_SECURITY       = os.getenv('APPSTORE_NO_SECURITY', default = '1') == '1'        # ignore developer signatures and do not generate store signatures
 APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE = os.getenv('APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE', default = 'certificates/store.p12')
 APPSTORE_STORE_SIGN_PKCS12_PASSWORD    = os.getenv('APPSTORE_STORE_SIGN_PKCS12_PASSWORD', default = 'password')
 APPSTORE_DEV_VERIFY_CA_CERTIFICATES    = os.getenv('APPSTORE_DEV_VERIFY_CA_CERTIFICATES', ','.join(['certificates/ca.crt', 'certificates/devca.crt'])).split(',')
 APPSTORE_DATA_PATH         = os.getenv('APPSTORE_DATA_PATH', default = '')
+APPSTORE_DB_ENGINE         = os.getenv('APPSTORE_DB_ENGINE', default = 'sqlite')            # sqlite or postgresql
+APPSTORE_DB_NAME           = os.getenv('APPSTORE_DB_NAME', default = '')                    # defaults to db.sqlite3 in APPSTORE_DATA_PATH, or appstore
+APPSTORE_DB_USER           = os.getenv('APPSTORE_DB_USER', default = '')
+APPSTORE_DB_PASSWORD       = os.getenv('APPSTORE_DB_PASSWORD', default = '')
+APPSTORE_DB_HOST           = os.getenv('APPSTORE_DB_HOST', default = '')
+APPSTORE_DB_PORT           = os.getenv('APPSTORE_DB_PORT', default = '')
+APPSTORE_DB_REPLICA_HOST   = os.getenv('APPSTORE_DB_REPLICA_HOST', default = '')            # postgresql only: catalog reads go to this replica
+APPSTORE_DB_CONN_MAX_AGE   = int(os.getenv('APPSTORE_DB_CONN_MAX_AGE', default = '0'))      # in seconds, 0 closes connections after each request
+APPSTORE_DB_SQLITE_WAL     = os.getenv('APPSTORE_DB_SQLITE_WAL', default = '1') == '1'      # readers do not block the writer and vice versa
+APPSTORE_DB_SQLITE_SYNCHRONOUS = os.getenv('APPSTORE_DB_SQLITE_SYNCHRONOUS', default = 'NORMAL')
+APPSTORE_DB_SQLITE_TIMEOUT = int(os.getenv('APPSTORE_DB_SQLITE_TIMEOUT', default = '20'))   # in seconds to wait for a locked database
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -125,12 +147,37 @@ else:
 # Database
 # https://docs.djangoproject.com/en/1.7/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(MEDIA_ROOT, 'db.sqlite3'),
-    }
-}
+# The SQLite journal mode and synchronous pragmas are set in store.database, when a connection
+# is opened.
+
+if APPSTORE_DB_ENGINE == 'postgresql':
+  DATABASES = {
+      'default': {
+          'ENGINE': 'django.db.backends.postgresql',
+          'NAME': APPSTORE_DB_NAME or 'appstore',
+          'USER': APPSTORE_DB_USER,
+          'PASSWORD': APPSTORE_DB_PASSWORD,
+          'HOST': APPSTORE_DB_HOST,
+          'PORT': APPSTORE_DB_PORT,
+          'CONN_MAX_AGE': APPSTORE_DB_CONN_MAX_AGE,
+      }
+  }
+  if APPSTORE_DB_REPLICA_HOST:
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=APPSTORE_DB_REPLICA_HOST,
+                                TEST={'MIRROR': 'default'})
+elif APPSTORE_DB_ENGINE == 'sqlite':
+  DATABASES = {
+      'default': {
+          'ENGINE': 'django.db.backends.sqlite3',
+          'NAME': APPSTORE_DB_NAME or os.path.join(MEDIA_ROOT, 'db.sqlite3'),
+          'CONN_MAX_AGE': APPSTORE_DB_CONN_MAX_AGE,
+          'OPTIONS': {'timeout': APPSTORE_DB_SQLITE_TIMEOUT},
+      }
+  }
+else:
+  raise ImproperlyConfigured('unsupported APPSTORE_DB_ENGINE: %s' % APPSTORE_DB_ENGINE)
+
+DATABASE_ROUTERS = ['store.database.CatalogReplicaRouter']
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
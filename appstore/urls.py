@@ -43,13 +43,21 @@ base_urlpatterns = [
     re_path(r'^logout$',            store_api.logout),
     re_path(r'^app/list$',          store_api.appList),
     re_path(r'^app/icon$',          store_api.appIcon),
+    re_path(r'^app/icons$',         store_api.appIcons),
+    re_path(r'^app/icons/metrics$', store_api.iconMetrics),
     re_path(r'^app/icons/(.*)$',    store_api.appIconNew),
     re_path(r'^app/description',    store_api.appDescription),
+    re_path(r'^app/purchase/status$',  store_api.appPurchaseStatus),
+    re_path(r'^app/purchase/metrics$', store_api.purchaseMetrics),
     re_path(r'^app/purchase',       store_api.appPurchase),
     re_path(r'^app/download/(.*)$', store_api.appDownload),
     re_path(r'^category/list$',     store_api.categoryList),
     re_path(r'^category/icon$',     store_api.categoryIcon),
     re_path(r'^upload$',            store_api.upload),
+    re_path(r'^upload/status$',     store_api.uploadStatus),
+    re_path(r'^upload/session$',    store_api.uploadSessionCreate),
+    re_path(r'^upload/session/([0-9a-f-]+)$',          store_api.uploadSession),
+    re_path(r'^upload/session/([0-9a-f-]+)/finalize$', store_api.uploadSessionFinalize),
 ]
 
 
@@ -3,11 +3,31 @@
 #export APPSTORE_PLATFORM_ID                   NEPTUNE3
 #export APPSTORE_PLATFORM_VERSION              2
 #export APPSTORE_DOWNLOAD_EXPIRY               10
+#export APPSTORE_DOWNLOAD_CACHE_SIZE           0
+#export APPSTORE_ICON_CACHE_SIZE               16
+#export APPSTORE_ICON_SIZES                    64,128
+#export APPSTORE_ASYNC_UPLOAD                  0
+#export APPSTORE_UPLOAD_SESSION_EXPIRY         1440
+#export APPSTORE_ASYNC_PURCHASE                0
+#export APPSTORE_SIGNING_WORKERS               0
+#export APPSTORE_SIGNING_QUEUE_SIZE            100
+#export APPSTORE_AUTH_CACHE_TTL                300
 #export APPSTORE_BIND_TO_DEVICE_ID             1
 #export APPSTORE_NO_SECURITY                   1
 #export APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE certificates/store.p12
 #export APPSTORE_STORE_SIGN_PKCS12_PASSWORD    password
 #export APPSTORE_DEV_VERIFY_CA_CERTIFICATES    certificates/ca.crt,certificates/devca.crt
+#export APPSTORE_DB_ENGINE                     sqlite
+#export APPSTORE_DB_NAME
+#export APPSTORE_DB_USER
+#export APPSTORE_DB_PASSWORD
+#export APPSTORE_DB_HOST
+#export APPSTORE_DB_PORT
+#export APPSTORE_DB_REPLICA_HOST
+#export APPSTORE_DB_CONN_MAX_AGE               0
+#export APPSTORE_DB_SQLITE_WAL                 1
+#export APPSTORE_DB_SQLITE_SYNCHRONOUS         NORMAL
+#export APPSTORE_DB_SQLITE_TIMEOUT             20
 
 IT=""
 if [ "x$1" = "x-it" ]; then
@@ -24,9 +44,29 @@ exec docker run $IT \
     -e APPSTORE_PLATFORM_ID \
     -e APPSTORE_PLATFORM_VERSION \
     -e APPSTORE_DOWNLOAD_EXPIRY \
+    -e APPSTORE_DOWNLOAD_CACHE_SIZE \
+    -e APPSTORE_ICON_CACHE_SIZE \
+    -e APPSTORE_ICON_SIZES \
+    -e APPSTORE_ASYNC_UPLOAD \
+    -e APPSTORE_UPLOAD_SESSION_EXPIRY \
+    -e APPSTORE_ASYNC_PURCHASE \
+    -e APPSTORE_SIGNING_WORKERS \
+    -e APPSTORE_SIGNING_QUEUE_SIZE \
+    -e APPSTORE_AUTH_CACHE_TTL \
     -e APPSTORE_BIND_TO_DEVICE_ID \
     -e APPSTORE_NO_SECURITY \
     -e APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE \
     -e APPSTORE_STORE_SIGN_PKCS12_PASSWORD \
     -e APPSTORE_DEV_VERIFY_CA_CERTIFICATES \
+    -e APPSTORE_DB_ENGINE \
+    -e APPSTORE_DB_NAME \
+    -e APPSTORE_DB_USER \
+    -e APPSTORE_DB_PASSWORD \
+    -e APPSTORE_DB_HOST \
+    -e APPSTORE_DB_PORT \
+    -e APPSTORE_DB_REPLICA_HOST \
+    -e APPSTORE_DB_CONN_MAX_AGE \
+    -e APPSTORE_DB_SQLITE_WAL \
+    -e APPSTORE_DB_SQLITE_SYNCHRONOUS \
+    -e APPSTORE_DB_SQLITE_TIMEOUT \
     qtauto-deployment-server "$@"
@@ -40,7 +40,9 @@ from ordered_model.admin import OrderedModelAdmin
 from django.utils.safestring import mark_safe
 
 from store.models import *
-from store.utilities import parseAndValidatePackageMetadata, writeTempIcon, makeTagList
+from store.utilities import parseAndValidatePackageMetadata, makeTagList, tagSetFingerprint
+from store.blobs import storeBlob, PACKAGE
+from store.iconvariants import storeIcon
 
 class CategoryAdminForm(forms.ModelForm):
     class Meta:
@@ -131,7 +133,7 @@ class AppAdminForm(forms.ModelForm):
                                             (self.instance.architecture, self.architecture))
         else:
             try:
-                if App.objects.get(appid__exact=self.appId, architecture__exact=self.architecture, tags_hash__exact=self.tags_hash):
+                if App.objects.get(appid__exact=self.appId, architecture__exact=self.architecture, tagset_id__exact=tagSetFingerprint(self.tags_hash)):
                     raise forms.ValidationError('Validation error: another application with id'
                                                 ' %s , tags %s and architecture %s already '
                                                 'exists' % (str(self.appId), str(self.tags_hash),
@@ -139,11 +141,6 @@ class AppAdminForm(forms.ModelForm):
             except App.DoesNotExist:
                 pass
 
-        # write icon into file to serve statically
-        success, error = writeTempIcon(self.appId, self.architecture, self.tags_hash, pkgdata['icon'])
-        if not success:
-            raise forms.ValidationError(error)
-
         return cleaned_data
 
     def save(self, commit=False):
@@ -161,6 +158,9 @@ class AppAdminForm(forms.ModelForm):
 
         # FIXME: clean tags beforehand
         m.pkgformat = pkgdata['packageFormat']['formatVersion']
+        m.package = storeBlob(PACKAGE, m.file.file)
+        m.icon = storeIcon(pkgdata['icon'])
+        m.file = m.package.path()
         m.save()
 
         for i in taglist:
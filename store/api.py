@@ -31,25 +31,39 @@
 #############################################################################
 
 import os
-import shutil
+import base64
 import hashlib
-import logging
+import functools
+import datetime
 
 from django.conf import settings
-from django.db.models import Q, Count
-from django.http import HttpResponse, HttpResponseForbidden, Http404, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, Http404, JsonResponse, \
+    FileResponse, StreamingHttpResponse
+from django.utils.http import http_date, quote_etag
 from django.contrib import auth
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.core.exceptions import ValidationError
-from store.authdecorators import logged_in_or_basicauth, is_staff_member
+from store.authdecorators import logged_in_or_basicauth, is_staff_member, optional_basicauth
 
-from store.models import App, Category, Vendor, savePackageFile
-from store.utilities import parsePackageMetadata, parseAndValidatePackageMetadata, \
-    addSignatureToPackage
-from store.utilities import packagePath, iconPath, downloadPath
+from store.models import Category, Vendor, UploadSession, UploadJob, savePackageFile
+from store.utilities import parseAndValidatePackageMetadata
+from store.utilities import iconPath, downloadPath, fileDigest
+from store.blobs import blobPath, isBlobDigest
 from store.utilities import getRequestDictionary
 from store.osandarch import normalizeArch
 from store.tags import SoftwareTagList
+from store.catalog import catalogSnapshot
+from store.devicecontext import DeviceContext, createDeviceToken, storeDeviceContext, \
+    getDeviceContext, getDeviceArchitectures, getDeviceTags
+from store.uploadhandlers import PackageUploadHandler
+from store.uploadsessions import OffsetMismatch, createSession, sessionOffset, writeChunk, \
+    finishSession, removeSession
+from store.uploadjobs import queueUpload
+from store.downloads import downloadKey, cachedDownload
+from store.signing import PRIORITIES, QueueFull, signingPool, createDownload
+from store.crypto import timings as cryptoTimings
+from store.iconcache import iconCache
 
 
 def hello(request):
@@ -79,17 +93,20 @@ def hello(request):
     if temp_tags:
         if not versionmap.parse(','.join(temp_tags)):
             status = 'malformed-tag'
-    request.session["tag"] = str(versionmap)
     del temp_tags
 
     if 'architecture' in dictionary:
         arch = normalizeArch(dictionary['architecture'])
         if arch == "":
             status = 'incompatible-architecture'
-        request.session['architecture'] = arch
     else:
-        request.session['architecture'] = ''
+        arch = ''
 
+    context = DeviceContext(arch, str(versionmap))
+    if dictionary.get('token') == '1':
+        # stateless: the device passes the context with every request
+        return JsonResponse({'status': status, 'token': createDeviceToken(context)})
+    storeDeviceContext(request, context)
     return JsonResponse({'status': status})
 
 
@@ -127,49 +144,79 @@ def logout(request):
     return JsonResponse({'status': status})
 
 
+def getPackageMetadata(request):
+    """ Returns the store metadata for an uploaded package from the request parameters """
+    try:
+        description = getRequestDictionary(request)["description"]
+    except:
+        raise Exception('no description')
+    try:
+        shortdescription = getRequestDictionary(request)["short-description"]
+    except:
+        raise Exception('no short description')
+    try:
+        category_name = getRequestDictionary(request)["category"]
+    except:
+        raise Exception('no category')
+    try:
+        vendor_name = getRequestDictionary(request)["vendor"]
+    except:
+        raise Exception('no vendor')
+
+    category = Category.objects.all().filter(name__exact=category_name)
+    vendor = Vendor.objects.all().filter(name__exact=vendor_name)
+    if not category:
+        raise Exception('Non-existing category')
+    if not vendor:
+        raise Exception('Non-existing vendor')
+
+    return {'category':category[0],
+            'vendor':vendor[0],
+            'description':description,
+            'short_description':shortdescription}
+
+
+def asyncUploadRequested(dictionary):
+    asyncUpload = dictionary.get('async', '')
+    return asyncUpload == '1' or (asyncUpload == '' and settings.APPSTORE_ASYNC_UPLOAD)
+
+
+def jobStatus(job):
+    return JsonResponse({'status': 'queued', 'id': str(job.id)})
+
+
 @csrf_exempt
 @logged_in_or_basicauth()
 @is_staff_member()
 def upload(request):
     status = 'ok'
+    # the async parameter has to be passed in the query string, as the upload handler has to be
+    # set up before the request data is accessed
+    asyncUpload = asyncUploadRequested(request.GET)
+    # validate the package while it is uploaded, unless an upload job will do that
+    request.upload_handlers.insert(0, PackageUploadHandler(request, validate=not asyncUpload))
     try:
-        try:
-            description = getRequestDictionary(request)["description"]
-        except:
-            raise Exception('no description')
-        try:
-            shortdescription = getRequestDictionary(request)["short-description"]
-        except:
-            raise Exception('no short description')
-        try:
-            category_name = getRequestDictionary(request)["category"]
-        except:
-            raise Exception('no category')
-        try:
-            vendor_name = getRequestDictionary(request)["vendor"]
-        except:
-            raise Exception('no vendor')
+        package_metadata = getPackageMetadata(request)
 
         if request.method == 'POST' and request.FILES['package']:
             myfile = request.FILES['package']
-            category = Category.objects.all().filter(name__exact=category_name)
-            vendor = Vendor.objects.all().filter(name__exact=vendor_name)
-            if not category:
-                raise Exception('Non-existing category')
-            if not vendor:
-                raise Exception('Non-existing vendor')
-
-            try:
-                pkgdata = parseAndValidatePackageMetadata(myfile)
-            except:
-                raise Exception('Package validation failed')
+            if asyncUpload:
+                return jobStatus(queueUpload(request.user, myfile, package_metadata))
+
+            pkgdata = getattr(myfile, 'pkgdata', None)
+            validationError = getattr(myfile, 'validationError', None)
+            if validationError is not None:
+                raise Exception('Package validation failed: %s' % validationError)
+            if pkgdata is None:
+                # not validated during the upload (e.g. not gzip compressed): check the
+                # complete file
+                try:
+                    pkgdata = parseAndValidatePackageMetadata(myfile)
+                except:
+                    raise Exception('Package validation failed')
 
             myfile.seek(0)
             try:
-                package_metadata = {'category':category[0],
-                                    'vendor':vendor[0],
-                                    'description':description,
-                                    'short_description':shortdescription}
                 savePackageFile(pkgdata, myfile, package_metadata)
             except Exception as error:
                 raise Exception(error)
@@ -183,33 +230,159 @@ def upload(request):
     return JsonResponse({'status': status})
 
 
+@csrf_exempt
+@logged_in_or_basicauth()
+@is_staff_member()
+def uploadSessionCreate(request):
+    if request.method != 'POST':
+        return JsonResponse({'status': 'failed', 'error': 'POST required'}, status=405)
+    try:
+        size = getRequestDictionary(request).get('size')
+        size = int(size) if size else None
+        if size is not None and size < 0:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'status': 'failed', 'error': 'invalid size'})
+
+    session = createSession(request.user, size)
+    return JsonResponse({'status': 'ok', 'id': str(session.id), 'offset': 0})
+
+
+def getUploadSession(request, sessionId):
+    try:
+        return UploadSession.objects.get(id=sessionId, user=request.user)
+    except (UploadSession.DoesNotExist, ValidationError):
+        raise Http404('no such upload session: %s' % sessionId)
+
+
+@csrf_exempt
+@logged_in_or_basicauth()
+@is_staff_member()
+def uploadSession(request, sessionId):
+    """ GET returns the offset to continue at, PUT adds a chunk and DELETE cancels the upload """
+    session = getUploadSession(request, sessionId)
+
+    if request.method == 'DELETE':
+        removeSession(session)
+        return JsonResponse({'status': 'ok'})
+    if request.method == 'GET':
+        return JsonResponse({'status': 'ok', 'offset': sessionOffset(session),
+                             'size': session.size})
+    if request.method != 'PUT':
+        return JsonResponse({'status': 'failed', 'error': 'GET, PUT or DELETE required'},
+                            status=405)
+
+    try:
+        offset = int(request.GET.get('offset', ''))
+        if offset < 0:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'status': 'failed', 'error': 'offset parameter required'})
+    try:
+        offset = writeChunk(session, offset, request)
+    except OffsetMismatch as error:
+        return JsonResponse({'status': 'offset-mismatch', 'offset': error.offset}, status=409)
+    except Exception as error:
+        return JsonResponse({'status': 'failed', 'error': str(error),
+                             'offset': sessionOffset(session)})
+    return JsonResponse({'status': 'ok', 'offset': offset})
+
+
+@csrf_exempt
+@logged_in_or_basicauth()
+@is_staff_member()
+def uploadSessionFinalize(request, sessionId):
+    session = getUploadSession(request, sessionId)
+    if request.method != 'POST':
+        return JsonResponse({'status': 'failed', 'error': 'POST required'}, status=405)
+
+    status = 'ok'
+    try:
+        package_metadata = getPackageMetadata(request)
+        package = finishSession(session)
+        if asyncUploadRequested(getRequestDictionary(request)):
+            try:
+                job = queueUpload(request.user, package, package_metadata)
+            finally:
+                package.close()
+            removeSession(session)
+            return jobStatus(job)
+        try:
+            try:
+                pkgdata = parseAndValidatePackageMetadata(package)
+            except:
+                raise Exception('Package validation failed')
+
+            package.seek(0)
+            savePackageFile(pkgdata, package, package_metadata)
+        finally:
+            package.close()
+        removeSession(session)
+    except Exception as error:
+        status = str(error)
+    return JsonResponse({'status': status})
+
+
+@logged_in_or_basicauth()
+@is_staff_member()
+def uploadStatus(request):
+    """ Returns the state of an asynchronous upload """
+    jobId = getRequestDictionary(request).get('id', '')
+    try:
+        job = UploadJob.objects.get(id=jobId, user=request.user)
+    except (UploadJob.DoesNotExist, ValidationError):
+        return JsonResponse({'status': 'failed', 'error': 'no such upload: %s' % jobId})
+
+    return JsonResponse({'status': job.state,
+                         'id': str(job.id),
+                         'appid': job.appid,
+                         'error': job.error,
+                         'queued': job.dateQueued.isoformat(),
+                         'started': job.dateStarted.isoformat() if job.dateStarted else None,
+                         'finished': job.dateFinished.isoformat() if job.dateFinished else None,
+                         'timings': job.timings})
+
+
+def fileLastModified(filename):
+    try:
+        return datetime.datetime.fromtimestamp(os.stat(filename).st_mtime, tz=datetime.timezone.utc)
+    except (OSError, TypeError):
+        return None
+
+
+def appListETag(request):
+    # The list depends on the catalog and on the device context stored by hello, as well as
+    # on the host name used in the icon URLs
+    dictionary = getRequestDictionary(request)
+    context = (catalogSnapshot().digest, request.build_absolute_uri('/'),
+               getDeviceContext(request), dictionary.get('filter'), dictionary.get('category_id'),
+               dictionary.get('icons'), iconSize(request))
+    return hashlib.sha256(repr(context).encode('utf-8')).hexdigest()
+
+
+@condition(etag_func=appListETag)
 def appList(request):
-    apps = App.objects.all()
     dictionary = getRequestDictionary(request)
-    if 'filter' in dictionary:
-        apps = apps.filter(name__contains=dictionary['filter'])
-    if 'category_id' in dictionary:
-        catId = dictionary['category_id']
-        if catId != -1: # All metacategory
-            apps = apps.filter(category__exact=catId)
 
     # Here goes the logic of listing packages when multiple architectures are available
-    # in /hello request, the target architecture is stored in the session. By definition
+    # in /hello request, the target architecture is stored in the device context. By definition
     # target machine can support both "All" package architecture and it's native one.
     # So - here goes filtering by list of architectures
-    archlist = ['All', ]
-    if 'architecture' in request.session:
-        archlist.append(request.session['architecture'])
-
-    apps = apps.filter(architecture__in=archlist)
+    archlist = getDeviceArchitectures(request)
 
     #Tag filtering
     #There is no search by version distance yet - this must be fixed
-    if 'tag' in request.session:
-        tags = SoftwareTagList()
-        tags.parse(request.session['tag'])
-        apps_ids = [app.id for app in apps if app.is_tagmatching(tags.list())]
-        apps = App.objects.filter(id__in=apps_ids)
+    snapshot = catalogSnapshot()
+    apps = snapshot.filter(archlist, getDeviceTags(request))
+
+    if 'filter' in dictionary:
+        # same as name__contains on SQLite, which is case-insensitive for ASCII
+        nameFilter = dictionary['filter'].lower()
+        apps = [app for app in apps if nameFilter in app.name.lower()]
+    if 'category_id' in dictionary:
+        catId = dictionary['category_id']
+        if catId != '-1': # All metacategory
+            apps = [app for app in apps if str(app.category_id) == catId]
 
     # After filtering, there are potential duplicates in list. And we should prefer native
     # applications to pure qml ones due to speedups offered.
@@ -217,106 +390,180 @@ def appList(request):
     # 'distance' between requested version and package version. Architecture will be also included
     # in this metric (as native apps should be preferred)
 
-    selectedAppList = apps.values('id', 'appid', 'name', 'vendor__name', 'briefDescription',
-                                       'category', 'architecture',
-                                       'version', 'pkgformat', 'tags_hash').order_by('appid', 'architecture', 'tags_hash')
+    # with icons=1, the icons are inlined, so that a catalog page needs no further requests
+    size = iconSize(request)
+    inlineIcons = dictionary.get('icons') == '1'
+    if inlineIcons:
+        icons = iconCache().getMany([appIconPath(snapshot, app, size) for app in apps])
 
     appList = []
-    for app in selectedAppList:
-        app['purchaseId'] = app['id']
-        app['id'] = app['appid']
-        app['category_id'] = app['category']
-        app['category'] = Category.objects.all().filter(id__exact=app['category_id'])[0].name
-        app['vendor'] = app['vendor__name']
-        app['tags'] = []
-        tags = list(App.objects.filter(appid=app['appid'], architecture=app['architecture'], tags_hash=app['tags_hash'], tags__negative=False).values('tags__name', 'tags__version'))
-        for i in tags:
-            app['tags'].append(i['tags__name'] if not i['tags__version'] else ':'.join((i['tags__name'],i['tags__version'])))
-        app['conflict_tags'] = []
-        conflict_tags = list(App.objects.filter(appid=app['appid'], architecture=app['architecture'], tags_hash=app['tags_hash'], tags__negative=True).values('tags__name', 'tags__version'))
-        for i in conflict_tags:
-            app['conflict_tags'].append(i['tags__name'] if not i['tags__version'] else ':'.join((i['tags__name'],i['tags__version'])))
-
-        toFile = '_'.join([app['appid'], app['architecture'], app['tags_hash']])
+    for app in apps:
+        # icons in the blob store are addressed by their digest, so their URL is immutable
+        toFile = app.iconDigest or '_'.join([app.appid, app.architecture, app.tags_hash])
         if settings.URL_PREFIX != '':
             iconUri = '/' + settings.URL_PREFIX + '/app/icons/' + toFile
         else:
             iconUri = '/app/icons/' + toFile
-        app['iconUrl'] = request.build_absolute_uri(iconUri)
-        del app['vendor__name']
-        del app['appid']
-        del app['tags_hash']
-        appList.append(app)
+        if size:
+            iconUri += '?size=%d' % size
+
+        appList.append({'id': app.appid,
+                        'name': app.name,
+                        'briefDescription': app.briefDescription,
+                        'category': app.category,
+                        'architecture': app.architecture,
+                        'version': app.version,
+                        'pkgformat': app.pkgformat,
+                        'purchaseId': app.id,
+                        'category_id': app.category_id,
+                        'vendor': app.vendor,
+                        'tags': list(app.tags),
+                        'conflict_tags': list(app.conflict_tags),
+                        'iconUrl': request.build_absolute_uri(iconUri)})
+        if inlineIcons:
+            icon = icons.get(appIconPath(snapshot, app, size)[0])
+            appList[-1]['icon'] = base64.b64encode(icon.data).decode() if icon else None
 
     # this is not valid JSON, since we are returning a list!
     return JsonResponse(appList, safe=False)
 
 
 def appDescription(request):
-    archlist = ['All', ]
-    if 'architecture' in request.session:
-        archlist.append(request.session['architecture'])
+    archlist = getDeviceArchitectures(request)
     appId = getRequestDictionary(request)['id']
-    try:
-        app = App.objects.filter(appid__exact = appId, architecture__in = archlist).order_by('architecture','tags_hash')
-        #Tag filtering
-        #There is no search by version distance yet - this must be fixed
-        if 'tag' in request.session:
-            tags = SoftwareTagList()
-            tags.parse(request.session['tag'])
-            app_ids = [x.id for x in app if x.is_tagmatching(tags.list())]
-            app = App.objects.filter(id__in=app_ids)
-        app = app.last()
-        return HttpResponse(app.description)
-    except:
+    #Tag filtering
+    #There is no search by version distance yet - this must be fixed
+    app = catalogSnapshot().select(archlist, getDeviceTags(request), appId=appId)
+    if app is None:
         raise Http404('no such application: %s' % appId)
+    return HttpResponse(app.description)
 
 
-def appIconNew(request, path):
-    path=path.replace('/', '_').replace('\\', '_').replace(':', 'x3A').replace(',', 'x2C') + '.png'
+def iconSize(request):
+    """ Returns the icon size requested with the size parameter, 0 for the original icons """
     try:
-        response = HttpResponse(content_type='image/png')
-        with open(os.path.join(settings.MEDIA_ROOT, iconPath(), path), 'rb') as pkg:
-            response.write(pkg.read())
-            response['Content-Length'] = pkg.tell()
-        return response
-    except:
+        return max(int(getRequestDictionary(request).get('size', 0)), 0)
+    except ValueError:
+        return 0
+
+
+def appIconFile(path, size=0):
+    """
+    Returns (path, blob digest) of app/icons/<path>, the digest is None for legacy files.
+    The path is None for blobs that are not icons of the catalog.
+    """
+    if isBlobDigest(path):
+        snapshot = catalogSnapshot()
+        if path not in snapshot.iconDigests:
+            return None, None
+        digest = snapshot.iconVariant(path, size)
+        return os.path.join(settings.MEDIA_ROOT, blobPath(digest)), digest
+    path=path.replace('/', '_').replace('\\', '_').replace(':', 'x3A').replace(',', 'x2C') + '.png'
+    return os.path.join(settings.MEDIA_ROOT, iconPath(), path), None
+
+
+def appIconPath(snapshot, app, size=0):
+    """ Returns (path, blob digest) of the icon of a CatalogApp, see CatalogSnapshot.iconFile() """
+    path, digest = snapshot.iconFile(app, size)
+    return os.path.join(settings.MEDIA_ROOT, path), digest
+
+
+def cachedIcon(request, path, digest=None):
+    """ Returns the Icon at path from the icon cache or None, looked up only once per request """
+    if not hasattr(request, 'icon'):
+        try:
+            request.icon = iconCache().get(path, digest)
+        except (OSError, TypeError):
+            request.icon = None
+    return request.icon
+
+
+def appIconETag(request, path):
+    icon = cachedIcon(request, *appIconFile(path, iconSize(request)))
+    return icon.etag if icon else None
+
+
+def appIconLastModified(request, path):
+    icon = cachedIcon(request, *appIconFile(path, iconSize(request)))
+    return icon.lastModified if icon else None
+
+
+@condition(etag_func=appIconETag, last_modified_func=appIconLastModified)
+def appIconNew(request, path):
+    icon = cachedIcon(request, *appIconFile(path, iconSize(request)))
+    if icon is None:
         raise Http404
+    response = HttpResponse(icon.data, content_type='image/png')
+    response['Content-Length'] = len(icon.data)
+    if isBlobDigest(path):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@logged_in_or_basicauth()
+@is_staff_member()
+def iconMetrics(request):
+    return JsonResponse(iconCache().metrics())
+
+
+# maximum number of icons returned by one app/icons request
+ICON_BATCH_SIZE = 500
+
+
+def appIcons(request):
+    dictionary = getRequestDictionary(request)
+    iconIds = [i for i in dictionary.get('ids', '').split(',') if i]
+    purchaseIds = [i for i in dictionary.get('purchaseIds', '').split(',') if i]
+    if len(iconIds) + len(purchaseIds) > ICON_BATCH_SIZE:
+        return JsonResponse({'status': 'failed',
+                             'error': 'at most %d icons per request' % ICON_BATCH_SIZE}, status=400)
+
+    size = iconSize(request)
+    files = {}
+    for iconId in iconIds:
+        path, digest = appIconFile(iconId, size)
+        if path is not None:
+            files[iconId] = (path, digest)
+    if purchaseIds:
+        snapshot = catalogSnapshot()
+        archlist = getDeviceArchitectures(request)
+        tags = getDeviceTags(request)
+        for purchaseId in purchaseIds:
+            app = snapshot.select(archlist, tags, purchaseId=purchaseId)
+            if app is not None:
+                files[purchaseId] = appIconPath(snapshot, app, size)
+
+    icons = iconCache().getMany(files.values())
+    return JsonResponse({'status': 'ok',
+                         'icons': {key: base64.b64encode(icons[path].data).decode()
+                                   for key, (path, digest) in files.items() if path in icons}})
+
 
 def appIcon(request):
     archlist = ['All', ]
     dictionary = getRequestDictionary(request)
     if 'architecture' in dictionary:
         archlist.append(normalizeArch(dictionary['architecture']))
-    elif 'architecture' in request.session:
-        archlist.append(request.session['architecture'])
+    else:
+        archlist = getDeviceArchitectures(request)
     appId = dictionary['id']
-    try:
-        apps = App.objects.filter(appid__exact = appId, architecture__in = archlist).order_by('architecture','tags_hash')
-        #Tag filtering
-        #There is no search by version distance yet - this must be fixed
-        if 'tag' in request.session:
-            tags = SoftwareTagList()
-            tags.parse(request.session['tag'])
-            app_ids = [x.id for x in apps if x.is_tagmatching(tags.list())]
-            apps = App.objects.filter(id__in=app_ids)
-        app = apps.last()
-        path = iconPath(app.appid, app.architecture, app.tags_hash)
-        path = os.path.join(settings.MEDIA_ROOT, path)
-        with open(path, 'rb') as iconPng:
-            response = HttpResponse(content_type='image/png')
-            response.write(iconPng.read())
-            return response
-    except:
+    #Tag filtering
+    #There is no search by version distance yet - this must be fixed
+    snapshot = catalogSnapshot()
+    app = snapshot.select(archlist, getDeviceTags(request), appId=appId)
+    if app is None:
+        raise Http404('no such application: %s' % appId)
+    icon = cachedIcon(request, *appIconPath(snapshot, app, iconSize(request)))
+    if icon is None:
         raise Http404('no such application: %s' % appId)
+    return HttpResponse(icon.data, content_type='image/png')
 
 
+@optional_basicauth()
 def appPurchase(request):
     if not request.user.is_authenticated:
         return HttpResponseForbidden('no login')
-    archlist = ['All', ]
-    if 'architecture' in request.session:
-        archlist.append(request.session['architecture'])
+    archlist = getDeviceArchitectures(request)
 
     try:
         deviceId = str(getRequestDictionary(request).get("device_id", ""))
@@ -326,95 +573,262 @@ def appPurchase(request):
         else:
             deviceId = ''
 
+        snapshot = catalogSnapshot()
+        tags = getDeviceTags(request)
+        #Tag filtering
+        #There is no search by version distance yet - this must be fixed
         if 'id' in getRequestDictionary(request):
-            app = App.objects.filter(appid__exact = getRequestDictionary(request)['id'], architecture__in=archlist).order_by('architecture','tags_hash')
+            app = snapshot.select(archlist, tags, appId=getRequestDictionary(request)['id'])
         elif 'purchaseId' in getRequestDictionary(request):
-            app = App.objects.filter(id__exact = getRequestDictionary(request)['purchaseId'], architecture__in=archlist).order_by('architecture','tags_hash')
+            app = snapshot.select(archlist, tags, purchaseId=getRequestDictionary(request)['purchaseId'])
         else:
             raise ValidationError('id or purchaseId parameter required')
-        #Tag filtering
-        #There is no search by version distance yet - this must be fixed
-        if 'tag' in request.session:
-            tags = SoftwareTagList()
-            tags.parse(request.session['tag'])
-            app_ids = [x.id for x in app if x.is_tagmatching(tags.list())]
-            app = App.objects.filter(id__in=app_ids)
+        if app is None:
+            raise Exception('no such application')
 
-        app = app.last()
-        fromFilePath = os.path.join(settings.MEDIA_ROOT, packagePath(app.appid, app.architecture, app.tags_hash))
+        fromFilePath = os.path.join(settings.MEDIA_ROOT, app.file)
+
+        # The signed package only depends on the package contents, the device id and the
+        # signing certificate, so a still valid download for the same combination is reused.
+        if not settings.APPSTORE_NO_SECURITY:
+            certificateDigest = fileDigest(settings.APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE)
+        else:
+            certificateDigest = None
+        packageDigest = app.packageDigest or fileDigest(fromFilePath)
+        key = downloadKey(packageDigest, deviceId, certificateDigest)
 
         # we should not use obvious names here, but just hash the string.
         # this would be a nightmare to debug though and this is a development server :)
-        toFile = '_'.join((str(app.appid), str(request.user.id), str(app.architecture),
-                           str(app.tags_hash), str(deviceId)))
-        if not settings.DEBUG:
-            toFile = hashlib.sha256(toFile).hexdigest()
+        if settings.DEBUG:
+            toFile = '_'.join((str(app.appid), str(app.architecture), app.tagset[:16],
+                               str(deviceId), key[:16]))
+        else:
+            toFile = key
         toFile += '.appkg'
-        toPath = downloadPath()
-        if not os.path.exists(toPath):
-            os.makedirs(toPath)
 
-        if not settings.APPSTORE_NO_SECURITY:
-            with open(fromFilePath, 'rb') as package:
-                pkgdata = parsePackageMetadata(package)
-                addSignatureToPackage(fromFilePath, toPath + toFile, pkgdata['rawDigest'], deviceId,
-                                      pkgdata['packageFormat']['formatVersion'])
-        else:
-            try:
-                shutil.copyfile(fromFilePath, toPath + toFile)
-            except Exception as error:
-                if type(error) == IOError:
-                    raise IOError(error.args[0], error.args[1], os.path.basename(fromFilePath))
-                else:
-                    raise error
+        if cachedDownload(toFile):
+            return purchaseResponse(request, toFile)
 
-        if settings.URL_PREFIX != '':
-            downloadUri = '/' + settings.URL_PREFIX + '/app/download/' + toFile
-        else:
-            downloadUri = '/app/download/' + toFile
+        args = (fromFilePath, toFile, deviceId, not settings.APPSTORE_NO_SECURITY, packageDigest)
+        asyncPurchase = getRequestDictionary(request).get('async', '')
+        if asyncPurchase == '1' or (asyncPurchase == '' and settings.APPSTORE_ASYNC_PURCHASE):
+            priority = getRequestDictionary(request).get('priority', 'interactive')
+            if priority not in PRIORITIES:
+                raise ValidationError('unknown priority: %s' % priority)
+            job = signingPool().submit(toFile, PRIORITIES[priority], *args)
+            return jobResponse(request, job)
 
-        return JsonResponse({'status': 'ok',
-                             'url': request.build_absolute_uri(downloadUri),
-                             'expiresIn': int(settings.APPSTORE_DOWNLOAD_EXPIRY) * 60})
+        createDownload(*args)
+        return purchaseResponse(request, toFile)
 
-        # a cronjob runing "manage.py expiredownloads" every settings.APPSTORE_DOWNLOAD_EXPIRY/2
-        # minutes will take care of removing these temporary download files.
+        # a cronjob runing "manage.py expire-downloads" every settings.APPSTORE_DOWNLOAD_EXPIRY/2
+        # minutes will take care of removing these temporary download files, in addition to the
+        # eviction that happens whenever a new download file is created.
     except Exception as error:
         return JsonResponse({ 'status': 'failed', 'error': str(error)})
 
 
+def purchaseResponse(request, toFile):
+    if settings.URL_PREFIX != '':
+        downloadUri = '/' + settings.URL_PREFIX + '/app/download/' + toFile
+    else:
+        downloadUri = '/app/download/' + toFile
+
+    return JsonResponse({'status': 'ok',
+                         'url': request.build_absolute_uri(downloadUri),
+                         'expiresIn': int(settings.APPSTORE_DOWNLOAD_EXPIRY) * 60})
+
+
+def jobResponse(request, job):
+    if job.state == 'failed':
+        return JsonResponse({'status': 'failed', 'id': job.id, 'error': job.error})
+    if job.state == 'done':
+        if cachedDownload(job.id):
+            return purchaseResponse(request, job.id)
+        # the download has expired or was evicted from the cache meanwhile, sign it again
+        try:
+            job = signingPool().submit(job.id, job.priority, *job.args)
+        except QueueFull as error:
+            return JsonResponse({'status': 'failed', 'id': job.id, 'error': str(error)})
+    return JsonResponse({'status': 'pending', 'id': job.id})
+
+
+@optional_basicauth()
+def appPurchaseStatus(request):
+    if not request.user.is_authenticated:
+        return HttpResponseForbidden('no login')
+
+    jobId = str(getRequestDictionary(request).get('id', ''))
+    if not downloadFile(jobId):
+        return JsonResponse({'status': 'failed', 'error': 'id parameter required'})
+
+    job = signingPool().job(jobId)
+    if job is not None:
+        return jobResponse(request, job)
+    # the job may have been handled by another server process
+    if cachedDownload(jobId):
+        return purchaseResponse(request, jobId)
+    return JsonResponse({'status': 'failed', 'error': 'no such purchase'})
+
+
+@logged_in_or_basicauth()
+@is_staff_member()
+def purchaseMetrics(request):
+    return JsonResponse({'signing': signingPool().metrics(), 'crypto': cryptoTimings.report()})
+
+
+def downloadFile(path):
+    # downloads are flat files, do not allow escaping the downloads directory
+    if not path or os.path.basename(path) != path:
+        return None
+    return downloadPath() + path
+
+
+def downloadETag(request, path):
+    # the download files are written once and never modified afterwards, so size and
+    # modification time are good enough to identify them without reading the contents
+    # (handing out a download again only touches its access time, see store.downloads)
+    try:
+        stat = os.stat(downloadFile(path))
+        return '%x-%x' % (stat.st_size, stat.st_mtime_ns)
+    except (OSError, TypeError):
+        return None
+
+
+def downloadLastModified(request, path):
+    return fileLastModified(downloadFile(path))
+
+
+def parseRange(rangeHeader, size):
+    """
+    Parses a "Range: bytes=..." header value for a file of the given size and returns a
+    (start, end) tuple, end being inclusive. Returns None when the header should be ignored
+    (malformed or multiple ranges, which are served as a complete file) and raises ValueError
+    if the range can not be satisfied.
+    """
+    unit, _, ranges = rangeHeader.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+
+    if not first:  # suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('unsatisfiable range')
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError('unsatisfiable range')
+    return start, min(end, size - 1)
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def fileChunks(fileObject, offset, length):
+    try:
+        fileObject.seek(offset)
+        while length > 0:
+            data = fileObject.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileObject.close()
+
+
+@condition(etag_func=downloadETag, last_modified_func=downloadLastModified)
 def appDownload(request, path):
     try:
-        response = HttpResponse(content_type='application/octetstream')
-        with open(downloadPath() + path, 'rb') as pkg:
-            response.write(pkg.read())
-            response['Content-Length'] = pkg.tell()
-        return response
-    except:
+        pkg = open(downloadFile(path), 'rb')
+    except (OSError, TypeError):
         raise Http404
+    size = os.fstat(pkg.fileno()).st_size
+
+    byteRange = None
+    if 'HTTP_RANGE' in request.META:
+        # If-Range: only send the partial content if the file is still the same one
+        ifRange = request.META.get('HTTP_IF_RANGE')
+        if ifRange is None or ifRange in (quote_etag(downloadETag(request, path)),
+                                          http_date(os.fstat(pkg.fileno()).st_mtime)):
+            try:
+                byteRange = parseRange(request.META['HTTP_RANGE'], size)
+            except ValueError:
+                pkg.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+
+    if byteRange is None:
+        response = FileResponse(pkg, content_type='application/octetstream')
+        response.block_size = DOWNLOAD_CHUNK_SIZE
+        response['Content-Length'] = size
+    else:
+        start, end = byteRange
+        response = StreamingHttpResponse(fileChunks(pkg, start, end - start + 1),
+                                         status=206, content_type='application/octetstream')
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def categoryListETag(request):
+    return catalogSnapshot().categoriesDigest
 
 
+def categoryListLastModified(request):
+    return datetime.datetime.fromtimestamp(catalogSnapshot().timestamp, tz=datetime.timezone.utc)
+
+
+@condition(etag_func=categoryListETag, last_modified_func=categoryListLastModified)
 def categoryList(request):
     # this is not valid JSON, since we are returning a list!
     allmeta = [{'id': -1, 'name': 'All'}, ] #All metacategory
-    categoryobject = Category.objects.all().order_by('order').values('id', 'name')
-    categoryobject=allmeta + list(categoryobject)
+    categoryobject = [{'id': i.id, 'name': i.name} for i in catalogSnapshot().categories]
+    categoryobject=allmeta + categoryobject
     return JsonResponse(categoryobject, safe = False)
 
 
+@functools.lru_cache(maxsize=None)
+def allCategoryIconFile():
+    from django.contrib.staticfiles import finders
+    return finders.find('img/category_All.png')
+
+
+def categoryIconFile(categoryId):
+    if categoryId == '-1':
+        return allCategoryIconFile()
+    if not any(str(category.id) == categoryId for category in catalogSnapshot().categories):
+        return None
+    return os.path.join(settings.MEDIA_ROOT, iconPath(), "category_" + categoryId + ".png")
+
+
+def categoryIconETag(request):
+    icon = cachedIcon(request, categoryIconFile(getRequestDictionary(request).get('id')))
+    return icon.etag if icon else None
+
+
+def categoryIconLastModified(request):
+    icon = cachedIcon(request, categoryIconFile(getRequestDictionary(request).get('id')))
+    return icon.lastModified if icon else None
+
+
+@condition(etag_func=categoryIconETag, last_modified_func=categoryIconLastModified)
 def categoryIcon(request):
     response = HttpResponse(content_type = 'image/png')
     categoryId = getRequestDictionary(request)['id']
     try:
-        if categoryId != '-1':
-            category = Category.objects.filter(id__exact = categoryId)[0]
-            filename = os.path.join(settings.MEDIA_ROOT, iconPath(), "category_" + str(category.id) + ".png")
-        else:
-            from django.contrib.staticfiles import finders
-            filename = finders.find('img/category_All.png')
-        with open(filename, 'rb') as icon:
-            response.write(icon.read())
-            response['Content-Length'] = icon.tell()
+        icon = cachedIcon(request, categoryIconFile(categoryId))
+        response.write(icon.data)
+        response['Content-Length'] = len(icon.data)
 
     except:
         # In case there was error in searching for category,
@@ -33,13 +33,71 @@
 # Code taken from: https://www.djangosnippets.org/snippets/243/
 # Reuse and licensing is permitted by TOS: https://www.djangosnippets.org/about/tos/
 
+import hmac
 import base64
+import hashlib
+import binascii
 
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, get_user_model
 
 #############################################################################
 
+def credentials_cache_key(credentials):
+    """
+    The cache key for the credentials of a basic authorization header. It is keyed with the
+    SECRET_KEY, so that the cache does not hold anything that could be used to check a
+    password guess.
+    """
+    digest = hmac.new(settings.SECRET_KEY.encode('utf-8'), credentials.encode('utf-8'),
+                      hashlib.sha256).hexdigest()
+    return 'store.basicauth.' + digest
+
+
+def password_fingerprint(user):
+    # changes whenever the password (or its hash) changes
+    return hashlib.sha256(user.password.encode('utf-8')).hexdigest()
+
+
+def basicauth_user(request):
+    """
+    Returns the active user authenticated by the basic authorization header of the request,
+    or None.
+
+    Checking a password means computing an expensive password hash, so verified credentials
+    are cached for APPSTORE_AUTH_CACHE_TTL seconds. A cached entry is only used as long as the
+    password of the user is unchanged and the user is active.
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    # NOTE: We are only support basic authentication for now.
+    if len(auth) != 2 or auth[0].lower() != "basic":
+        return None
+
+    ttl = int(settings.APPSTORE_AUTH_CACHE_TTL)
+    key = credentials_cache_key(auth[1])
+    if ttl > 0:
+        cached = cache.get(key)
+        if cached is not None:
+            user_id, fingerprint = cached
+            user = get_user_model().objects.filter(pk=user_id, is_active=True).first()
+            if user is not None and hmac.compare_digest(password_fingerprint(user), fingerprint):
+                return user
+            cache.delete(key)
+
+    try:
+        uname, passwd = base64.b64decode(auth[1].encode('utf-8')).decode('utf-8').split(':', 1)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+    user = authenticate(request, username=uname, password=passwd)
+    if user is None or not user.is_active:
+        return None
+    if ttl > 0:
+        cache.set(key, (user.pk, password_fingerprint(user)), ttl)
+    return user
+
+
 def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
     """
     This is a helper function used by both 'logged_in_or_basicauth' and
@@ -52,22 +110,14 @@ def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
         #
         return view(request, *args, **kwargs)
 
-    # They are not logged in. See if they provided login credentials
+    # They are not logged in. See if they provided login credentials. The user is not
+    # logged in to a session, as these clients send their credentials with every request.
     #
-    if 'HTTP_AUTHORIZATION' in request.META:
-        auth = request.META['HTTP_AUTHORIZATION'].split()
-        if len(auth) == 2:
-            # NOTE: We are only support basic authentication for now.
-            #
-            if auth[0].lower() == "basic":
-                uname, passwd = base64.b64decode(auth[1].encode('utf-8')).decode('utf-8').split(':')
-                user = authenticate(username=uname, password=passwd)
-                if user is not None:
-                    if user.is_active:
-                        login(request, user)
-                        request.user = user
-                        if test_func(request.user):
-                            return view(request, *args, **kwargs)
+    user = basicauth_user(request)
+    if user is not None:
+        request.user = user
+        if test_func(request.user):
+            return view(request, *args, **kwargs)
 
     # Either they did not provide an authorization header or
     # something in the authorization attempt failed. Send a 401
@@ -134,3 +184,18 @@ def is_staff_member():
         return wrapper
     return view_decorator
 
+def optional_basicauth():
+    """
+    Authenticates the request with basic authentication, if it is not logged in but has an
+    authorization header. Unlike logged_in_or_basicauth, the view is always called.
+    """
+    def view_decorator(func):
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                user = basicauth_user(request)
+                if user is not None:
+                    request.user = user
+            return func(request, *args, **kwargs)
+
+        return wrapper
+    return view_decorator
@@ -0,0 +1,291 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+
+# Content-addressed store for package and icon files.
+#
+# Packages and icons are stored once per content, as MEDIA_ROOT/blobs/<xx>/<sha256>, no matter
+# how many App entries (e.g. variants with different tags) refer to them. Blob files are never
+# modified: uploading identical bytes again only reuses the existing blob, and an updated App
+# simply refers to a different blob. Blobs that are no longer referenced by any App, as well as
+# the signing bases of such packages, are removed by collectGarbage().
+
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import datetime
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.db import transaction, IntegrityError
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from store.utilities import iconPath, signingBasePath, fileDigest
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = 'blobs'
+TEMP_PREFIX = '.tmp-'
+CHUNK_SIZE = 64 * 1024
+# unreferenced blobs younger than this are kept, as an upload may be about to refer to them
+GRACE_PERIOD = 60 * 60
+
+PACKAGE = 'package'
+ICON = 'icon'
+
+
+def blobPath(digest):
+    """ Returns the path of a blob, relative to MEDIA_ROOT """
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def isBlobDigest(name):
+    return len(name) == 64 and all(c in '0123456789abcdef' for c in name)
+
+
+def blobDigest(path):
+    """ Returns the digest of the blob at path (relative to MEDIA_ROOT), or None """
+    if not path:
+        return None
+    parts = path.split('/')
+    if len(parts) == 3 and parts[0] == BLOB_DIR and isBlobDigest(parts[2]) \
+            and parts[1] == parts[2][:2]:
+        return parts[2]
+    return None
+
+
+def hashFile(file):
+    digest = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+class StagedFile(File):
+    """
+    A complete file in the uploads directory, which storeBlob() moves into the store instead of
+    copying it. digest is its SHA-256, if already known.
+    """
+
+    def __init__(self, path, digest=None):
+        super().__init__(open(path, 'rb'), os.path.basename(path))
+        self.path = path
+        self.digest = digest
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def storeBlob(kind, content):
+    """
+    Stores content and returns its Blob. content can be bytes, a file object or an uploaded
+    file; uploaded files in a temporary file are moved into the store instead of being copied.
+    If a blob with the same digest already exists, nothing is written.
+    """
+    from store.models import Blob
+
+    root = os.path.join(settings.MEDIA_ROOT, BLOB_DIR)
+    os.makedirs(root, exist_ok=True)
+    tempPath = None
+    try:
+        if isinstance(content, bytes):
+            digest, size = hashlib.sha256(content).hexdigest(), len(content)
+        elif hasattr(content, 'temporary_file_path'):
+            # the upload handler already hashed the package while receiving it
+            digest = getattr(content, 'digest', None)
+            size = content.size
+            if digest is None:
+                digest, size = hashFile(content)
+        else:
+            # copy into a temporary file in the store while hashing
+            fd, tempPath = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=root)
+            hash = hashlib.sha256()
+            size = 0
+            content.seek(0)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+                    hash.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = hash.hexdigest()
+
+        # saving refreshes dateUsed, which keeps the blob from being collected right now. This
+        # happens before looking for the file, which collectGarbage() removes after the entry.
+        blob, created = Blob.objects.get_or_create(digest=digest,
+                                                   defaults={'kind': kind, 'size': size})
+        if not created:
+            blob.save(update_fields=['dateUsed'])
+
+        path = os.path.join(settings.MEDIA_ROOT, blobPath(digest))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if isinstance(content, bytes):
+                fd, tempPath = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=root)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+            elif tempPath is None:
+                content.file.flush()
+                file_move_safe(content.temporary_file_path(), path, allow_overwrite=True)
+            if tempPath is not None:
+                os.replace(tempPath, path)
+                tempPath = None
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(path, settings.FILE_UPLOAD_PERMISSIONS)
+        return blob
+    finally:
+        if tempPath is not None and os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+def importLegacyFiles(app):
+    """
+    Moves the package and icon files of an App stored before the blob store existed (below
+    packages/ and icons/) into the store. Returns False if there was nothing to import.
+    """
+    if app.package_id is not None:
+        return False
+
+    packageFile = os.path.join(settings.MEDIA_ROOT, app.file.name)
+    with open(packageFile, 'rb') as f:
+        app.package = storeBlob(PACKAGE, f)
+    app.file.name = app.package.path()
+
+    iconFile = os.path.join(settings.MEDIA_ROOT,
+                            iconPath(app.appid, app.architecture, app.tags_hash))
+    if os.path.exists(iconFile):
+        from store.iconvariants import storeIcon
+        with open(iconFile, 'rb') as f:
+            app.icon = storeIcon(f.read())
+        os.remove(iconFile)
+    # App.save() removes the old package file
+    app.save()
+    return True
+
+
+def collectGarbage(dryRun=False):
+    """
+    Removes blobs that are not referenced by any App or by the icon variants of a referenced icon
+    (and have not been used within the GRACE_PERIOD), stray blob files without a Blob entry and
+    the signing bases of packages that are no longer in the store.
+    Returns a list of (path relative to MEDIA_ROOT, size in bytes) of the removed files.
+    """
+    from store.models import Blob, App, IconVariant
+
+    removed = []
+
+    def remove(path, size):
+        removed.append((os.path.relpath(path, settings.MEDIA_ROOT), size))
+        if not dryRun:
+            try:
+                os.remove(path)
+            except OSError as error:
+                logger.warning('could not remove %s: %s', path, error)
+
+    threshold = timezone.now() - datetime.timedelta(seconds=GRACE_PERIOD)
+    unreferenced = Blob.objects.filter(packageApps=None, iconApps=None, dateUsed__lt=threshold)
+    # variants go along with their icon, which is removed first, dropping the IconVariant entries
+    unreferenced = unreferenced.exclude(variantOf__icon__iconApps__isnull=False) \
+                               .exclude(variantOf__icon__dateUsed__gte=threshold)
+    isVariant = Exists(IconVariant.objects.filter(blob=OuterRef('pk')))
+    unused = []
+    for blob in unreferenced.annotate(isVariant=isVariant).order_by('isVariant', 'digest'):
+        path = os.path.join(settings.MEDIA_ROOT, blob.path())
+        if not dryRun:
+            # The entry is removed first, unless an upload has referred to the blob meanwhile.
+            # storeBlob() creates the entry before looking for the file, so once the file is
+            # out of the way, an upload storing the same content again either shows up as a
+            # new entry here or writes the file anew.
+            try:
+                with transaction.atomic():
+                    deleted, _ = unreferenced.filter(digest=blob.digest).delete()
+            except IntegrityError:
+                continue
+            if not deleted:
+                continue
+            tempPath = os.path.join(os.path.dirname(path), TEMP_PREFIX + blob.digest)
+            try:
+                os.replace(path, tempPath)
+            except OSError as error:
+                logger.warning('could not remove %s: %s', path, error)
+                continue
+            if Blob.objects.filter(digest=blob.digest).exists():
+                os.replace(tempPath, path)
+                continue
+            path = tempPath
+        unused.append(blob)
+        removed.append((blob.path(), blob.size))
+        if not dryRun:
+            try:
+                os.remove(path)
+            except OSError as error:
+                logger.warning('could not remove %s: %s', path, error)
+
+    collected = set(blob.digest for blob in unused)
+    known = set(Blob.objects.values_list('digest', flat=True)) - collected
+    root = os.path.join(settings.MEDIA_ROOT, BLOB_DIR)
+    cutoff = time.time() - GRACE_PERIOD
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if name in known or name in collected:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mtime < cutoff:
+                remove(path, stat.st_size)
+
+    # signing bases (and their signing info) are named after the digest of their package
+    packages = set(Blob.objects.filter(kind=PACKAGE).values_list('digest', flat=True))
+    packages -= collected
+    for app in App.objects.filter(package=None):
+        try:
+            packages.add(fileDigest(os.path.join(settings.MEDIA_ROOT, app.file.name)))
+        except OSError:
+            pass
+    if os.path.exists(signingBasePath()):
+        for name in os.listdir(signingBasePath()):
+            path = os.path.join(signingBasePath(), name)
+            for suffix in ('.tar.gz', '.yaml'):
+                if name.endswith(suffix) and name[:-len(suffix)] not in packages:
+                    remove(path, os.path.getsize(path))
+
+    return removed
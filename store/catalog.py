@@ -0,0 +1,304 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# In-process snapshot of the application catalog.
+#
+# The catalog only changes when packages are uploaded or edited in the admin, while devices
+# poll it all the time. Every worker process therefore keeps an immutable copy of all app
+# variants, which is rebuilt only when the catalog generation changes. The generation is a
+# number stored in a file in MEDIA_ROOT, so that all workers sharing the same data directory
+# notice changes done by any of them, without having to ask the database. The data directory
+# (and its blob store) has to be shared by all hosts using the same database anyway.
+#
+# With a database replica, the snapshot is read from the replica. As the replica may lag
+# behind, a snapshot built within REPLICA_LAG seconds of a catalog change is built once more
+# after that time.
+
+import os
+import time
+import fcntl
+import hashlib
+import threading
+import collections
+import numpy
+
+from django.conf import settings
+from django.db import transaction
+
+from store.utilities import iconPath
+from store.blobs import blobPath
+from store.iconvariants import selectVariant
+from store.database import REPLICA, catalogReads
+from store.tags import SoftwareTagMatcher
+
+CatalogApp = collections.namedtuple('CatalogApp', [
+    'id',                # purchase id (string form of App.id)
+    'appid',
+    'name',
+    'briefDescription',
+    'description',
+    'category_id',
+    'category',          # category name
+    'vendor',            # vendor name
+    'architecture',
+    'version',
+    'pkgformat',
+    'tags_hash',
+    'tagset',            # fingerprint of the tag set
+    'tags',              # required tags, as strings
+    'conflict_tags',     # conflicting tags, as strings
+    'dateModified',
+    'file',              # package path, relative to MEDIA_ROOT
+    'icon',              # icon path, relative to MEDIA_ROOT
+    'packageDigest',     # SHA-256 of the package blob, None for legacy package files
+    'iconDigest',        # SHA-256 of the icon blob, None for legacy icon files
+])
+
+CatalogCategory = collections.namedtuple('CatalogCategory', ['id', 'name', 'order'])
+
+
+class CatalogSnapshot:
+    """
+    Immutable, indexed copy of the catalog for one generation.
+    Apps are ordered by appid, architecture and tags_hash, categories by their order.
+    """
+
+    def __init__(self, generation, timestamp, apps, tagsets, categories, iconVariants=None):
+        """
+        :param timestamp: time of the last catalog change, in seconds since the epoch
+        :param apps: list of CatalogApp
+        :param tagsets: (required, conflicts) lists of SoftwareTag, one pair per app
+        :param categories: list of CatalogCategory
+        :param iconVariants: icon digest -> tuple of (size, digest) of its variants, by size
+        """
+        self.generation = generation
+        self.timestamp = timestamp
+        self.apps = tuple(apps)
+        self.categories = tuple(categories)
+        self.iconVariants = iconVariants or {}
+        # only these blobs may be served as icons, all other blobs are packages
+        self.iconDigests = frozenset([app.iconDigest for app in self.apps if app.iconDigest] +
+                                     [digest for variants in self.iconVariants.values()
+                                      for _, digest in variants])
+        # digests of the catalog content, used to derive ETags
+        content = (self.apps, self.categories, sorted(self.iconVariants.items()))
+        self.digest = hashlib.sha256(repr(content).encode('utf-8')).hexdigest()
+        self.categoriesDigest = hashlib.sha256(repr(self.categories).encode('utf-8')).hexdigest()
+        self.byId = {}
+        self.byAppId = {}
+        self.architectures = {}
+        for index, app in enumerate(self.apps):
+            self.byId[app.id] = index
+            self.byAppId.setdefault(app.appid, []).append(index)
+            self.architectures.setdefault(app.architecture, len(self.architectures))
+        self.architectureCodes = numpy.array([self.architectures[app.architecture]
+                                              for app in self.apps], dtype=numpy.int32)
+        self.matcher = SoftwareTagMatcher(tagsets)
+
+        self.built = time.time()
+        self.fromReplica = False
+
+    def current(self, generation):
+        """ Returns True if this snapshot can be used for the given catalog generation """
+        if self.generation != generation:
+            return False
+        settled = self.timestamp + REPLICA_LAG
+        return not (self.fromReplica and self.built < settled <= time.time())
+
+    def mask(self, archlist, tags=None):
+        """
+        Returns a boolean array over all apps, which is True for apps for one of the
+        architectures in archlist, matching the device tags (a list of SoftwareTag) if given.
+        """
+        codes = [self.architectures[i] for i in archlist if i in self.architectures]
+        result = numpy.isin(self.architectureCodes, codes)
+        if tags is not None:
+            result &= self.matcher.match(tags)
+        return result
+
+    def filter(self, archlist, tags=None, appId=None):
+        """
+        Returns all apps matching archlist and tags (see mask()). The result can be limited to
+        the variants of one application id.
+        """
+        mask = self.mask(archlist, tags)
+        if appId is None:
+            return [self.apps[i] for i in numpy.flatnonzero(mask)]
+        return [self.apps[i] for i in self.byAppId.get(appId, ()) if mask[i]]
+
+    def iconFile(self, app, size=0):
+        """
+        Returns the path (relative to MEDIA_ROOT) and blob digest of the icon of app, using the
+        variant for the given size if there is one. The digest is None for legacy icon files.
+        """
+        if app.iconDigest is None:
+            return app.icon, None
+        digest = self.iconVariant(app.iconDigest, size)
+        return blobPath(digest), digest
+
+    def iconVariant(self, digest, size):
+        """ Returns the digest of the variant of icon digest to serve for size, see selectVariant() """
+        return selectVariant(digest, self.iconVariants.get(digest, ()), size)
+
+    def select(self, archlist, tags=None, appId=None, purchaseId=None):
+        """
+        Returns the preferred variant of an application (or None), ordered the same way as
+        App.objects.order_by('architecture', 'tags_hash').last() would do.
+        """
+        if purchaseId is not None:
+            index = self.byId.get(str(purchaseId))
+            if index is None or not self.mask(archlist, tags)[index]:
+                return None
+            return self.apps[index]
+
+        apps = self.filter(archlist, tags, appId)
+        if not apps:
+            return None
+        return max(apps, key=lambda app: (app.architecture, app.tags_hash))
+
+
+def generationPath():
+    return os.path.join(settings.MEDIA_ROOT, 'catalog-generation')
+
+
+def currentGeneration():
+    try:
+        with open(generationPath(), 'r') as f:
+            return int(f.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def bumpGeneration():
+    path = generationPath()
+    if not os.path.exists(settings.MEDIA_ROOT):
+        os.makedirs(settings.MEDIA_ROOT)
+    # several processes may commit catalog changes at the same time, each of them has to
+    # produce a new generation
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        temp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            f.write(str(currentGeneration() + 1))
+        os.replace(temp, path)
+
+
+# seconds after which a catalog change is expected to have reached the database replica
+REPLICA_LAG = 10
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def invalidate():
+    """ Drops the snapshot of this process, without changing the shared generation """
+    global _snapshot
+    _snapshot = None
+
+
+def catalogChanged():
+    """
+    To be called whenever an App, Tag, Category or Vendor is written. The local snapshot is
+    dropped right away and the shared generation is bumped once the transaction is committed,
+    so that other workers can not rebuild from data that is not visible to them yet.
+    """
+    invalidate()
+    transaction.on_commit(bumpGeneration)
+
+
+def buildSnapshot(generation):
+    from store.models import App, Category, IconVariant
+
+    try:
+        timestamp = os.stat(generationPath()).st_mtime
+    except OSError:
+        timestamp = time.time()
+
+    with catalogReads():
+        apps = App.objects.select_related('category', 'vendor').prefetch_related('tags')
+        apps = list(apps.order_by('appid', 'architecture', 'tags_hash'))
+        categories = [CatalogCategory(*i) for i in
+                      Category.objects.order_by('order').values_list('id', 'name', 'order')]
+        iconVariants = collections.defaultdict(tuple)
+        variants = IconVariant.objects.order_by('icon', 'size').values_list('icon', 'size', 'blob')
+        for icon, size, digest in variants:
+            iconVariants[icon] += ((size, digest), )
+
+    entries = []
+    tagsets = []
+    for app in apps:
+        tags = list(app.tags.all())
+        tagsets.append(([i.softwareTag() for i in tags if not i.negative],
+                        [i.softwareTag() for i in tags if i.negative]))
+        entries.append(CatalogApp(
+            id=str(app.id),
+            appid=app.appid,
+            name=app.name,
+            briefDescription=app.briefDescription,
+            description=app.description,
+            category_id=app.category_id,
+            category=app.category.name,
+            vendor=app.vendor.name,
+            architecture=app.architecture,
+            version=app.version,
+            pkgformat=app.pkgformat,
+            tags_hash=app.tags_hash,
+            tagset=app.tagset_id,
+            tags=tuple(str(i.softwareTag()) for i in tags if not i.negative),
+            conflict_tags=tuple(str(i.softwareTag()) for i in tags if i.negative),
+            dateModified=app.dateModified,
+            file=app.file.name,
+            icon=(blobPath(app.icon_id) if app.icon_id else
+                  iconPath(app.appid, app.architecture, app.tags_hash)),
+            packageDigest=app.package_id,
+            iconDigest=app.icon_id))
+
+    snapshot = CatalogSnapshot(generation, timestamp, entries, tagsets, categories,
+                               dict(iconVariants))
+    snapshot.fromReplica = REPLICA in settings.DATABASES
+    return snapshot
+
+
+def catalogSnapshot():
+    """ Returns the catalog snapshot for the current generation, rebuilding it if needed """
+    global _snapshot
+    generation = currentGeneration()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.current(generation):
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshot
+        if snapshot is None or not snapshot.current(generation):
+            snapshot = buildSnapshot(generation)
+            _snapshot = snapshot
+    return snapshot
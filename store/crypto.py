@@ -0,0 +1,200 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Process-wide crypto context.
+#
+# Parsing the store PKCS#12 certificate and building the store of trusted developer CAs are by
+# far the most expensive parts of signing and verifying packages. Both are loaded once per
+# process and shared by all threads (the loaded objects are never modified afterwards). They
+# are reloaded automatically when any of the underlying files changes.
+
+import os
+import time
+import logging
+import threading
+
+from django.conf import settings
+from OpenSSL.crypto import load_pkcs12, FILETYPE_PEM, dump_privatekey, dump_certificate
+from M2Crypto import SMIME, BIO, X509, EVP
+
+logger = logging.getLogger(__name__)
+
+
+class SigningMaterial:
+    """ Private key, certificate and CA chain of a PKCS#12 signing certificate """
+
+    def __init__(self, signingCertificatePkcs12, signingCertificatePassword):
+        # M2Crypto has no support for PKCS#12, so we have to use pyopenssl here
+        # to load the .p12. Since the internal structures are incompatible, we
+        # have to export from pyopenssl and import to M2Crypto via PEM BIOs.
+        pkcs12 = load_pkcs12(signingCertificatePkcs12, signingCertificatePassword)
+        self.key = EVP.load_key_bio(BIO.MemoryBuffer(dump_privatekey(FILETYPE_PEM,
+                                                                     pkcs12.get_privatekey())))
+        self.certificate = X509.load_cert_bio(BIO.MemoryBuffer(
+            dump_certificate(FILETYPE_PEM, pkcs12.get_certificate())), X509.FORMAT_PEM)
+        self.caCertificates = []
+        for cert in pkcs12.get_ca_certificates() or []:
+            bio = BIO.MemoryBuffer(dump_certificate(FILETYPE_PEM, cert))
+            self.caCertificates.append(X509.load_cert_bio(bio, X509.FORMAT_PEM))
+
+    def sign(self, hash):
+        # see also in AM: src/crypto-lib/signature.cpp / Signature::create()
+
+        s = SMIME.SMIME()
+        s.pkey = self.key
+        s.x509 = self.certificate
+        caCerts = X509.X509_Stack()
+        for cert in self.caCertificates:
+            caCerts.push(cert)
+        s.set_x509_stack(caCerts)
+
+        signature = s.sign(BIO.MemoryBuffer(hash), SMIME.PKCS7_DETACHED + SMIME.PKCS7_BINARY)
+        bioSignature = BIO.MemoryBuffer()
+        signature.write(bioSignature)
+        return bioSignature.read_all()
+
+
+class TrustStore:
+    """ Store of trusted certificates, used to verify developer signatures """
+
+    def __init__(self, chainOfTrust):
+        self.store = X509.X509_Store()
+        for trustedCert in chainOfTrust:
+            bioCert = BIO.MemoryBuffer(data = trustedCert)
+
+            while len(bioCert):
+                cert = X509.load_cert_bio(bioCert, X509.FORMAT_PEM)
+                self.store.add_x509(cert)
+
+    def verify(self, signaturePkcs7, hash):
+        # see also in AM: src/crypto-lib/signature.cpp / Signature::verify()
+
+        s = SMIME.SMIME()
+
+        signature = SMIME.load_pkcs7_bio(BIO.MemoryBuffer(data = signaturePkcs7))
+        s.set_x509_store(self.store)
+        s.set_x509_stack(X509.X509_Stack())
+
+        s.verify(signature, BIO.MemoryBuffer(data = hash), SMIME.PKCS7_NOCHAIN)
+
+
+class Timings:
+    """ Thread-safe accumulator of operation counts and durations """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def add(self, operation, seconds):
+        with self.lock:
+            count, total, maximum = self.data.get(operation, (0, 0.0, 0.0))
+            self.data[operation] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def report(self):
+        with self.lock:
+            return {operation: {'count': count,
+                                'total': round(total, 6),
+                                'average': round(total / count, 6),
+                                'max': round(maximum, 6)}
+                    for operation, (count, total, maximum) in self.data.items()}
+
+
+timings = Timings()
+
+
+def filesKey(paths):
+    """ Identifies the current state of a list of files, raises OSError if one is missing """
+    key = []
+    for path in paths:
+        stat = os.stat(path)
+        key.append((path, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+class CachedContext:
+    """ Keeps an object loaded from files, until any of these files change """
+
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self.lock = threading.Lock()
+        self.key = None
+        self.value = None
+
+    def get(self, paths, *args):
+        key = (filesKey(paths), ) + args
+        if self.key == key:
+            return self.value
+        with self.lock:
+            if self.key != key:
+                start = time.perf_counter()
+                self.value = self.load(paths, *args)
+                self.key = key
+                elapsed = time.perf_counter() - start
+                timings.add('load ' + self.name, elapsed)
+                logger.info('loaded %s from %s in %.3fs', self.name, ', '.join(paths), elapsed)
+            return self.value
+
+
+def loadSigningMaterial(paths, password):
+    with open(paths[0], 'rb') as cert:
+        return SigningMaterial(cert.read(), password)
+
+
+def loadTrustStore(paths):
+    certificates = []
+    for certFile in paths:
+        with open(certFile, 'rb') as cert:
+            certificates.append(cert.read())
+    return TrustStore(certificates)
+
+
+signingContext = CachedContext('store signing certificate', loadSigningMaterial)
+verificationContext = CachedContext('developer CA certificates', loadTrustStore)
+
+
+def storeSignature(hash):
+    """ Signs hash with the store certificate (APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE) """
+    material = signingContext.get([settings.APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE],
+                                  settings.APPSTORE_STORE_SIGN_PKCS12_PASSWORD)
+    start = time.perf_counter()
+    signature = material.sign(hash)
+    timings.add('sign', time.perf_counter() - start)
+    return signature
+
+
+def verifyDeveloperSignature(signaturePkcs7, hash):
+    """ Verifies a signature against the APPSTORE_DEV_VERIFY_CA_CERTIFICATES """
+    store = verificationContext.get(list(settings.APPSTORE_DEV_VERIFY_CA_CERTIFICATES))
+    start = time.perf_counter()
+    store.verify(signaturePkcs7, hash)
+    timings.add('verify', time.perf_counter() - start)
@@ -0,0 +1,98 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+
+# Database connection setup.
+#
+# SQLite connections are switched to write-ahead logging, so that the many readers do not
+# block the writer of e.g. session rows (and vice versa), with a relaxed synchronous mode that
+# is still safe in WAL mode.
+#
+# With a PostgreSQL replica configured (APPSTORE_DB_REPLICA_HOST), the read queries building
+# the catalog snapshot are sent to the replica. All other queries stay on the default database,
+# so that requests always read their own writes.
+
+import threading
+import contextlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+REPLICA = 'replica'
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+_local = threading.local()
+
+
+@receiver(connection_created)
+def configureConnection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+
+    synchronous = settings.APPSTORE_DB_SQLITE_SYNCHRONOUS.upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ImproperlyConfigured('APPSTORE_DB_SQLITE_SYNCHRONOUS must be one of %s'
+                                   % ', '.join(SYNCHRONOUS_MODES))
+    with connection.cursor() as cursor:
+        if settings.APPSTORE_DB_SQLITE_WAL:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=%s' % synchronous)
+
+
+@contextlib.contextmanager
+def catalogReads():
+    """ Sends the read queries made within to the replica database, if there is one """
+    previous = getattr(_local, 'replica', False)
+    _local.replica = True
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+class CatalogReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if getattr(_local, 'replica', False) and REPLICA in settings.DATABASES:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same data as the default database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA
@@ -0,0 +1,113 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+
+# Device context of catalog requests.
+#
+# hello determines the architecture and the tags of a device, which select the apps offered to
+# it. They are normally kept in the session, which costs a database write for every device
+# boot and a read for every later request. With token=1, hello returns them in a signed token
+# instead, which the device passes in the token parameter (or the X-Device-Context header) of
+# the following requests: these then neither read nor write any session. Tokens are signed with
+# the SECRET_KEY and expire after SESSION_COOKIE_AGE seconds, just like sessions.
+
+import functools
+import collections
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import PermissionDenied
+
+from store.tags import SoftwareTagList
+from store.utilities import getRequestDictionary
+
+SALT = 'store.devicecontext'
+
+# architecture and tags are None, if hello was not called
+DeviceContext = collections.namedtuple('DeviceContext', ['architecture', 'tags'])
+
+
+def createDeviceToken(context):
+    return signing.dumps([context.architecture, context.tags], salt=SALT, compress=True)
+
+
+def storeDeviceContext(request, context):
+    """ Stores the device context in the session """
+    request.session['tag'] = context.tags
+    request.session['architecture'] = context.architecture
+
+
+def getDeviceContext(request):
+    """
+    Returns the DeviceContext of the request, from its token if there is one, otherwise from
+    the session. Raises PermissionDenied if the token is invalid or expired.
+    """
+    context = getattr(request, 'deviceContext', None)
+    if context is not None:
+        return context
+
+    token = getRequestDictionary(request).get('token') or request.META.get('HTTP_X_DEVICE_CONTEXT')
+    if token:
+        try:
+            architecture, tags = signing.loads(token, salt=SALT,
+                                               max_age=settings.SESSION_COOKIE_AGE)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise PermissionDenied('invalid device context token')
+        context = DeviceContext(architecture, tags)
+    else:
+        context = DeviceContext(request.session.get('architecture'), request.session.get('tag'))
+    request.deviceContext = context
+    return context
+
+
+def getDeviceArchitectures(request):
+    """ Returns the architectures of packages the device can install """
+    archlist = ['All', ]
+    architecture = getDeviceContext(request).architecture
+    if architecture is not None:
+        archlist.append(architecture)
+    return archlist
+
+
+@functools.lru_cache(maxsize=1024)
+def parseTags(tags):
+    tagList = SoftwareTagList()
+    tagList.parse(tags)
+    return tuple(tagList.list())
+
+
+def getDeviceTags(request):
+    """ Returns the tags stored by hello as a list of SoftwareTag, or None if there are none """
+    tags = getDeviceContext(request).tags
+    if tags is None:
+        return None
+    return list(parseTags(tags))
@@ -0,0 +1,158 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Cache of signed packages in the downloads directory.
+#
+# A package signed for a device only depends on the package contents, the device id and the
+# store signing certificate, so the download files are named after a hash of these and are
+# reused for repeated purchases. The access time of a download file is refreshed every time
+# it is handed out: it is used both for expiring downloads after APPSTORE_DOWNLOAD_EXPIRY
+# minutes and for evicting the least recently used files, once the size of the directory
+# exceeds APPSTORE_DOWNLOAD_CACHE_SIZE. The modification time is left alone, as it is part of
+# the validators of app/download, which must not change while a device resumes a download.
+
+import os
+import time
+import uuid
+import hashlib
+import threading
+
+from django.conf import settings
+
+from store.utilities import downloadPath
+
+TEMP_PREFIX = '.tmp-'
+
+# storeDownload() sweeps the downloads directory at most every SWEEP_INTERVAL seconds, unless
+# more than a tenth of APPSTORE_DOWNLOAD_CACHE_SIZE has been written since the last sweep
+SWEEP_INTERVAL = 60
+
+_sweepLock = threading.Lock()
+_lastSweep = 0.0
+_writtenSinceSweep = 0
+
+
+def downloadKey(packageDigest, deviceId, certificateDigest):
+    """ Returns the cache key for a package signed for one device with one certificate """
+    key = '\n'.join((packageDigest, deviceId, certificateDigest or 'unsigned'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def expiry():
+    return int(settings.APPSTORE_DOWNLOAD_EXPIRY) * 60
+
+
+def cachedDownload(name):
+    """
+    Returns True if the download file exists and has not expired yet. Its lifetime is then
+    extended, so that it stays available for another APPSTORE_DOWNLOAD_EXPIRY minutes.
+    """
+    path = downloadPath() + name
+    try:
+        stat = os.stat(path)
+        if time.time() - stat.st_atime >= expiry():
+            return False
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        return True
+    except OSError:
+        return False
+
+
+def storeDownload(name, writeFile):
+    """
+    Creates the download file by calling writeFile(path) with a temporary path in the
+    downloads directory, which is then atomically renamed, so that concurrent purchases of
+    the same package never see a partial file.
+    """
+    path = downloadPath()
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    tempPath = path + TEMP_PREFIX + uuid.uuid4().hex
+    try:
+        writeFile(tempPath)
+        size = os.path.getsize(tempPath)
+        os.replace(tempPath, path + name)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+    global _lastSweep, _writtenSinceSweep
+    budget = int(settings.APPSTORE_DOWNLOAD_CACHE_SIZE) * 1024 * 1024
+    with _sweepLock:
+        _writtenSinceSweep += size
+        now = time.time()
+        overBudget = budget > 0 and _writtenSinceSweep * 10 > budget
+        if now - _lastSweep < SWEEP_INTERVAL and not overBudget:
+            return
+        _lastSweep = now
+        _writtenSinceSweep = 0
+    expireDownloads(keep=name)
+
+
+def expireDownloads(keep=None):
+    """
+    Removes all expired download files, then the least recently used ones until the total size
+    is within APPSTORE_DOWNLOAD_CACHE_SIZE (if set). The file named keep is never removed, and
+    neither are the temporary files of downloads that are still being written.
+    Returns a list of (name, age in seconds) for the removed files.
+    """
+    path = downloadPath()
+    if not os.path.exists(path):
+        return []
+
+    now = time.time()
+    entries = []
+    for name in os.listdir(path):
+        try:
+            stat = os.stat(path + name)
+        except OSError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, name))
+    entries.sort()
+
+    removed = []
+    budget = int(settings.APPSTORE_DOWNLOAD_CACHE_SIZE) * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    for atime, size, name in entries:
+        age = now - atime
+        expired = age > expiry()
+        overBudget = budget > 0 and total > budget
+        if name == keep or name.startswith(TEMP_PREFIX) or not (expired or overBudget):
+            continue
+        try:
+            os.remove(path + name)
+        except OSError:
+            continue
+        total -= size
+        removed.append((name, int(age)))
+    return removed
@@ -0,0 +1,167 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Per-process cache of icon files.
+#
+# A catalog screen requests dozens of icons per device, so app/icons, app/icon and category/icon
+# serve them from a least recently used cache, limited to APPSTORE_ICON_CACHE_SIZE MiB per server
+# process. Icons in the blob store never change and are cached by digest. All other icon files
+# (category icons and icons of apps stored before the blob store existed) are rewritten in place,
+# possibly by another server process, so their entries are only used as long as inode, size and
+# modification time of the file are unchanged. Saving a category drops its icon right away.
+
+import os
+import errno
+import hashlib
+import datetime
+import threading
+import collections
+
+from django.conf import settings
+
+# larger files are not served as icons at all, so that no request can read them into memory
+MAX_ICON_SIZE = 4 * 1024 * 1024
+
+Icon = collections.namedtuple('Icon', ['data', 'etag', 'lastModified'])
+
+
+def fileKey(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class IconCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # path -> (file key, Icon)
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, path, digest=None):
+        """
+        Returns the Icon stored at path. digest is the blob digest for icons in the blob store,
+        which are not checked for changes. Raises OSError if the file cannot be read or is
+        larger than MAX_ICON_SIZE.
+        """
+        key = None if digest else fileKey(os.stat(path))
+        with self.lock:
+            icon = self.lookup(path, key)
+        if icon is None:
+            icon = self.load(path, digest)
+        return icon
+
+    def getMany(self, files):
+        """
+        Returns a dict of path -> Icon for a list of (path, digest) pairs, see get(). All cached
+        icons are looked up at once, files that cannot be read are left out.
+        """
+        keys = {}
+        for path, digest in files:
+            try:
+                keys[path] = None if digest else fileKey(os.stat(path))
+            except OSError:
+                pass
+
+        with self.lock:
+            icons = {path: self.lookup(path, key) for path, key in keys.items()}
+        for path, digest in files:
+            if path in icons and icons[path] is None:
+                try:
+                    icons[path] = self.load(path, digest)
+                except OSError:
+                    del icons[path]
+        return icons
+
+    def lookup(self, path, key):
+        # needs self.lock
+        cached = self.entries.get(path)
+        if cached is None or cached[0] != key:
+            self.stats['misses'] += 1
+            return None
+        self.entries.move_to_end(path)
+        self.stats['hits'] += 1
+        return cached[1]
+
+    def load(self, path, digest):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read(MAX_ICON_SIZE + 1)
+        if len(data) > MAX_ICON_SIZE:
+            raise OSError(errno.EFBIG, 'icon larger than %d bytes' % MAX_ICON_SIZE, path)
+        icon = Icon(data, digest or hashlib.sha256(data).hexdigest(),
+                    datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc))
+        # the key of the data actually read, the file may have changed since it was looked up
+        self.put(path, None if digest else fileKey(stat), icon)
+        return icon
+
+    def put(self, path, key, icon):
+        with self.lock:
+            self.remove(path)
+            if len(icon.data) > self.budget:
+                return
+            self.entries[path] = (key, icon)
+            self.size += len(icon.data)
+            while self.size > self.budget:
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def remove(self, path):
+        cached = self.entries.pop(path, None)
+        if cached is not None:
+            self.size -= len(cached[1].data)
+        return cached is not None
+
+    def invalidate(self, path):
+        with self.lock:
+            if self.remove(path):
+                self.stats['invalidations'] += 1
+
+    def metrics(self):
+        with self.lock:
+            requests = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        size=self.size,
+                        budget=self.budget,
+                        hitRate=round(self.stats['hits'] / requests, 3) if requests else 0.0)
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def iconCache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = IconCache(int(settings.APPSTORE_ICON_CACHE_SIZE) * 1024 * 1024)
+        return _cache
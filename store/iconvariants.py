@@ -0,0 +1,130 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Scaled down variants of app icons.
+#
+# Developers ship icons in whatever size they like, often much larger than a head unit shows
+# them. When an icon is stored, a copy scaled to each of the APPSTORE_ICON_SIZES (the maximum
+# width and height in pixels) is stored next to it in the blob store, re-encoded as an
+# optimized PNG. Clients pick one with the size parameter of the icon URLs, which maps to the
+# smallest variant at least as large as requested, so no icon is ever scaled while serving.
+# Like all blobs, identical icons and identical variants are only stored once.
+
+import io
+import os
+import logging
+
+from django.conf import settings
+from PIL import Image
+
+from store.blobs import storeBlob, ICON
+
+logger = logging.getLogger(__name__)
+
+
+def iconSizes():
+    return sorted(set(int(i) for i in str(settings.APPSTORE_ICON_SIZES).split(',') if i.strip()))
+
+
+def scaleIcon(data, size):
+    """ Returns the PNG icon data scaled to fit into size x size pixels """
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size), Image.LANCZOS)
+    result = io.BytesIO()
+    image.save(result, format='png', optimize=True)
+    return result.getvalue()
+
+
+def createIconVariants(icon, data):
+    """
+    Stores the missing variants of the icon Blob with the given data. Variants that would not
+    be smaller than the icon itself are not stored, the icon is served instead.
+    Returns the number of variants created.
+    """
+    from store.models import IconVariant
+
+    existing = set(icon.variants.values_list('size', flat=True))
+    created = 0
+    for size in iconSizes():
+        if size in existing:
+            continue
+        try:
+            variant = scaleIcon(data, size)
+        except (OSError, ValueError) as error:
+            logger.warning('could not scale icon %s: %s', icon.digest, error)
+            break
+        if len(variant) >= len(data):
+            continue
+        # another upload of the same icon may have created the variant meanwhile, the blob is
+        # only stored if it did not
+        _, new = IconVariant.objects.get_or_create(
+            icon=icon, size=size, defaults={'blob': lambda: storeBlob(ICON, variant)})
+        created += new
+    return created
+
+
+def storeIcon(data):
+    """ Stores the icon data as a Blob along with its variants, see storeBlob() """
+    icon = storeBlob(ICON, data)
+    createIconVariants(icon, data)
+    return icon
+
+
+def updateIconVariants():
+    """
+    Creates the missing variants of all app icons and drops the variants of sizes no longer
+    in APPSTORE_ICON_SIZES, e.g. after changing that setting. The files of dropped variants
+    are removed by the next collectGarbage(). Returns the number of created and dropped variants.
+    """
+    from store.models import Blob, IconVariant
+    import store.catalog
+
+    created = 0
+    for icon in Blob.objects.filter(iconApps__isnull=False).distinct():
+        with open(os.path.join(settings.MEDIA_ROOT, icon.path()), 'rb') as f:
+            created += createIconVariants(icon, f.read())
+    dropped, _ = IconVariant.objects.exclude(size__in=iconSizes()).delete()
+    if created or dropped:
+        store.catalog.catalogChanged()
+    return created, dropped
+
+
+def selectVariant(digest, variants, size):
+    """
+    Returns the digest of the smallest variant at least size pixels large, given the
+    (size, digest) pairs of the variants of the icon digest, sorted by size.
+    """
+    if size > 0:
+        for variantSize, variantDigest in variants:
+            if variantSize >= size:
+                return variantDigest
+    return digest
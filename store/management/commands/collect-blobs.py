@@ -0,0 +1,79 @@
+#############################################################################
+##
+## Copyright (C) 2019 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.models import App
+from store.blobs import collectGarbage, importLegacyFiles
+from store.iconvariants import updateIconVariants
+
+class Command(BaseCommand):
+    help = 'Removes package and icon blobs that are no longer referenced by any application, ' \
+           'as well as their signing bases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only list the files that would be removed')
+        parser.add_argument('--import-legacy', action='store_true',
+                            help='first move package and icon files stored before the blob '
+                                 'store existed into the store')
+        parser.add_argument('--icon-variants', action='store_true',
+                            help='first create missing icon variants and drop those of sizes '
+                                 'no longer in APPSTORE_ICON_SIZES')
+
+    def handle(self, *args, **options):
+        if options['import_legacy'] and not options['dry_run']:
+            self.stdout.write('Importing package and icon files into the blob store')
+            for app in App.objects.filter(package=None):
+                try:
+                    if importLegacyFiles(app):
+                        self.stdout.write(' -> %s (%s)' % (app.file.name, app.appid))
+                except OSError as error:
+                    raise CommandError('could not import %s: %s' % (app.appid, error))
+
+        if options['icon_variants'] and not options['dry_run']:
+            self.stdout.write('Updating icon variants')
+            try:
+                created, dropped = updateIconVariants()
+            except OSError as error:
+                raise CommandError('could not read icon: %s' % error)
+            self.stdout.write(' -> %d created, %d dropped' % (created, dropped))
+
+        self.stdout.write('Removing unreferenced blobs')
+
+        total = 0
+        for path, size in collectGarbage(dryRun=options['dry_run']):
+            total += size
+            self.stdout.write(' -> %s (%d bytes)' % (path, size))
+
+        self.stdout.write('Done, %d bytes %s' % (total, 'reclaimable' if options['dry_run']
+                                                 else 'reclaimed'))
@@ -30,28 +30,25 @@
 ##
 #############################################################################
 
-import os
-import time
+from django.core.management.base import BaseCommand
 
-from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
-
-from store.utilities import downloadPath
+from store.downloads import expireDownloads
+from store.uploadsessions import expireSessions
 
 class Command(BaseCommand):
-    help = 'Expires all downloads that are older than APPSTORE_DOWNLOAD_EXPIRY minutes'
+    help = 'Expires all downloads that are older than APPSTORE_DOWNLOAD_EXPIRY minutes, ' \
+           'and evicts the least recently used ones above APPSTORE_DOWNLOAD_CACHE_SIZE MiB, ' \
+           'as well as upload sessions idle for APPSTORE_UPLOAD_SESSION_EXPIRY minutes'
 
     def handle(self, *args, **options):
         self.stdout.write('Removing expired download packages')
-        pkgPath = downloadPath()
-        if not os.path.exists(pkgPath):
-            os.makedirs(pkgPath)
-
-        for pkg in os.listdir(pkgPath):
-            t = os.path.getmtime(pkgPath + pkg)
-            age = time.time() - t
-            if age > (int(settings.APPSTORE_DOWNLOAD_EXPIRY) * 60):
-               os.remove(pkgPath + pkg)
-               self.stdout.write(' -> %s (age: %s seconds)' % (pkg, int(age)))
+
+        for pkg, age in expireDownloads():
+            self.stdout.write(' -> %s (age: %s seconds)' % (pkg, age))
+
+        self.stdout.write('Removing abandoned upload sessions')
+
+        for session, age in expireSessions():
+            self.stdout.write(' -> %s (idle: %s seconds)' % (session, age))
 
         self.stdout.write('Done')
@@ -0,0 +1,73 @@
+#############################################################################
+##
+## Copyright (C) 2019 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.uploadjobs import claimJob, processJob, requeueStaleJobs
+
+class Command(BaseCommand):
+    help = 'Validates and stores the packages queued by asynchronous uploads ' \
+           '(APPSTORE_ASYNC_UPLOAD). Several workers can run in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='exit once the queue is empty, instead of waiting for jobs')
+        parser.add_argument('--poll', type=float, default=2.0,
+                            help='seconds to wait before checking an empty queue again')
+        parser.add_argument('--nice', type=int, default=10,
+                            help='scheduling priority increment, so that the server processes '
+                                 'answering devices are preferred (default: 10)')
+
+    def handle(self, *args, **options):
+        if options['nice']:
+            os.nice(options['nice'])
+
+        while True:
+            requeued = requeueStaleJobs()
+            if requeued:
+                self.stdout.write('Queued %d stale jobs again' % requeued)
+
+            job = claimJob()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+                continue
+
+            job = processJob(job)
+            self.stdout.write(' -> %s: %s %s(%.3fs)' % (job.id, job.state,
+                                                       job.error + ' ' if job.error else '',
+                                                       (job.dateFinished - job.dateStarted)
+                                                       .total_seconds()))
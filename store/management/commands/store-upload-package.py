@@ -30,16 +30,58 @@
 ##
 #############################################################################
 
-import argparse
+import os
+import csv
+import time
+import yaml
+import concurrent.futures
 
 from django.core.management.base import BaseCommand, CommandError
-from django.core.files.base import ContentFile
+from django.core.files import File
+from django.db import connections, transaction
 from store.models import Category, Vendor, savePackageFile
-from store.utilities import parseAndValidatePackageMetadata
+from store.utilities import parseAndValidatePackageMetadata, findPackages
+
+MANIFEST_FIELDS = ['package', 'vendor', 'category', 'description']
+
+
+def validatePackage(path):
+    """ Runs in the worker processes, returns (pkgdata, None) or (None, error) """
+    try:
+        with open(path, 'rb') as packagefile:
+            return parseAndValidatePackageMetadata(packagefile), None
+    except Exception as error:
+        return None, str(error)
+
+
+def readManifest(manifest):
+    """
+    Reads a CSV file (with a header line) or a YAML list of mappings, using the keys in
+    MANIFEST_FIELDS. Relative package paths are relative to the manifest.
+    """
+    with open(manifest, 'r', newline='') as f:
+        if manifest.endswith('.csv'):
+            entries = list(csv.DictReader(f))
+        else:
+            entries = yaml.safe_load(f) or []
+    if not isinstance(entries, list):
+        raise CommandError('manifest %s does not contain a list of packages' % manifest)
+
+    result = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('package'):
+            raise CommandError('manifest entry without a package: %s' % entry)
+        unknown = set(entry) - set(MANIFEST_FIELDS)
+        if unknown:
+            raise CommandError('unknown manifest fields: %s' % ', '.join(sorted(unknown)))
+        entry = {key: value for key, value in entry.items() if value}
+        entry['package'] = os.path.join(os.path.dirname(manifest), entry['package'])
+        result.append(entry)
+    return result
 
 
 class Command(BaseCommand):
-    help = 'Uploads a package to the deployment server. This can be used for batch uploading.'
+    help = 'Uploads packages to the deployment server. This can be used for batch uploading.'
 
     def add_arguments(self, parser):
         parser.add_argument('--vendor',
@@ -58,39 +100,104 @@ class Command(BaseCommand):
                             dest='description',
                             default="Empty description",
                             help='Short package description')
+        parser.add_argument('--manifest',
+                            action='store',
+                            type=str,
+                            dest='manifest',
+                            help='CSV or YAML file listing packages, with optional vendor, '
+                                 'category and description for each of them')
+        parser.add_argument('--jobs',
+                            action='store',
+                            type=int,
+                            dest='jobs',
+                            default=0,
+                            help='Number of packages to validate in parallel (default: number of CPUs)')
+        parser.add_argument('--batch-size',
+                            action='store',
+                            type=int,
+                            dest='batch_size',
+                            default=50,
+                            help='Number of packages to store per database transaction')
         parser.add_argument('package',
                             metavar='package',
-                            type=argparse.FileType('rb'),
-                            nargs=1,
-                            help='package file to upload')
+                            type=str,
+                            nargs='*',
+                            help='package files, directories or glob patterns to upload')
 
 
     def handle(self, *args, **options):
-        category = Category.objects.all().filter(name__exact=options['category'])
-        vendor = Vendor.objects.all().filter(name__exact=options['vendor'])
-        if not category:
-            raise CommandError('Non-existing category specified')
-        if not vendor:
-            raise CommandError('Non-existing vendor specified')
+        defaults = {'vendor': options['vendor'],
+                    'category': options['category'],
+                    'description': options['description']}
+        entries = []
+        if options['manifest']:
+            entries += readManifest(options['manifest'])
+        for pattern in options['package']:
+            packages = findPackages(pattern)
+            if not packages:
+                raise CommandError('No packages found for %s' % pattern)
+            entries += [{'package': i} for i in packages]
+        if not entries:
+            raise CommandError('No packages specified')
+        entries = [dict(defaults, **entry) for entry in entries]
 
-        try:
-            self.stdout.write('Parsing package %s' % options['package'][0].name)
-            packagefile = options['package'][0]
-            pkgdata = parseAndValidatePackageMetadata(packagefile)
-            self.stdout.write('  -> passed validation (internal name: %s)\n' % pkgdata['storeName'])
-        except Exception as error:
-            self.stdout.write('  -> failed: %s\n' % str(error))
-            return 0
+        categories = {}
+        vendors = {}
+        for entry in entries:
+            name = entry['category']
+            if name not in categories:
+                categories[name] = Category.objects.filter(name__exact=name).first()
+            if not categories[name]:
+                raise CommandError('Non-existing category specified: %s' % name)
+            name = entry['vendor']
+            if name not in vendors:
+                vendors[name] = Vendor.objects.filter(name__exact=name).first()
+            if not vendors[name]:
+                raise CommandError('Non-existing vendor specified: %s' % name)
 
-        packagefile.seek(0)
-        description = options['description']
-        try:
-            package_metadata = {'category': category[0],
-                                'vendor': vendor[0],
-                                'description': description,
-                                'short_description': description}
-            savePackageFile(pkgdata, ContentFile(packagefile.read()), package_metadata)
-        except Exception as error:
-            raise CommandError(error)
+        start = time.time()
+        failed = 0
+        totalSize = 0
+        # the worker processes do not need the database, do not share its connections
+        connections.close_all()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=options['jobs'] or None) as pool:
+            results = [pool.submit(validatePackage, entry['package']) for entry in entries]
+
+            batchSize = max(1, options['batch_size'])
+            for batch in range(0, len(entries), batchSize):
+                with transaction.atomic():
+                    for entry, result in zip(entries[batch:batch + batchSize],
+                                             results[batch:batch + batchSize]):
+                        if not self.storePackage(entry, result.result(), categories, vendors):
+                            failed += 1
+                        else:
+                            totalSize += os.path.getsize(entry['package'])
+
+        elapsed = max(time.time() - start, 0.001)
+        count = len(entries)
+        self.stdout.write('%d packages uploaded, %d failed in %.1fs (%.1f packages/s, %.1f MiB/s)\n'
+                          % (count - failed, failed, elapsed, count / elapsed,
+                             totalSize / elapsed / 1024 / 1024))
         return 0
 
+    def storePackage(self, entry, result, categories, vendors):
+        """ Stores one validated package, returns whether it succeeded """
+        self.stdout.write('Parsing package %s' % entry['package'])
+        pkgdata, error = result
+        if error:
+            self.stdout.write('  -> failed: %s\n' % error)
+            return False
+        self.stdout.write('  -> passed validation (internal name: %s)\n' % pkgdata['storeName'])
+
+        try:
+            package_metadata = {'category': categories[entry['category']],
+                                'vendor': vendors[entry['vendor']],
+                                'description': entry['description'],
+                                'short_description': entry['description']}
+            # a savepoint per package, so that one failure does not roll back the whole batch
+            with transaction.atomic(), open(entry['package'], 'rb') as packagefile:
+                savePackageFile(pkgdata, File(packagefile), package_metadata)
+        except Exception as error:
+            self.stdout.write('  -> failed to store: %s\n' % str(error))
+            return False
+        return True
@@ -30,32 +30,80 @@
 ##
 #############################################################################
 
-import argparse
+import json
+import time
+import concurrent.futures
 
 from django.core.management.base import BaseCommand, CommandError
 
-from store.utilities import parseAndValidatePackageMetadata
+from store.utilities import parseAndValidatePackageMetadata, makeTagList, findPackages
+
+
+def verifyPackage(path):
+    """ Runs in the worker processes, returns the report for one package """
+    report = {'package': path, 'status': 'ok', 'error': None}
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as package_file:
+            pkgdata = parseAndValidatePackageMetadata(package_file)
+        report.update({'id': pkgdata['info']['id'],
+                       'name': pkgdata['storeName'],
+                       'architecture': pkgdata['architecture'],
+                       'tags_hash': makeTagList(pkgdata)[2],
+                       'digest': pkgdata['digest'],
+                       'timings': pkgdata['timings']})
+    except Exception as error:
+        report.update({'status': 'failed', 'error': str(error)})
+    report.setdefault('timings', {})['validate'] = time.perf_counter() - start
+    return report
+
 
 class Command(BaseCommand):
     help = 'Checks if packages are valid for store upload'
 
     def add_arguments(self, parser):
+        parser.add_argument('--jobs',
+                            action='store',
+                            type=int,
+                            dest='jobs',
+                            default=0,
+                            help='Number of packages to verify in parallel (default: number of CPUs)')
+        parser.add_argument('--format',
+                            action='store',
+                            choices=['text', 'json', 'jsonl'],
+                            dest='format',
+                            default='text',
+                            help='Output format: text, a JSON list or one JSON object per line')
         parser.add_argument('package',
                             metavar='package',
-                            type=argparse.FileType('rb'),
-                            nargs=1,
-                            help='package file to verify')
+                            type=str,
+                            nargs='+',
+                            help='package files, directories or glob patterns to verify')
 
     def handle(self, *args, **options):
-        if not options["package"]:
-            raise CommandError('Usage: manage.py verify-upload-package <package>')
+        packages = []
+        for pattern in options['package']:
+            found = findPackages(pattern)
+            if not found:
+                raise CommandError('No packages found for %s' % pattern)
+            packages += found
 
-        try:
-            self.stdout.write('Parsing package %s' % options['package'][0].name)
-            package_file = options['package'][0]
-            pkgdata = parseAndValidatePackageMetadata(package_file)
+        reports = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=options['jobs'] or None) as pool:
+            for report in pool.map(verifyPackage, packages):
+                reports.append(report)
+                if options['format'] == 'jsonl':
+                    self.stdout.write(json.dumps(report))
+                elif options['format'] == 'text':
+                    self.stdout.write('Parsing package %s' % report['package'])
+                    if report['error']:
+                        self.stdout.write('  -> failed: %s\n' % report['error'])
+                    else:
+                        self.stdout.write('  -> passed validation (internal name: %s)\n' % report['name'])
 
-            self.stdout.write('  -> passed validation (internal name: %s)\n' % pkgdata['storeName'])
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(reports, indent=2))
 
-        except Exception as error:
-            self.stdout.write('  -> failed: %s\n' % str(error))
+        failed = len([i for i in reports if i['error']])
+        if failed:
+            raise CommandError('%d of %d packages failed validation' % (failed, len(reports)))
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_alter_category_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('package', 'Package'), ('icon', 'Icon')], max_length=10)),
+                ('size', models.BigIntegerField()),
+                ('dateAdded', models.DateTimeField(auto_now_add=True)),
+                ('dateUsed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='app',
+            name='icon',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='iconApps', to='store.blob'),
+        ),
+        migrations.AddField(
+            model_name='app',
+            name='package',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='packageApps', to='store.blob'),
+        ),
+    ]
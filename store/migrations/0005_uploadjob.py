@@ -0,0 +1,36 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0004_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('validating', 'Validating'), ('stored', 'Stored'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10)),
+                ('digest', models.CharField(blank=True, default='', max_length=64)),
+                ('briefDescription', models.TextField()),
+                ('description', models.TextField()),
+                ('appid', models.CharField(blank=True, default='', max_length=200)),
+                ('error', models.TextField(blank=True, default='')),
+                ('timings', models.JSONField(default=dict)),
+                ('dateQueued', models.DateTimeField(auto_now_add=True)),
+                ('dateStarted', models.DateTimeField(blank=True, null=True)),
+                ('dateFinished', models.DateTimeField(blank=True, null=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='store.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('vendor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='store.vendor')),
+            ],
+        ),
+    ]
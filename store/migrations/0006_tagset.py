@@ -0,0 +1,31 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_uploadjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagSet',
+            fields=[
+                ('fingerprint', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('tags', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='app',
+            name='tagset',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='store.tagset'),
+        ),
+        migrations.AlterField(
+            model_name='app',
+            name='architecture',
+            field=models.CharField(db_index=True, default='All', max_length=20),
+        ),
+    ]
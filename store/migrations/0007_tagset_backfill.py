@@ -0,0 +1,45 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:40
+
+import hashlib
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def backfillTagSets(apps, schema_editor):
+    """ Assigns the TagSet to all existing apps, in batches of BATCH_SIZE rows """
+    App = apps.get_model('store', 'App')
+    TagSet = apps.get_model('store', 'TagSet')
+    db = schema_editor.connection.alias
+
+    lastId = None
+    while True:
+        batch = App.objects.using(db).filter(tagset=None).order_by('id')
+        if lastId is not None:
+            batch = batch.filter(id__gt=lastId)
+        batch = list(batch.only('id', 'tags_hash')[:BATCH_SIZE])
+        if not batch:
+            break
+
+        tagsets = {}
+        for app in batch:
+            fingerprint = hashlib.sha256(app.tags_hash.encode('utf-8')).hexdigest()
+            tagsets[fingerprint] = app.tags_hash
+            app.tagset_id = fingerprint
+        TagSet.objects.using(db).bulk_create(
+            [TagSet(fingerprint=fingerprint, tags=tags) for fingerprint, tags in tagsets.items()],
+            ignore_conflicts=True)
+        App.objects.using(db).bulk_update(batch, ['tagset'])
+        lastId = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_tagset'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfillTagSets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_tagset_backfill'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='app',
+            name='tagset',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, to='store.tagset'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='app',
+            unique_together={('appid', 'architecture', 'tagset')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.0.6 on 2026-10-18 17:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_tagset_required'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IconVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.IntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='variantOf', to='store.blob')),
+                ('icon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='store.blob')),
+            ],
+            options={
+                'unique_together': {('icon', 'size')},
+            },
+        ),
+    ]
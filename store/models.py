@@ -34,13 +34,19 @@ import os
 import uuid
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
 from ordered_model.models import OrderedModel
 
-from store.utilities import packagePath, writeTempIcon, makeTagList
+from store.utilities import packagePath, makeTagList, tagSetFingerprint
 from store.tags import SoftwareTag
+from store.blobs import blobPath, blobDigest, storeBlob, PACKAGE, ICON
+import store.catalog
+import store.iconcache
+import store.iconvariants
 
 def category_file_name(instance, filename):
     # filename parameter is unused. See django documentation for details:
@@ -104,8 +110,56 @@ class Tag(models.Model):
             return negative + self.name + ":" + self.version
         return negative + self.name
 
+    def softwareTag(self):
+        if self.version:
+            return SoftwareTag(self.name + ":" + self.version)
+        return SoftwareTag(self.name)
+
+class Blob(models.Model):
+    """A package or icon file in the content-addressed store, see store/blobs.py"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    kind = models.CharField(max_length=10, choices=((PACKAGE, 'Package'), (ICON, 'Icon')))
+    size = models.BigIntegerField()
+    dateAdded = models.DateTimeField(auto_now_add=True)
+    dateUsed = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.kind + ' ' + self.digest
+
+    def path(self):
+        return blobPath(self.digest)
+
+    def references(self):
+        return self.packageApps.count() + self.iconApps.count()
+
+class IconVariant(models.Model):
+    """An icon scaled to fit into size x size pixels, see store/iconvariants.py"""
+    icon = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='variants')
+    size = models.IntegerField()
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='variantOf')
+
+    class Meta:
+        unique_together = (('icon', 'size'),)
+
+    def __str__(self):
+        return '%s (%dpx)' % (self.icon_id, self.size)
+
+class TagSet(models.Model):
+    """A distinct set of required and conflicting tags, shared by all apps with these tags"""
+    fingerprint = models.CharField(max_length=64, primary_key=True)
+    tags = models.TextField()   # the tags_hash of the apps
+
+    def __str__(self):
+        return self.tags
+
+    @staticmethod
+    def forTags(tags_hash):
+        tagset, _ = TagSet.objects.get_or_create(fingerprint=tagSetFingerprint(tags_hash),
+                                                 defaults={'tags': tags_hash})
+        return tagset
+
 def content_file_name(instance, filename):
-    return packagePath(instance.appid, instance.architecture, instance.tags_hash)
+    return packagePath(instance.appid, instance.architecture, instance.tagset_id)
 
 class App(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -121,13 +175,20 @@ class App(models.Model):
     tags = models.ManyToManyField(Tag)
     # Hash sum for sorted tag list, this is used to be able to distinguish different tag sets
     tags_hash = models.CharField(max_length=4096, default='')
-    architecture = models.CharField(max_length=20, default='All')
+    # Fixed-length identifier of the tag set, used instead of tags_hash for lookups
+    tagset = models.ForeignKey(TagSet, on_delete=models.PROTECT, editable=False)
+    architecture = models.CharField(max_length=20, default='All', db_index=True)
     version = models.CharField(max_length=20, default='0.0.0')
     pkgformat = models.IntegerField()
+    # Content-addressed package and icon, None for apps stored before the blob store existed
+    package = models.ForeignKey(Blob, null=True, blank=True, editable=False,
+                                on_delete=models.PROTECT, related_name='packageApps')
+    icon = models.ForeignKey(Blob, null=True, blank=True, editable=False,
+                             on_delete=models.PROTECT, related_name='iconApps')
 
     class Meta:
         """Makes the group of id and arch - a unique identifier"""
-        unique_together = (('appid', 'architecture', 'tags_hash'),)
+        unique_together = (('appid', 'architecture', 'tagset'),)
 
     def __unicode__(self):
         return self.name + " [" + " ".join([self.appid, self.version, self.architecture,
@@ -138,19 +199,74 @@ class App(models.Model):
         if not temp: #App with tags does not require anything
             return True
         for i in temp:
-            if not any(j.match(SoftwareTag(str(i))) for j in tagstring):
+            matching = any(j.match(i.softwareTag()) for j in tagstring)
+            if matching == i.negative: # required tag missing or conflicting tag present
                 return False
         return True
 
     def save(self, *args, **kwargs):
+        self.tagset = TagSet.forTags(self.tags_hash)
         try:
-            this = App.objects.get(appid=self.appid, architecture=self.architecture, tags_hash=self.tags_hash)
-            if this.file != self.file:
+            this = App.objects.get(appid=self.appid, architecture=self.architecture, tagset=self.tagset)
+            # blobs may be shared, unreferenced ones are removed by collect-blobs
+            if this.file != self.file and blobDigest(this.file.name) is None:
                 this.file.delete(save=False)
         except:
             pass
         super(App, self).save(*args, **kwargs)
 
+class UploadSession(models.Model):
+    """A resumable upload of a package in chunks, see store/uploadsessions.py"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # total size of the package, if announced when creating the session
+    size = models.BigIntegerField(null=True, blank=True)
+    dateCreated = models.DateTimeField(auto_now_add=True)
+    dateModified = models.DateTimeField(auto_now=True)
+
+class UploadJob(models.Model):
+    """An uploaded package waiting to be validated and stored, see store/uploadjobs.py"""
+    QUEUED = 'queued'
+    VALIDATING = 'validating'
+    STORED = 'stored'
+    FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    state = models.CharField(max_length=10, default=QUEUED, db_index=True,
+                             choices=((QUEUED, 'Queued'), (VALIDATING, 'Validating'),
+                                      (STORED, 'Stored'), (FAILED, 'Failed')))
+    # SHA-256 of the package, if it was computed during the upload
+    digest = models.CharField(max_length=64, blank=True, default='')
+    vendor = models.ForeignKey(Vendor, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    briefDescription = models.TextField()
+    description = models.TextField()
+    appid = models.CharField(max_length=200, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    timings = models.JSONField(default=dict)
+    dateQueued = models.DateTimeField(auto_now_add=True)
+    dateStarted = models.DateTimeField(null=True, blank=True)
+    dateFinished = models.DateTimeField(null=True, blank=True)
+
+@receiver(post_save, sender=App)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Vendor)
+@receiver(post_delete, sender=App)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Vendor)
+@receiver(m2m_changed, sender=App.tags.through)
+def catalogChanged(sender, **kwargs):
+    store.catalog.catalogChanged()
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def categoryIconChanged(sender, instance, **kwargs):
+    store.iconcache.iconCache().invalidate(os.path.join(settings.MEDIA_ROOT,
+                                                        category_file_name(instance, None)))
+
 def populateTagList(tags, conflict_tags):
     taglist = []
     for i in tags:
@@ -166,6 +282,7 @@ def populateTagList(tags, conflict_tags):
         tag, created = Tag.objects.get_or_create(name=i.tag, version=version, negative=True)
         if created:
             tag.save()
+        taglist.append(tag)
     return taglist
 
 
@@ -180,15 +297,15 @@ def savePackageFile(pkgdata, pkgfile, package_metadata):
     description = package_metadata['description']
     shortdescription = package_metadata['short_description']
 
-    success, error = writeTempIcon(appId, architecture, tags_hash, pkgdata['icon'])
-    if not success:
-        raise Exception(error)
+    # identical files are only stored once, re-uploading a package does not write anything
+    package = storeBlob(PACKAGE, pkgfile)
+    icon = store.iconvariants.storeIcon(pkgdata['icon'])
 
     exists = False
     app = None
     try:
         app = App.objects.get(appid__exact=appId, architecture__exact=architecture,
-                              tags_hash__exact=tags_hash)
+                              tagset_id__exact=tagSetFingerprint(tags_hash))
         exists = True
     except App.DoesNotExist:
         pass
@@ -205,7 +322,9 @@ def savePackageFile(pkgdata, pkgfile, package_metadata):
         app.briefDescription = shortdescription
         app.architecture = architecture
         app.pkgformat = pkgformat
-        app.file.save(packagePath(appId, architecture, tags_hash), pkgfile)
+        app.package = package
+        app.icon = icon
+        app.file = package.path()
         app.save()
     else:
         app, _ = App.objects.get_or_create(name=name, tags_hash=tags_hash,
@@ -213,7 +332,9 @@ def savePackageFile(pkgdata, pkgfile, package_metadata):
                                            briefDescription=shortdescription,
                                            description=description, pkgformat=pkgformat,
                                            architecture=architecture) #FIXME
-        app.file.save(packagePath(appId, architecture, tags_hash), pkgfile)
+        app.package = package
+        app.icon = icon
+        app.file = package.path()
         app.save()
 
     for i in taglist:
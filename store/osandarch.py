@@ -134,6 +134,131 @@ def getOsArch(string_data):
         return result
     return None
 
+# Decoding the binary headers directly is a lot faster than asking libmagic and parsing its
+# output. The names below are the ones libmagic uses, so that both ways end up with the same
+# architecture strings.
+
+ELF_MACHINES = {
+    2:   'SPARC',
+    3:   'Intel 80386',
+    8:   'MIPS',
+    18:  'SPARC32PLUS',
+    20:  'PowerPC or cisco 4500',
+    21:  '64-bit PowerPC or cisco 7500',
+    22:  'IBM S/390',
+    40:  'ARM',
+    42:  'Renesas SH',
+    43:  'SPARC V9',
+    62:  'x86-64',
+    183: 'ARM aarch64',
+    243: 'UCB RISC-V',
+}
+
+PE_MACHINES = {
+    0x014c: 'Intel 80386',
+    0x8664: 'x86-64',
+    0xaa64: 'Aarch64',
+}
+
+MACHO_CPUTYPES = {
+    0x01000007: 'x86_64',
+    0x0100000c: 'arm64',
+}
+
+# (cputype, cpusubtype) pairs that libmagic reports with their own names
+MACHO_SUBTYPES = {
+    (0x01000007, 8): 'x86_64_haswell',
+    (0x0100000c, 1): 'arm64v8',
+    (0x0100000c, 2): 'arm64e',
+}
+
+# number of bytes getOsArchFromHeader() needs to look at
+HEADER_SIZE = 1024
+
+
+class UnknownBinaryFormat(Exception):
+    """ The data is a binary, but its architecture can only be determined by libmagic """
+    pass
+
+
+def parseElfHeader(data):
+    if len(data) < 20 or data[4] not in (1, 2) or data[5] not in (1, 2):
+        raise UnknownBinaryFormat()
+    bits = '32' if data[4] == 1 else '64'
+    byteorder = 'little' if data[5] == 1 else 'big'
+    machine = ELF_MACHINES.get(int.from_bytes(data[18:20], byteorder))
+    if machine is None:
+        raise UnknownBinaryFormat()
+    arch = parseElfArch('', machine, bits)
+    return ['Linux', arch, byteorder + '_endian', bits]
+
+
+def parsePEHeader(data):
+    if len(data) < 0x40:
+        return None  # too short for a PE header
+    offset = int.from_bytes(data[0x3c:0x40], 'little')
+    header = data[offset:offset + 26]
+    if len(header) < 26:
+        if offset + 26 > HEADER_SIZE:
+            raise UnknownBinaryFormat()
+        return None  # a DOS executable
+    if header[:4] != b'PE\0\0':
+        return None
+    machine = PE_MACHINES.get(int.from_bytes(header[4:6], 'little'))
+    if machine is None or header[24:26] not in (b'\x0b\x01', b'\x0b\x02'):
+        raise UnknownBinaryFormat()
+    # this mimics parsePE32(), which only reports 64 bits for x86-64
+    arch = machine.split(' ')[-1]
+    bits = '64' if arch == 'x86-64' else '32'
+    if arch == '80386':
+        arch = 'i386'
+    return ['Windows', arch, 'little_endian', bits]
+
+
+def parseMachOHeader(data):
+    if len(data) < 12:
+        raise UnknownBinaryFormat()
+    cputype = int.from_bytes(data[4:8], 'little')
+    cpusubtype = int.from_bytes(data[8:12], 'little') & 0xffffff
+    arch = MACHO_SUBTYPES.get((cputype, cpusubtype), MACHO_CPUTYPES.get(cputype))
+    if arch is None:
+        raise UnknownBinaryFormat()
+    # parseMachO() always reports little endian
+    return ['macOS', arch, 'little_endian', '64']
+
+
+def getOsArchFromHeader(data):
+    """
+    Returns the same [os, arch, endianness, bits, fmt] list as getOsArch() would for the
+    libmagic description of a file, but looks only at the first HEADER_SIZE bytes of the
+    file's data. Returns None if the data is not an ELF, PE or Mach-O binary and raises
+    UnknownBinaryFormat for binaries that are not recognized here.
+    """
+    magic = data[:4]
+    if magic == b'\x7fELF':
+        fmt = 'elf'
+        result = parseElfHeader(data)
+    elif magic[:2] == b'MZ':
+        fmt = 'pe32'
+        result = parsePEHeader(data)
+    elif magic == b'\xcf\xfa\xed\xfe':
+        fmt = 'mach_o'
+        result = parseMachOHeader(data)
+    elif magic in (b'\xfe\xed\xfa\xcf', b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe'):
+        raise UnknownBinaryFormat()  # big endian or 32-bit Mach-O
+    elif magic == b'\xca\xfe\xba\xbe' and 0 < int.from_bytes(data[4:8], 'big') < 20:
+        # the same magic is used by Java class files, which have a version number here
+        raise Exception("Universal binaries are not supported in packages")
+    else:
+        return None
+
+    if result is None:
+        return None
+    result[1] = result[1].replace('-', '_')
+    result.append(fmt)
+    return result
+
+
 def normalizeArch(inputArch):
     """
     This function brings requested architecture to common form (currently just parses the bits
@@ -0,0 +1,247 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Asynchronous creation of download files.
+#
+# With APPSTORE_ASYNC_PURCHASE enabled, app/purchase does not sign packages in the request
+# thread. Instead a job is queued and signed by a pool of APPSTORE_SIGNING_WORKERS processes.
+# A dispatcher thread hands the queued jobs to the pool in order of priority (interactive
+# purchases before bulk provisioning), but never more jobs than there are workers, so that a
+# later interactive purchase can still overtake queued bulk jobs.
+#
+# The job id is the name of the download file, so that the status of a job can also be
+# answered by other server processes, once the file exists in the downloads directory.
+
+import os
+import time
+import queue
+import shutil
+import logging
+import itertools
+import threading
+import concurrent.futures
+import concurrent.futures.process
+
+from django.conf import settings
+
+from store.utilities import signingInfo, addSignatureToPackage
+from store.downloads import storeDownload
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {'interactive': 0, 'bulk': 1}
+
+
+class QueueFull(Exception):
+    pass
+
+
+def createDownload(fromFilePath, toFile, deviceId, sign, packageDigest=None):
+    """
+    Creates the download file toFile from the package fromFilePath, signed for deviceId if
+    sign is set. packageDigest is the digest of the package file, if known. Used both inline
+    and in the worker processes.
+    """
+    if sign:
+        def signPackage(toFilePath):
+            rawDigest, formatVersion = signingInfo(fromFilePath, packageDigest)
+            addSignatureToPackage(fromFilePath, toFilePath, rawDigest, deviceId, formatVersion,
+                                  packageDigest)
+        storeDownload(toFile, signPackage)
+    else:
+        try:
+            storeDownload(toFile, lambda toFilePath: shutil.copyfile(fromFilePath, toFilePath))
+        except IOError as error:
+            raise IOError(error.args[0], error.args[1], os.path.basename(fromFilePath))
+
+
+class Job:
+    def __init__(self, id, priority, args):
+        self.id = id
+        self.priority = priority
+        self.args = args
+        self.state = 'pending'
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+
+class SigningPool:
+    def __init__(self, workers, queueSize):
+        self.workers = workers
+        self.queueSize = queueSize
+        self.lock = threading.Lock()
+        self.queue = queue.PriorityQueue()
+        self.slots = threading.Semaphore(workers)
+        self.sequence = itertools.count()
+        self.jobs = {}
+        self.executor = None
+        self.dispatcher = None
+        self.stats = {'completed': 0, 'failed': 0, 'rejected': 0,
+                      'waitTotal': 0.0, 'waitMax': 0.0, 'runTotal': 0.0, 'runMax': 0.0}
+
+    def submit(self, id, priority, *args):
+        """ Queues a job, unless one with the same id is still pending. Returns the Job. """
+        with self.lock:
+            job = self.jobs.get(id)
+            if job is not None and job.state in ('pending', 'running'):
+                return job
+            if self.queue.qsize() >= self.queueSize:
+                self.stats['rejected'] += 1
+                raise QueueFull('too many pending purchases, please try again later')
+
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+                self.dispatcher = threading.Thread(target=self.dispatch, daemon=True,
+                                                   name='signing-dispatcher')
+                self.dispatcher.start()
+
+            job = Job(id, priority, args)
+            self.jobs[id] = job
+            self.queue.put((priority, next(self.sequence), job))
+            return job
+
+    def job(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def dispatch(self):
+        while True:
+            self.slots.acquire()
+            _, _, job = self.queue.get()
+            if job is None:
+                self.slots.release()
+                return
+
+            with self.lock:
+                job.state = 'running'
+                job.started = time.time()
+                executor = self.executor
+            try:
+                future = executor.submit(createDownload, *job.args)
+            except Exception as error:
+                if isinstance(error, concurrent.futures.process.BrokenProcessPool):
+                    self.replaceExecutor(executor)
+                self.finish(job, error)
+                continue
+            future.add_done_callback(lambda future, job=job, executor=executor:
+                                     self.done(job, executor, future.exception()))
+
+    def done(self, job, executor, error):
+        # a worker died (e.g. killed when running out of memory), which breaks the whole pool
+        if isinstance(error, concurrent.futures.process.BrokenProcessPool):
+            self.replaceExecutor(executor)
+        self.finish(job, error)
+
+    def replaceExecutor(self, broken):
+        """ Replaces the executor with a new one, unless that already happened """
+        with self.lock:
+            if self.executor is not broken or broken is None:
+                return
+            logger.error('signing worker died, restarting the worker processes')
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        broken.shutdown(wait=False)
+
+    def finish(self, job, error):
+        self.slots.release()
+        with self.lock:
+            job.finished = time.time()
+            job.state = 'failed' if error else 'done'
+            job.error = str(error) if error else None
+            self.stats['failed' if error else 'completed'] += 1
+            wait = job.started - job.queued
+            run = job.finished - job.started
+            self.stats['waitTotal'] += wait
+            self.stats['waitMax'] = max(self.stats['waitMax'], wait)
+            self.stats['runTotal'] += run
+            self.stats['runMax'] = max(self.stats['runMax'], run)
+
+            # forget finished jobs after the download expiry, the download file is the result
+            expired = job.finished - int(settings.APPSTORE_DOWNLOAD_EXPIRY) * 60
+            for id in [i.id for i in self.jobs.values() if i.finished and i.finished < expired]:
+                del self.jobs[id]
+        if error:
+            logger.error('signing %s failed: %s', job.id, error)
+
+    def metrics(self):
+        with self.lock:
+            now = time.time()
+            pending = [i for i in self.jobs.values() if i.state == 'pending']
+            finished = self.stats['completed'] + self.stats['failed']
+            return {
+                'workers': self.workers,
+                'queueSize': self.queueSize,
+                'queued': len(pending),
+                'queuedByPriority': {name: sum(1 for i in pending if i.priority == priority)
+                                     for name, priority in PRIORITIES.items()},
+                'running': sum(1 for i in self.jobs.values() if i.state == 'running'),
+                'completed': self.stats['completed'],
+                'failed': self.stats['failed'],
+                'rejected': self.stats['rejected'],
+                'oldestWait': round(max([now - i.queued for i in pending], default=0.0), 3),
+                'averageWait': round(self.stats['waitTotal'] / finished, 3) if finished else 0.0,
+                'maxWait': round(self.stats['waitMax'], 3),
+                'averageRun': round(self.stats['runTotal'] / finished, 3) if finished else 0.0,
+                'maxRun': round(self.stats['runMax'], 3),
+            }
+
+    def shutdown(self):
+        with self.lock:
+            executor, dispatcher = self.executor, self.dispatcher
+            self.executor = self.dispatcher = None
+        if dispatcher is not None:
+            self.queue.put((len(PRIORITIES), next(self.sequence), None))
+            dispatcher.join()
+            executor.shutdown(wait=True)
+
+
+_lock = threading.Lock()
+_pool = None
+
+
+def signingPool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = SigningPool(int(settings.APPSTORE_SIGNING_WORKERS) or os.cpu_count() or 1,
+                                int(settings.APPSTORE_SIGNING_QUEUE_SIZE))
+        return _pool
+
+
+def shutdownSigningPool():
+    """ Waits for all queued jobs, then stops the workers """
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
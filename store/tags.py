@@ -35,6 +35,8 @@ import hashlib
 import unittest
 import re
 
+import numpy
+
 
 def validateTagVersion(version):
     """
@@ -152,7 +154,8 @@ class SoftwareTagList:
         if tag.has_version():
             if tag.tag in self.taglist:
                 # Tag in list - need to check version
-                if self.has_version(tag.tag) and not any(tag.match(i) for i in self.taglist[tag.tag]):
+                if self.has_version(tag.tag) and \
+                        not any(tag.match(i) for i in self.taglist[tag.tag]):
                     self.taglist[tag.tag].append(tag)
                     self.taglist[tag.tag].sort()  # this is slow, I guess
             else:
@@ -178,6 +181,75 @@ class SoftwareTagList:
         return hashlib.md5(str(self)).hexdigest()
 
 
+class SoftwareTagMatcher:
+    """
+    Matches one device tag list against many tag sets (e.g. all app variants) at once.
+
+    Every distinct (tag, version) pair used by the tag sets is interned into a bit index, and
+    the required and conflicting tags of each tag set are stored as packed 64-bit masks (one
+    array per 64 interned tags, so that every operation runs over contiguous memory). A device
+    tag satisfies a tag set entry when it matches it in the SoftwareTag.match() sense, i.e.
+    for the same name the entry has no version, the same version, or a version
+    which is a dot-separated prefix of the device tag version. So the device list can be turned
+    into a single mask by looking up every such prefix, and all rows are evaluated with a
+    couple of vectorized operations.
+    """
+
+    def __init__(self, tagsets):
+        """
+        :param tagsets: list of (required, conflicts) pairs, each a list of SoftwareTag
+        """
+        self.bits = dict()
+        for required, conflicts in tagsets:
+            for tag in list(required) + list(conflicts):
+                self.bits.setdefault((tag.tag, tag.version), len(self.bits))
+
+        self.words = max(1, (len(self.bits) + 63) // 64)
+        self.required = self._packRows([required for required, _ in tagsets])
+        self.conflicts = self._packRows([conflicts for _, conflicts in tagsets])
+
+    def __len__(self):
+        return self.required.shape[1]
+
+    def _packRows(self, taglists):
+        data = bytearray()
+        for taglist in taglists:
+            mask = 0
+            for tag in taglist:
+                mask |= 1 << self.bits[(tag.tag, tag.version)]
+            data += mask.to_bytes(self.words * 8, 'little')
+        rows = numpy.frombuffer(bytes(data), dtype='<u8').reshape((len(taglists), self.words))
+        return numpy.ascontiguousarray(rows.T)
+
+    def deviceMask(self, tags):
+        """ Returns the packed mask of all interned tags that are satisfied by the device tags """
+        mask = 0
+        for tag in tags:
+            keys = [(tag.tag, None)]
+            if tag.version is not None:
+                keys += [(tag.tag, tag.version[:i]) for i, c in enumerate(tag.version) if c == '.']
+                keys.append((tag.tag, tag.version))
+            for key in keys:
+                bit = self.bits.get(key)
+                if bit is not None:
+                    mask |= 1 << bit
+        return numpy.frombuffer(mask.to_bytes(self.words * 8, 'little'), dtype='<u8')
+
+    def match(self, tags):
+        """
+        Returns a boolean array with one entry per tag set, which is True when all required
+        tags are satisfied by the device tags and none of the conflicting tags are.
+        :param tags: list of SoftwareTag, as sent by the device
+        """
+        mask = self.deviceMask(tags)
+        rejected = numpy.zeros(len(self), dtype=bool)
+        for word in range(self.words):
+            rejected |= (self.required[word] & ~mask[word]) != 0
+            if mask[word]:
+                rejected |= (self.conflicts[word] & mask[word]) != 0
+        return ~rejected
+
+
 class TestSoftwareTagMethods(unittest.TestCase):
     def test_tag_creation(self):
         tag = SoftwareTag('qt')
@@ -277,5 +349,50 @@ class TestSoftwareTagListMethods(unittest.TestCase):
         self.assertNotEqual(lst1.hash(), lst2.hash())
 
 
+class TestSoftwareTagMatcherMethods(unittest.TestCase):
+    def tags(self, tag_string):
+        return [SoftwareTag(i) for i in tag_string.split(',') if i]
+
+    def test_empty(self):
+        matcher = SoftwareTagMatcher([])
+        self.assertEqual(len(matcher), 0)
+        self.assertEqual(list(matcher.match(self.tags('qt'))), [])
+
+    def test_required_tags(self):
+        matcher = SoftwareTagMatcher([(self.tags(''), []),
+                                      (self.tags('qt'), []),
+                                      (self.tags('qt:5.1'), []),
+                                      (self.tags('qt:5.1,neptune'), [])])
+        self.assertEqual(list(matcher.match(self.tags(''))), [True, False, False, False])
+        self.assertEqual(list(matcher.match(self.tags('qt'))), [True, True, False, False])
+        self.assertEqual(list(matcher.match(self.tags('qt:5'))), [True, True, False, False])
+        self.assertEqual(list(matcher.match(self.tags('qt:5.1'))), [True, True, True, False])
+        self.assertEqual(list(matcher.match(self.tags('qt:5.12'))), [True, True, False, False])
+        self.assertEqual(list(matcher.match(self.tags('qt:5.1.2,neptune:3'))),
+                         [True, True, True, True])
+
+    def test_conflict_tags(self):
+        matcher = SoftwareTagMatcher([(self.tags('qt'), self.tags('neptune')),
+                                      ([], self.tags('neptune:5.1'))])
+        self.assertEqual(list(matcher.match(self.tags('qt'))), [True, True])
+        self.assertEqual(list(matcher.match(self.tags('qt,neptune'))), [False, True])
+        self.assertEqual(list(matcher.match(self.tags('qt,neptune:5.1.1'))), [False, False])
+        self.assertEqual(list(matcher.match(self.tags('qt,neptune:5.2'))), [False, True])
+
+    def test_same_as_tag_match(self):
+        server = self.tags('qt,qt:5,qt:5.1,qt:5.1.1,qt:5.11,neptune:1')
+        device = self.tags('qt,qt:5,qt:5.1,qt:5.1.1,qt:5.1.1.7,qt:5.11,qt:6,neptune')
+        matcher = SoftwareTagMatcher([([i], []) for i in server])
+        for j in device:
+            self.assertEqual(list(matcher.match([j])), [j.match(i) for i in server])
+
+    def test_many_tags(self):
+        server = [SoftwareTag('tag%d' % i) for i in range(150)]
+        matcher = SoftwareTagMatcher([([i], [server[-1 - n]]) for n, i in enumerate(server)])
+        # first 50 are missing their required tag, next 50 conflict with the device tags
+        result = matcher.match(server[50:])
+        self.assertEqual(list(result), [False] * 100 + [True] * 50)
+
+
 if __name__ == '__main__':
     unittest.main()
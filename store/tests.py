@@ -0,0 +1,1563 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+import io
+import os
+import sys
+import hmac
+import json
+import time
+import yaml
+import shutil
+import hashlib
+import tarfile
+import datetime
+import tempfile
+import unittest
+import unittest.mock
+import tracemalloc
+import threading
+import multiprocessing
+import fcntl
+import gzip
+import struct
+import collections
+import base64
+
+import PIL.Image
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+import django.core.cache
+import django.contrib.auth.base_user
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.conf import settings
+from django.db import connections
+
+from store.models import App, Category, Vendor, Tag, TagSet, Blob, IconVariant, UploadSession, \
+    UploadJob
+import store.catalog
+import store.downloads
+import store.crypto
+import store.signing
+import store.osandarch
+import store.utilities
+import store.uploadhandlers
+import store.blobs
+import store.uploadsessions
+import store.uploadjobs
+import store.database
+import store.iconcache
+import store.iconvariants
+from store.utilities import addSignatureToPackage, verifySignature, parsePackageMetadata, \
+    getOsArchWithMagic
+
+
+def createIcon(size=256):
+    """ Returns a PNG image of size x size pixels, which can be scaled down """
+    image = PIL.Image.linear_gradient('L').resize((size, size)).convert('RGB')
+    data = io.BytesIO()
+    image.save(data, format='png')
+    return data.getvalue()
+
+
+ICON = createIcon()
+
+
+def createCategory(name):
+    category = Category(name=name)
+    category.save()
+    return category
+
+
+def createApp(appid, category, vendor, tags=(), conflicts=(), architecture='All'):
+    tags_hash = ','.join(tags) + ','.join(conflicts)
+    app = App.objects.create(appid=appid, name=appid, vendor=vendor, category=category,
+                             briefDescription='brief', description='description',
+                             file='packages/' + appid, tags_hash=tags_hash,
+                             architecture=architecture, pkgformat=2)
+    for negative, taglist in ((False, tags), (True, conflicts)):
+        for i in taglist:
+            name, _, version = i.partition(':')
+            tag, _ = Tag.objects.get_or_create(name=name, version=version, negative=negative)
+            app.tags.add(tag)
+    return app
+
+
+def createCertificate(directory, password='password'):
+    """ Creates a self-signed store certificate, returns paths to the .p12 and .crt files """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Test Store')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+        .sign(key, hashes.SHA256())
+
+    p12Path = os.path.join(directory, 'store.p12')
+    with open(p12Path, 'wb') as f:
+        f.write(pkcs12.serialize_key_and_certificates(
+            b'store', key, cert, None,
+            serialization.BestAvailableEncryption(password.encode('utf-8'))))
+    crtPath = os.path.join(directory, 'store.crt')
+    with open(crtPath, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return p12Path, crtPath
+
+
+def createElfHeader(bits, byteorder, machine):
+    order = '<' if byteorder == 'little' else '>'
+    ident = b'\x7fELF' + bytes([bits // 32, 1 if byteorder == 'little' else 2, 1]) + bytes(9)
+    if bits == 64:
+        header = struct.pack(order + 'HHIQQQIHHHHHH', 2, machine, 1, 0x400000, 64, 0, 0, 64, 56, 0, 64, 0, 0)
+    else:
+        header = struct.pack(order + 'HHIIIIIHHHHHH', 2, machine, 1, 0x8000, 52, 0, 0, 52, 32, 0, 40, 0, 0)
+    return ident + header + bytes(200)
+
+
+def createPEHeader(machine, optionalMagic):
+    dos = b'MZ' + bytes(0x3a) + struct.pack('<I', 0x80) + bytes(0x40)
+    coff = b'PE\0\0' + struct.pack('<HHIIIHH', machine, 1, 0, 0, 0, 0xf0, 0x22)
+    optional = struct.pack('<H', optionalMagic) + bytes(66) + struct.pack('<H', 3) + bytes(170)
+    return dos + coff + optional + bytes(200)
+
+
+def createMachOHeader(cputype, cpusubtype):
+    return struct.pack('<IIIIIIII', 0xfeedfacf, cputype, cpusubtype, 6, 0, 0, 0x85, 0) + bytes(200)
+
+
+def createPackage(path, files):
+    """ Writes a tar.gz with the given (name, contents) entries """
+    with tarfile.open(path, mode='w:gz') as pkg:
+        for name, contents in files:
+            entry = tarfile.TarInfo(name)
+            entry.size = len(contents)
+            pkg.addfile(entry, io.BytesIO(contents))
+
+
+def createValidPackage(path, appId, files=(), extra=None):
+    """ Writes a package that passes parseAndValidatePackageMetadata (without security) """
+    header = {'packageId': appId, 'diskSpaceUsed': 1}
+    if extra is not None:
+        header['extra'] = extra
+    header = yaml.dump_all([{'formatVersion': 2, 'formatType': 'am-package-header'}, header])
+    info = yaml.dump_all([{'formatVersion': 1, 'formatType': 'am-package'},
+                          {'id': appId, 'name': {'en': appId}, 'icon': 'icon.png',
+                           'applications': []}])
+    files = [('info.yaml', info.encode()), ('icon.png', ICON)] + list(files)
+    digest = hashlib.sha256()
+    for name, contents in files:
+        digest.update(contents + b'F/%d/' % len(contents) + name.encode('utf-8'))
+    footer = yaml.dump_all([{'formatVersion': 2, 'formatType': 'am-package-footer'},
+                            {'digest': digest.hexdigest()}])
+    createPackage(path, [('--PACKAGE-HEADER--', header.encode())] + files +
+                  [('--PACKAGE-FOOTER--', footer.encode())])
+
+
+class TempMediaRootMixin:
+    """ Runs each test with MEDIA_ROOT set to a new temporary directory, self.mediaRoot """
+
+    def setUp(self):
+        super().setUp()
+        self.mediaRoot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mediaRoot)
+        mediaRoot = override_settings(MEDIA_ROOT=self.mediaRoot)
+        mediaRoot.enable()
+        self.addCleanup(mediaRoot.disable)
+
+
+class AppListTest(TestCase):
+    def setUp(self):
+        store.catalog.invalidate()
+        user = User.objects.create(username='vendor')
+        self.vendor = Vendor.objects.create(user=user, name='Vendor', certificate='')
+        self.categories = [createCategory('Category %d' % i) for i in range(3)]
+
+    def populate(self, first, last):
+        for i in range(first, last):
+            createApp('com.example.app%d' % i, self.categories[i % 3], self.vendor,
+                      tags=('qt:5.%d' % (i % 2),))
+
+    def hello(self):
+        self.client.get('/hello', {'platform': 'NEPTUNE3', 'version': '2', 'tag': 'qt:5.1'})
+
+    def test_app_list_fields(self):
+        createApp('com.example.app', self.categories[0], self.vendor,
+                  tags=('qt:5.1',), conflicts=('neptune',))
+        apps = self.client.get('/app/list').json()
+        self.assertEqual(len(apps), 1)
+        self.assertEqual(apps[0]['id'], 'com.example.app')
+        self.assertEqual(apps[0]['category'], 'Category 0')
+        self.assertEqual(apps[0]['vendor'], 'Vendor')
+        self.assertEqual(apps[0]['tags'], ['qt:5.1'])
+        self.assertEqual(apps[0]['conflict_tags'], ['neptune'])
+
+    def test_app_list_tag_matching(self):
+        createApp('com.example.plain', self.categories[0], self.vendor)
+        createApp('com.example.qt', self.categories[0], self.vendor, tags=('qt:5',))
+        createApp('com.example.qt6', self.categories[0], self.vendor, tags=('qt:6',))
+        createApp('com.example.noneptune', self.categories[0], self.vendor, conflicts=('neptune',))
+        self.client.get('/hello', {'tag': 'qt:5.15,neptune:3'})
+        apps = self.client.get('/app/list').json()
+        self.assertEqual([app['id'] for app in apps], ['com.example.plain', 'com.example.qt'])
+
+        self.client.get('/hello', {'tag': 'qt:6.2'})
+        apps = self.client.get('/app/list').json()
+        self.assertEqual([app['id'] for app in apps],
+                         ['com.example.noneptune', 'com.example.plain', 'com.example.qt6'])
+
+    def test_app_list_query_count_is_constant(self):
+        self.hello()
+        self.populate(0, 2)
+        with self.assertNumQueries(5):  # session, apps with category and vendor, tags, categories,
+                                        # icon variants
+            apps = self.client.get('/app/list').json()
+        self.assertEqual(len(apps), 1)
+
+        self.populate(2, 50)
+        with self.assertNumQueries(5):
+            apps = self.client.get('/app/list').json()
+        self.assertEqual(len(apps), 25)
+
+    def test_app_list_served_from_snapshot(self):
+        self.hello()
+        self.populate(0, 10)
+        self.client.get('/app/list')
+        with self.assertNumQueries(1):  # session only
+            apps = self.client.get('/app/list', {'category_id': self.categories[1].id}).json()
+        self.assertEqual([app['id'] for app in apps], ['com.example.app1', 'com.example.app7'])
+
+        App.objects.filter(appid='com.example.app7').get().delete()
+        apps = self.client.get('/app/list', {'category_id': self.categories[1].id}).json()
+        self.assertEqual([app['id'] for app in apps], ['com.example.app1'])
+
+    def test_device_context_token(self):
+        self.populate(0, 4)
+        createApp('com.example.native', self.categories[0], self.vendor,
+                  architecture='arm-little_endian-64-elf')
+        response = self.client.get('/hello', {'platform': 'NEPTUNE3', 'version': '2',
+                                              'tag': 'qt:5.1',
+                                              'architecture': 'arm-little_endian-64-linux',
+                                              'token': '1'}).json()
+        self.assertEqual(response['status'], 'ok')
+        self.assertFalse(Session.objects.exists())
+
+        self.client.get('/app/list')
+        # neither the session nor the tags have to be looked up
+        with self.assertNumQueries(0):
+            apps = self.client.get('/app/list', {'token': response['token']}).json()
+        self.assertEqual([app['id'] for app in apps],
+                         ['com.example.app1', 'com.example.app3', 'com.example.native'])
+        apps = self.client.get('/app/list', HTTP_X_DEVICE_CONTEXT=response['token']).json()
+        self.assertEqual(len(apps), 3)
+        self.assertFalse(Session.objects.exists())
+
+        self.assertEqual(self.client.get('/app/list', {'token': 'forged'}).status_code, 403)
+
+
+class CatalogGenerationTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        store.catalog.invalidate()
+
+    def runProcesses(self, count, target):
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=target) for _ in range(count)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+    def test_changed_by_other_process(self):
+        snapshot = store.catalog.catalogSnapshot()
+        self.assertIs(store.catalog.catalogSnapshot(), snapshot)
+
+        self.runProcesses(1, store.catalog.bumpGeneration)
+        self.assertIsNot(store.catalog.catalogSnapshot(), snapshot)
+
+    def test_concurrent_changes(self):
+        def bump():
+            for _ in range(20):
+                store.catalog.bumpGeneration()
+
+        self.runProcesses(4, bump)
+        self.assertEqual(store.catalog.currentGeneration(), 80)
+
+
+class ConditionalRequestTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        store.catalog.invalidate()
+
+        user = User.objects.create(username='vendor')
+        self.vendor = Vendor.objects.create(user=user, name='Vendor', certificate='')
+        self.category = createCategory('Category')
+        createApp('com.example.app', self.category, self.vendor, tags=('qt',))
+
+    def assertNotModified(self, url, params={}):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'])
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        return response['ETag']
+
+    def test_app_list(self):
+        self.client.get('/hello', {'tag': 'qt'})
+        etag = self.assertNotModified('/app/list')
+
+        # different device context
+        self.client.get('/hello', {'tag': 'neptune'})
+        response = self.client.get('/app/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+        # catalog changed
+        self.client.get('/hello', {'tag': 'qt'})
+        createApp('com.example.other', self.category, self.vendor)
+        response = self.client.get('/app/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_category_list(self):
+        etag = self.assertNotModified('/category/list')
+        createCategory('Other')
+        response = self.client.get('/category/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_icons(self):
+        os.makedirs(os.path.join(self.mediaRoot, 'icons'))
+        for name in ('com.example.app_All_qt.png', 'category_%d.png' % self.category.id):
+            with open(os.path.join(self.mediaRoot, 'icons', name), 'wb') as icon:
+                icon.write(b'png data')
+
+        etag = self.assertNotModified('/app/icons/com.example.app_All_qt')
+        self.assertNotModified('/category/icon', {'id': self.category.id})
+
+        with open(os.path.join(self.mediaRoot, 'icons', 'com.example.app_All_qt.png'), 'wb') as icon:
+            icon.write(b'other png data')
+        response = self.client.get('/app/icons/com.example.app_All_qt', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'other png data')
+
+
+class IconCacheTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = store.iconcache.IconCache(1024)
+        patcher = unittest.mock.patch('store.iconcache._cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create(username='vendor')
+        self.vendor = Vendor.objects.create(user=user, name='Vendor', certificate='')
+        self.category = createCategory('Category')
+        createApp('com.example.app', self.category, self.vendor, tags=('qt',))
+        os.makedirs(os.path.join(self.mediaRoot, 'icons'))
+
+    def writeIcon(self, name, data):
+        path = os.path.join(self.mediaRoot, 'icons', name)
+        with open(path, 'wb') as icon:
+            icon.write(data)
+        return path
+
+    def test_lru(self):
+        paths = [self.writeIcon('%d.png' % i, bytes([i]) * 400) for i in range(3)]
+        for path in paths[:2]:
+            self.assertEqual(self.cache.get(path).data[:1], bytes([paths.index(path)]))
+        self.cache.get(paths[0])
+        # the third icon exceeds the budget, the least recently used one is evicted
+        self.cache.get(paths[2])
+        self.assertEqual(list(self.cache.entries), [paths[0], paths[2]])
+        self.assertEqual(self.cache.size, 800)
+
+        large = self.writeIcon('large.png', b'x' * 2048)
+        self.assertEqual(len(self.cache.get(large).data), 2048)
+        self.assertNotIn(large, self.cache.entries)
+
+        metrics = self.cache.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses'], metrics['evictions']), (1, 4, 1))
+
+        # rewritten files are read again
+        self.writeIcon('0.png', b'new')
+        self.assertEqual(self.cache.get(paths[0]).data, b'new')
+        os.remove(paths[0])
+        self.assertRaises(OSError, self.cache.get, paths[0])
+
+        with unittest.mock.patch('store.iconcache.MAX_ICON_SIZE', 1024):
+            self.assertRaises(OSError, self.cache.get, large)
+            self.assertEqual(self.cache.getMany([(large, None), (paths[1], None)]).keys(),
+                             {paths[1]})
+
+    def test_views(self):
+        self.writeIcon('com.example.app_All_qt.png', b'app icon')
+        self.writeIcon('category_%d.png' % self.category.id, b'category icon')
+
+        for i in range(5):
+            response = self.client.get('/app/icons/com.example.app_All_qt')
+            self.assertEqual(response.content, b'app icon')
+            response = self.client.get('/app/icon', {'id': 'com.example.app', 'architecture': 'All'})
+            self.assertEqual(response.content, b'app icon')
+            response = self.client.get('/category/icon', {'id': self.category.id})
+            self.assertEqual(response.content, b'category icon')
+        metrics = self.cache.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses']), (13, 2))
+
+        # saving a category drops its icon from the cache
+        self.category.save()
+        self.assertEqual(self.cache.metrics()['invalidations'], 1)
+        self.assertEqual(len(self.cache.entries), 1)
+
+    def test_batch(self):
+        other = createApp('com.example.other', self.category, self.vendor)
+        self.writeIcon('com.example.app_All_qt.png', b'app icon')
+        self.writeIcon('com.example.other_All_.png', b'other icon')
+        self.client.get('/hello', {'tag': 'qt'})
+
+        response = self.client.get('/app/icons', {'ids': 'com.example.app_All_qt,missing',
+                                                  'purchaseIds': '%s,12345' % other.id})
+        self.assertEqual(response.json(), {'status': 'ok', 'icons': {
+            'com.example.app_All_qt': base64.b64encode(b'app icon').decode(),
+            str(other.id): base64.b64encode(b'other icon').decode()}})
+
+        response = self.client.get('/app/icons', {'ids': ','.join(['x'] * 501)})
+        self.assertEqual(response.status_code, 400)
+
+        # the first page of a catalog in a single request
+        apps = self.client.get('/app/list', {'icons': '1'}).json()
+        self.assertEqual({i['id']: base64.b64decode(i['icon']) for i in apps},
+                         {'com.example.app': b'app icon', 'com.example.other': b'other icon'})
+        self.assertNotIn('icon', self.client.get('/app/list').json()[0])
+
+
+class DownloadTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.data = os.urandom(200 * 1024)
+        os.makedirs(os.path.join(self.mediaRoot, 'downloads'))
+        with open(os.path.join(self.mediaRoot, 'downloads', 'package.appkg'), 'wb') as f:
+            f.write(self.data)
+
+    def download(self, **headers):
+        response = self.client.get('/app/download/package.appkg', **headers)
+        return response, b''.join(response.streaming_content) if response.streaming else b''
+
+    def test_complete(self):
+        response, content = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(response['Content-Length']), len(self.data))
+        self.assertEqual(content, self.data)
+
+    def test_ranges(self):
+        for header, start, end in (('bytes=0-99', 0, 99),
+                                   ('bytes=100000-', 100000, len(self.data) - 1),
+                                   ('bytes=-1000', len(self.data) - 1000, len(self.data) - 1),
+                                   ('bytes=5-999999999', 5, len(self.data) - 1)):
+            response, content = self.download(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (start, end, len(self.data)))
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+            self.assertEqual(content, self.data[start:end + 1])
+
+        response, _ = self.download(HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+        response, _ = self.download(HTTP_RANGE='bytes=%d-' % len(self.data))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.data))
+
+    def test_if_range(self):
+        etag = self.download()[0]['ETag']
+        response, content = self.download(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.data[10:20])
+        response, content = self.download(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.data)
+
+    def test_invalid_path(self):
+        response = self.client.get('/app/download/../db.sqlite3')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(APPSTORE_NO_SECURITY=True, APPSTORE_BIND_TO_DEVICE_ID=True)
+class PurchaseTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        store.catalog.invalidate()
+
+        user = User.objects.create_user(username='device', password='password')
+        self.client.force_login(user)
+        vendor = Vendor.objects.create(user=user, name='Vendor', certificate='')
+        createApp('com.example.app', createCategory('Category'), vendor)
+        os.makedirs(os.path.join(self.mediaRoot, 'packages'))
+        with open(os.path.join(self.mediaRoot, 'packages', 'com.example.app'), 'wb') as f:
+            f.write(b'package contents')
+
+    def purchase(self, deviceId):
+        response = self.client.get('/app/purchase', {'id': 'com.example.app', 'device_id': deviceId})
+        self.assertEqual(response.json()['status'], 'ok')
+        name = response.json()['url'].rsplit('/', 1)[1]
+        return name, os.path.join(self.mediaRoot, 'downloads', name)
+
+    def test_purchase_is_reused(self):
+        name, path = self.purchase('device1')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'package contents')
+        os.utime(path, (1, 1))  # expired downloads are recreated under the same name
+        self.assertEqual(self.purchase('device1')[0], name)
+        self.assertGreater(os.path.getmtime(path), 1)
+
+        # handing out the download again extends its lifetime, but keeps its validators
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        etag = self.client.get('/app/download/' + name)['ETag']
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(self.purchase('device1')[0], name)
+        self.assertGreater(os.stat(path).st_atime, time.time() - 60)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        response = self.client.get('/app/download/' + name, HTTP_RANGE='bytes=8-',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'contents')
+
+        self.assertNotEqual(self.purchase('device2')[0], name)
+
+    def test_sweep(self):
+        downloads = os.path.join(self.mediaRoot, 'downloads')
+        os.makedirs(downloads)
+        for name in ('expired', store.downloads.TEMP_PREFIX + 'writing'):
+            with open(os.path.join(downloads, name), 'wb') as f:
+                f.write(b'x')
+            os.utime(os.path.join(downloads, name), (1, 1))
+
+        # the directory is swept once per SWEEP_INTERVAL when storing downloads
+        self.addCleanup(setattr, store.downloads, '_lastSweep', 0.0)
+        store.downloads._lastSweep = time.time()
+        self.purchase('device1')
+        self.assertIn('expired', os.listdir(downloads))
+        store.downloads._lastSweep = 0.0
+        self.purchase('device2')
+        self.assertEqual(len(os.listdir(downloads)), 3)
+        self.assertNotIn('expired', os.listdir(downloads))
+
+        # downloads that are still being written are never removed
+        self.assertEqual(store.downloads.expireDownloads(), [])
+        self.assertIn(store.downloads.TEMP_PREFIX + 'writing', os.listdir(downloads))
+
+    @override_settings(APPSTORE_DOWNLOAD_CACHE_SIZE=1)
+    def test_cache_eviction(self):
+        downloads = os.path.join(self.mediaRoot, 'downloads')
+        os.makedirs(downloads)
+        for i, name in enumerate(('old', 'older', 'expired')):
+            with open(os.path.join(downloads, name), 'wb') as f:
+                f.write(b'x' * 400 * 1024)
+            os.utime(os.path.join(downloads, name), (time.time() - 100 * (i + 1), ) * 2)
+        os.utime(os.path.join(downloads, 'expired'), (1, 1))
+
+        removed = [name for name, _ in store.downloads.expireDownloads()]
+        self.assertEqual(removed, ['expired'])
+
+        name, path = self.purchase('device1')
+        self.assertEqual(sorted(os.listdir(downloads)), sorted(['old', 'older', name]))
+        with open(os.path.join(downloads, 'new'), 'wb') as f:
+            f.write(b'x' * 400 * 1024)
+        removed = [name for name, _ in store.downloads.expireDownloads(keep='new')]
+        self.assertEqual(removed, ['older'])
+
+    @override_settings(APPSTORE_SIGNING_WORKERS=1)
+    def test_async_purchase(self):
+        self.addCleanup(store.signing.shutdownSigningPool)
+        response = self.client.get('/app/purchase', {'id': 'com.example.app', 'device_id': 'device1',
+                                                     'async': '1', 'priority': 'bulk'})
+        self.assertIn(response.json()['status'], ('pending', 'ok'))
+        jobId = response.json().get('id')
+        if jobId is not None:
+            for _ in range(100):
+                response = self.client.get('/app/purchase/status', {'id': jobId})
+                if response.json()['status'] != 'pending':
+                    break
+                time.sleep(0.1)
+        self.assertEqual(response.json()['status'], 'ok')
+
+        # once signed, the same purchase is answered right away
+        name, path = self.purchase('device1')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'package contents')
+        self.assertEqual(response.json()['url'].rsplit('/', 1)[1], name)
+
+        response = self.client.get('/app/purchase', {'id': 'com.example.app', 'device_id': 'device2',
+                                                     'async': '1', 'priority': 'none'})
+        self.assertEqual(response.json()['status'], 'failed')
+        response = self.client.get('/app/purchase/status', {'id': 'unknown.appkg'})
+        self.assertEqual(response.json()['status'], 'failed')
+
+        self.assertEqual(self.client.get('/app/purchase/metrics').status_code, 403)
+        User.objects.filter(username='device').update(is_staff=True)
+        metrics = self.client.get('/app/purchase/metrics').json()['signing']
+        self.assertEqual(metrics['completed'], 1)
+        self.assertEqual(metrics['queued'], 0)
+        self.assertIn('hits', self.client.get('/app/icons/metrics').json())
+
+    @override_settings(APPSTORE_SIGNING_WORKERS=1)
+    def test_async_purchase_evicted(self):
+        self.addCleanup(store.signing.shutdownSigningPool)
+
+        def status(jobId):
+            for _ in range(100):
+                response = self.client.get('/app/purchase/status', {'id': jobId}).json()
+                if response['status'] != 'pending':
+                    return response
+                time.sleep(0.1)
+
+        response = self.client.get('/app/purchase', {'id': 'com.example.app', 'device_id': 'device1',
+                                                     'async': '1'}).json()
+        name = response.get('id') or response['url'].rsplit('/', 1)[1]
+        self.assertEqual(status(name)['status'], 'ok')
+
+        # the signed package is removed before the device fetched it, it is signed again
+        os.remove(os.path.join(self.mediaRoot, 'downloads', name))
+        response = self.client.get('/app/purchase/status', {'id': name}).json()
+        self.assertEqual(response['status'], 'pending')
+        self.assertEqual(status(name)['status'], 'ok')
+        self.assertTrue(os.path.exists(os.path.join(self.mediaRoot, 'downloads', name)))
+
+    def test_worker_died(self):
+        pool = store.signing.SigningPool(1, 10)
+        self.addCleanup(pool.shutdown)
+        package = os.path.join(self.mediaRoot, 'packages', 'com.example.app')
+
+        def wait(job):
+            for _ in range(100):
+                if job.state in ('done', 'failed'):
+                    return job.state
+                time.sleep(0.1)
+
+        self.assertEqual(wait(pool.submit('first', 0, package, 'first', '', False)), 'done')
+        # a worker process dies, which breaks the executor
+        broken = pool.executor
+        broken.submit(os._exit, 1)
+        self.assertEqual(wait(pool.submit('second', 0, package, 'second', '', False)), 'failed')
+        self.assertEqual(wait(pool.submit('third', 0, package, 'third', '', False)), 'done')
+        self.assertIsNot(pool.executor, broken)
+
+
+class SigningTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.p12, self.crt = createCertificate(self.mediaRoot)
+        self.settings = override_settings(APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE=self.p12,
+                                          APPSTORE_STORE_SIGN_PKCS12_PASSWORD='password')
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.files = [('--PACKAGE-HEADER--', b'header'), ('info.yaml', b'info'),
+                      ('icon.png', b'icon'), ('lib/libfoo.so', os.urandom(100000)),
+                      ('--PACKAGE-FOOTER--', b'footer')]
+        self.source = os.path.join(self.mediaRoot, 'source.appkg')
+        createPackage(self.source, self.files)
+
+    def test_signature_is_appended(self):
+        digest = hashlib.sha256(b'package digest').digest()
+        destinations = [os.path.join(self.mediaRoot, name) for name in ('a.appkg', 'b.appkg')]
+        for deviceId, destination in zip(('device1', 'device2'), destinations):
+            addSignatureToPackage(self.source, destination, digest, deviceId, 2)
+
+        with open(destinations[0], 'rb') as a, open(destinations[1], 'rb') as b:
+            a, b = a.read(), b.read()
+        # both share the same compressed entries, only the footer member differs
+        prefix = os.path.commonprefix([a, b])
+        self.assertGreater(len(prefix), 100000)
+
+        with tarfile.open(destinations[1], mode='r:*') as pkg:
+            entries = [(entry.name, pkg.extractfile(entry).read()) for entry in pkg]
+        self.assertEqual(entries[:-1], self.files)
+        self.assertEqual(entries[-1][0], '--PACKAGE-FOOTER--store-signature')
+
+        docs = list(yaml.safe_load_all(entries[-1][1]))
+        self.assertEqual(docs[0], {'formatVersion': 2, 'formatType': 'am-package-footer'})
+        with open(self.crt, 'rb') as crt:
+            verifySignature(docs[1]['storeSignature'],
+                            hmac.new(b'device2', digest, hashlib.sha256).digest(), [crt.read()])
+
+    def test_package_is_parsed_once(self):
+        createValidPackage(self.source, 'com.example.app', [('lib/libfoo.so', os.urandom(100000))])
+        with open(self.source, 'rb') as package:
+            digest = parsePackageMetadata(package)['rawDigest']
+
+        packageDigest = store.utilities.fileDigest(self.source)
+        store.signing.createDownload(self.source, 'first.appkg', 'device1', True, packageDigest)
+        # later signatures only need the signing base and the stored signing info
+        with unittest.mock.patch('store.utilities.parsePackageMetadata',
+                                 side_effect=AssertionError('package parsed again')), \
+                unittest.mock.patch('store.utilities.fileDigest',
+                                    side_effect=AssertionError('package hashed again')):
+            store.signing.createDownload(self.source, 'second.appkg', 'device2', True,
+                                         packageDigest)
+
+        with tarfile.open(os.path.join(self.mediaRoot, 'downloads', 'second.appkg')) as pkg:
+            footer = pkg.extractfile('--PACKAGE-FOOTER--store-signature').read()
+        docs = list(yaml.safe_load_all(footer))
+        self.assertEqual(docs[0]['formatVersion'], 2)
+        with open(self.crt, 'rb') as crt:
+            verifySignature(docs[1]['storeSignature'],
+                            hmac.new(b'device2', digest, hashlib.sha256).digest(), [crt.read()])
+
+
+class CryptoContextTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.p12, self.crt = createCertificate(self.directory)
+        self.settings = override_settings(APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE=self.p12,
+                                          APPSTORE_STORE_SIGN_PKCS12_PASSWORD='password',
+                                          APPSTORE_DEV_VERIFY_CA_CERTIFICATES=[self.crt])
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def loads(self, name):
+        return store.crypto.timings.report().get('load ' + name, {}).get('count', 0)
+
+    def test_signing_material_is_loaded_once(self):
+        name = store.crypto.signingContext.name
+        before = self.loads(name)
+        signatures = [store.crypto.storeSignature(b'hash%d' % i) for i in range(3)]
+        self.assertEqual(self.loads(name), before + 1)
+        for i, signature in enumerate(signatures):
+            store.crypto.verifyDeveloperSignature(signature, b'hash%d' % i)
+
+    def test_reload_on_change(self):
+        name = store.crypto.signingContext.name
+        store.crypto.storeSignature(b'hash')
+        before = self.loads(name)
+        # replace the certificate: the next signature has to use the new one
+        self.p12, self.crt = createCertificate(self.directory)
+        signature = store.crypto.storeSignature(b'hash')
+        self.assertEqual(self.loads(name), before + 1)
+        store.crypto.verifyDeveloperSignature(signature, b'hash')
+
+    def test_verify_rejects_wrong_hash(self):
+        signature = store.crypto.storeSignature(b'hash')
+        with self.assertRaises(Exception):
+            store.crypto.verifyDeveloperSignature(signature, b'other')
+
+
+class PackageMetadataTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def createPackage(self, files):
+        header = yaml.dump_all([{'formatVersion': 2, 'formatType': 'am-package-header'},
+                                {'packageId': 'com.example.app', 'diskSpaceUsed': 1}])
+        info = yaml.dump_all([{'formatVersion': 1, 'formatType': 'am-package'},
+                              {'id': 'com.example.app', 'name': {'en': 'App'}}])
+        footer = yaml.dump_all([{'formatVersion': 2, 'formatType': 'am-package-footer'},
+                                {'digest': 'digest'}])
+        path = os.path.join(self.directory, 'package.appkg')
+        createPackage(path, [('--PACKAGE-HEADER--', header.encode()), ('info.yaml', info.encode()),
+                             ('icon.png', b'icon')] + files +
+                      [('--PACKAGE-FOOTER--', footer.encode())])
+        return path
+
+    def test_file_digests_are_bounded(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.directory, 'file%d' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'%d' % i)
+        with unittest.mock.patch('store.utilities.MAX_FILE_DIGESTS', 2), \
+                unittest.mock.patch('store.utilities.fileDigests', collections.OrderedDict()):
+            for path in paths + paths[1:2]:
+                self.assertEqual(store.utilities.fileDigest(path),
+                                 hashlib.sha256(b'%d' % paths.index(path)).hexdigest())
+            self.assertEqual(list(store.utilities.fileDigests), [paths[2], paths[1]])
+
+    def test_streaming_digest(self):
+        big = os.urandom(1024 * 1024) * 24
+        files = [('data/big.bin', big), ('data/small.txt', b'small')]
+        path = self.createPackage(files)
+
+        digest = hashlib.sha256()
+        for name, contents in [('info.yaml', None), ('icon.png', b'icon')] + files:
+            if contents is None:
+                with tarfile.open(path) as pkg:
+                    contents = pkg.extractfile(name).read()
+            digest.update(contents)
+            digest.update(b'F/%d/' % len(contents))
+            digest.update(name.encode('utf-8'))
+
+        tracemalloc.start()
+        try:
+            with open(path, 'rb') as package:
+                pkgdata = parsePackageMetadata(package)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(pkgdata['digest'], digest.hexdigest())
+        self.assertEqual(pkgdata['architecture'], 'All')
+        self.assertLess(peak, len(big) // 4)
+
+    def test_pipeline_matches_sequential(self):
+        files = [('lib/libfoo.so', createElfHeader(64, 'little', 183)),
+                 ('data/big.bin', os.urandom(1024 * 1024))]
+        files += [('qml/file%d.qml' % i, b'Item {}\n' * i) for i in range(200)]
+        path = self.createPackage(files)
+
+        results = []
+        for cpus in (1, 4):
+            with unittest.mock.patch('os.cpu_count', return_value=cpus), \
+                    open(path, 'rb') as package:
+                results.append(parsePackageMetadata(package))
+        self.assertEqual(results[0]['digest'], results[1]['digest'])
+        self.assertEqual(results[0]['architecture'], 'arm64-little_endian-64-elf')
+        self.assertEqual(results[1]['architecture'], 'arm64-little_endian-64-elf')
+        self.assertEqual(sorted(results[1]['timings']), ['classify', 'digest', 'read', 'total'])
+
+    def test_oversized_metadata(self):
+        path = self.createPackage([('--PACKAGE-FOOTER--x', b'x' * (17 * 1024 * 1024))])
+        with open(path, 'rb') as package, self.assertRaisesRegex(Exception, 'larger than'):
+            parsePackageMetadata(package)
+
+
+class OsArchTest(TestCase):
+    def samples(self):
+        for machine in store.osandarch.ELF_MACHINES:
+            for bits in (32, 64):
+                for byteorder in ('little', 'big'):
+                    yield createElfHeader(bits, byteorder, machine)
+        for machine in store.osandarch.PE_MACHINES:
+            for optionalMagic in (0x10b, 0x20b):
+                yield createPEHeader(machine, optionalMagic)
+        for cputype in store.osandarch.MACHO_CPUTYPES:
+            for cpusubtype in (0, 1, 2, 3, 8):
+                yield createMachOHeader(cputype, cpusubtype)
+
+    @unittest.skipIf(store.utilities.magic is None, 'libmagic is not available')
+    def test_same_as_libmagic(self):
+        for sample in self.samples():
+            self.assertEqual(store.osandarch.getOsArchFromHeader(sample),
+                             getOsArchWithMagic(sample, 'sample'))
+
+    def test_not_binary(self):
+        for sample in (b'\x89PNG\r\n\x1a\n' + bytes(100), b'import QtQuick 2.0\n', b'MZ', b'',
+                       b'\xca\xfe\xba\xbe\x00\x00\x00\x34'):
+            self.assertIsNone(store.osandarch.getOsArchFromHeader(sample))
+
+    def test_unknown_binary(self):
+        with self.assertRaises(store.osandarch.UnknownBinaryFormat):
+            store.osandarch.getOsArchFromHeader(createElfHeader(64, 'little', 0x1234))
+        with self.assertRaisesRegex(Exception, 'Universal binaries'):
+            store.osandarch.getOsArchFromHeader(b'\xca\xfe\xba\xbe\x00\x00\x00\x02')
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class UploadCommandTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.objects.create_user(username='vendor', password='password')
+        Vendor.objects.create(user=user, name='Vendor', certificate='')
+        Vendor.objects.create(user=user, name='Other', certificate='')
+        createCategory('Category')
+        createCategory('Games')
+
+        self.packages = os.path.join(self.mediaRoot, 'import')
+        os.makedirs(self.packages)
+        for i in range(3):
+            createValidPackage(os.path.join(self.packages, 'app%d.appkg' % i), 'com.example.app%d' % i)
+        with open(os.path.join(self.packages, 'broken.appkg'), 'wb') as f:
+            f.write(b'not a package')
+
+    def upload(self, *args):
+        output = io.StringIO()
+        call_command('store-upload-package', '--jobs', '2', '--batch-size', '2', *args,
+                     stdout=output)
+        return output.getvalue()
+
+    def test_directory(self):
+        output = self.upload('--vendor', 'Vendor', '--category', 'Category', self.packages)
+        self.assertIn('3 packages uploaded, 1 failed', output)
+        self.assertIn('broken.appkg\n  -> failed', output)
+        self.assertEqual(sorted(App.objects.values_list('appid', flat=True)),
+                         ['com.example.app0', 'com.example.app1', 'com.example.app2'])
+
+    def test_manifest(self):
+        manifest = os.path.join(self.packages, 'manifest.csv')
+        with open(manifest, 'w') as f:
+            f.write('package,vendor,category,description\n'
+                    'app0.appkg,,,First\n'
+                    'app1.appkg,Other,Games,\n')
+        output = self.upload('--vendor', 'Vendor', '--category', 'Category', '--manifest', manifest,
+                             os.path.join(self.packages, 'app2.*'))
+        self.assertIn('3 packages uploaded, 0 failed', output)
+        apps = {app.appid: app for app in App.objects.select_related('vendor', 'category')}
+        self.assertEqual(apps['com.example.app0'].description, 'First')
+        self.assertEqual(apps['com.example.app1'].vendor.name, 'Other')
+        self.assertEqual(apps['com.example.app1'].category.name, 'Games')
+        self.assertEqual(apps['com.example.app2'].description, 'Empty description')
+
+    def test_unknown_vendor(self):
+        with self.assertRaises(CommandError):
+            self.upload('--vendor', 'Nobody', '--category', 'Category', self.packages)
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class VerifyCommandTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for i in range(2):
+            createValidPackage(os.path.join(self.directory, 'app%d.appkg' % i), 'com.example.app%d' % i)
+
+    def verify(self, *args):
+        output = io.StringIO()
+        call_command('verify-upload-package', '--jobs', '2', *args, stdout=output)
+        return output.getvalue()
+
+    def test_jsonl_report(self):
+        lines = self.verify('--format', 'jsonl', self.directory).splitlines()
+        reports = [json.loads(line) for line in lines]
+        self.assertEqual([i['id'] for i in reports], ['com.example.app0', 'com.example.app1'])
+        for report in reports:
+            self.assertEqual(report['status'], 'ok')
+            self.assertEqual(report['architecture'], 'All')
+            self.assertEqual(report['tags_hash'], '')
+            self.assertEqual(len(report['digest']), 64)
+            self.assertIn('validate', report['timings'])
+
+    def test_native_package_jsonl(self):
+        createValidPackage(os.path.join(self.directory, 'app0.appkg'), 'com.example.app0',
+                           [('lib/libfoo.so', createElfHeader(64, 'little', 183))])
+        # nothing but the report may be written to stdout, also not by the worker processes
+        with tempfile.TemporaryFile('w+') as output:
+            sys.stdout.flush()
+            savedStdout = os.dup(1)
+            os.dup2(output.fileno(), 1)
+            try:
+                call_command('verify-upload-package', '--format', 'jsonl', self.directory)
+                sys.stdout.flush()
+            finally:
+                os.dup2(savedStdout, 1)
+                os.close(savedStdout)
+            output.seek(0)
+            reports = [json.loads(line) for line in output.read().splitlines()]
+        self.assertEqual(reports[0]['architecture'], 'arm64-little_endian-64-elf')
+
+    def test_failure_exit_code(self):
+        with open(os.path.join(self.directory, 'broken.appkg'), 'wb') as f:
+            f.write(b'not a package')
+        output = io.StringIO()
+        with self.assertRaisesRegex(CommandError, '1 of 3 packages failed'):
+            call_command('verify-upload-package', '--format', 'json', self.directory, stdout=output)
+        reports = json.loads(output.getvalue())
+        self.assertEqual([i['status'] for i in reports], ['ok', 'ok', 'failed'])
+        self.assertTrue(reports[2]['error'])
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class UploadTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.client.force_login(user)
+        Vendor.objects.create(user=user, name='Vendor', certificate='')
+        createCategory('Category')
+        self.package = os.path.join(self.mediaRoot, 'app.appkg')
+        createValidPackage(self.package, 'com.example.app', [('data/big.bin', os.urandom(3000000))])
+
+    def upload(self, path):
+        with open(path, 'rb') as package:
+            return self.client.post('/upload', {'description': 'description',
+                                                'short-description': 'short',
+                                                'category': 'Category', 'vendor': 'Vendor',
+                                                'package': package}).json()['status']
+
+    def test_validated_while_uploading(self):
+        # the package must not be parsed again after the upload
+        with unittest.mock.patch('store.api.parseAndValidatePackageMetadata',
+                                 side_effect=AssertionError('parsed twice')):
+            self.assertEqual(self.upload(self.package), 'ok')
+        app = App.objects.get(appid='com.example.app')
+        with open(self.package, 'rb') as original, app.file as stored:
+            self.assertEqual(original.read(), stored.read())
+        # the temporary upload file was renamed, not copied
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'uploads')), [])
+
+    def test_tags_and_conflicts(self):
+        createValidPackage(self.package, 'com.example.app',
+                           extra={'tags': ['qt:5.15'], 'conflicts': ['neptune']})
+        self.assertEqual(self.upload(self.package), 'ok')
+        app = App.objects.get(appid='com.example.app')
+        self.assertEqual(sorted((i.negative, i.name, i.version) for i in app.tags.all()),
+                         [(False, 'qt', '5.15'), (True, 'neptune', '')])
+
+        self.client.get('/hello', {'tag': 'qt:5.15'})
+        apps = self.client.get('/app/list').json()
+        self.assertEqual(apps[0]['conflict_tags'], ['neptune'])
+        self.client.get('/hello', {'tag': 'qt:5.15,neptune'})
+        self.assertEqual(self.client.get('/app/list').json(), [])
+
+    def test_invalid_package(self):
+        broken = os.path.join(self.mediaRoot, 'broken.appkg')
+        with open(broken, 'wb') as f:
+            f.write(b'not a package' * 1000)
+        self.assertEqual(self.upload(broken), 'Package validation failed')
+        self.assertFalse(App.objects.exists())
+
+    def test_invalid_package_not_parsed_again(self):
+        broken = os.path.join(self.mediaRoot, 'broken.appkg')
+        createPackage(broken, [('info.yaml', b'info')])
+        with unittest.mock.patch('store.api.parseAndValidatePackageMetadata',
+                                 side_effect=AssertionError('parsed twice')):
+            status = self.upload(broken)
+        self.assertTrue(status.startswith('Package validation failed: '), status)
+        self.assertFalse(App.objects.exists())
+
+    def test_other_compression(self):
+        # only gzip can be validated while uploading, other packages are checked afterwards
+        bzip2 = os.path.join(self.mediaRoot, 'app.tar.bz2')
+        with tarfile.open(self.package) as source, tarfile.open(bzip2, mode='w:bz2') as pkg:
+            for entry in source:
+                pkg.addfile(entry, source.extractfile(entry))
+        with self.assertLogs('store.uploadhandlers', 'INFO'):
+            self.assertEqual(self.upload(bzip2), 'ok')
+        self.assertTrue(App.objects.filter(appid='com.example.app').exists())
+
+    def test_stream_with_gzip_members(self):
+        tar = io.BytesIO()
+        with tarfile.open(fileobj=tar, mode='w') as pkg:
+            for name in ('a', 'b', 'c'):
+                entry = tarfile.TarInfo(name)
+                entry.size = 100000
+                pkg.addfile(entry, io.BytesIO(os.urandom(entry.size)))
+        data = tar.getvalue()
+        split = 512 + 100352  # after the first entry
+        compressed = gzip.compress(data[:split]) + gzip.compress(data[split:])
+
+        stream = store.uploadhandlers.PackageStream()
+        feeder = threading.Thread(target=lambda: [stream.feed(compressed[i:i + 1000])
+                                                  for i in range(0, len(compressed), 1000)]
+                                  + [stream.feed(None)])
+        feeder.start()
+        with tarfile.open(fileobj=stream, mode='r|') as pkg:
+            names = [entry.name for entry in pkg]
+        stream.abandon()
+        feeder.join()
+        self.assertEqual(names, ['a', 'b', 'c'])
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class BlobStoreTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.client.force_login(user)
+        Vendor.objects.create(user=user, name='Vendor', certificate='')
+        createCategory('Category')
+
+    def upload(self, appId):
+        path = os.path.join(self.mediaRoot, appId + '.appkg')
+        if not os.path.exists(path):
+            createValidPackage(path, appId, [('data.bin', os.urandom(1000))])
+        with open(path, 'rb') as package:
+            self.assertEqual(self.client.post('/upload', {'description': 'description',
+                                                          'short-description': 'short',
+                                                          'category': 'Category',
+                                                          'vendor': 'Vendor',
+                                                          'package': package}).json()['status'],
+                             'ok')
+        with open(path, 'rb') as package:
+            return path, hashlib.sha256(package.read()).hexdigest()
+
+    def blobFiles(self):
+        return sorted(name for _, _, names in os.walk(os.path.join(self.mediaRoot, 'blobs'))
+                      for name in names)
+
+    def test_identical_upload_is_noop(self):
+        path, digest = self.upload('com.example.app')
+        app = App.objects.get(appid='com.example.app')
+        self.assertEqual(app.package_id, digest)
+        self.assertEqual(app.file.name, store.blobs.blobPath(digest))
+        blobFile = os.path.join(self.mediaRoot, app.file.name)
+        before = os.stat(blobFile)
+
+        self.upload('com.example.app')
+        after = os.stat(blobFile)
+        self.assertEqual((before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+        # the package, the icon and its variants for the default APPSTORE_ICON_SIZES
+        variants = list(app.icon.variants.values_list('blob', flat=True))
+        self.assertEqual(len(variants), 2)
+        self.assertEqual(Blob.objects.count(), 4)
+        self.assertEqual(self.blobFiles(), sorted([digest, app.icon_id] + variants))
+
+    def test_shared_icon(self):
+        self.upload('com.example.app1')
+        self.upload('com.example.app2')
+        icons = Blob.objects.filter(kind=store.blobs.ICON, variantOf=None)
+        self.assertEqual(icons.count(), 1)
+        self.assertEqual(icons[0].references(), 2)
+        self.assertEqual(icons[0].variants.count(), 2)
+
+        # the icon URL is the immutable digest of the icon
+        iconUrls = set(i['iconUrl'] for i in self.client.get('/app/list').json())
+        self.assertEqual(iconUrls, {'http://testserver/app/icons/' + icons[0].digest})
+        response = self.client.get('/app/icons/' + icons[0].digest)
+        self.assertEqual(response.content, ICON)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_only_icons_are_served(self):
+        path, digest = self.upload('com.example.app')
+        app = App.objects.get(appid='com.example.app')
+        self.client.logout()
+        self.assertEqual(self.client.get('/app/icons/' + app.icon_id).status_code, 200)
+        self.assertEqual(self.client.get('/app/icons/' + digest).status_code, 404)
+        self.assertEqual(self.client.get('/app/icons/' + digest, {'size': 64}).status_code, 404)
+
+        response = self.client.get('/app/icons', {'ids': ','.join([app.icon_id, digest])})
+        self.assertEqual(list(response.json()['icons']), [app.icon_id])
+
+    def test_collect_garbage(self):
+        path, digest = self.upload('com.example.app')
+        app = App.objects.get(appid='com.example.app')
+        base = store.utilities.signingBase(os.path.join(self.mediaRoot, app.file.name))
+        app.delete()
+
+        # recently used blobs are kept, an upload may be about to refer to them
+        self.assertEqual(store.blobs.collectGarbage(), [])
+
+        Blob.objects.update(dateUsed=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        removed = store.blobs.collectGarbage(dryRun=True)
+        self.assertEqual(len(removed), 5)  # package, icon, two icon variants and signing base
+        self.assertEqual(len(self.blobFiles()), 4)
+
+        store.blobs.collectGarbage()
+        self.assertEqual(self.blobFiles(), [])
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(base))
+
+    def test_icon_variants(self):
+        image = PIL.Image.frombytes('RGB', (256, 256), os.urandom(256 * 256 * 3))
+        data = io.BytesIO()
+        image.save(data, format='png')
+        data = data.getvalue()
+
+        with override_settings(APPSTORE_ICON_SIZES='64, 128'):
+            icon = store.iconvariants.storeIcon(data)
+            # identical icons share their variants
+            self.assertEqual(store.iconvariants.storeIcon(data), icon)
+        variants = {i.size: i.blob for i in icon.variants.all()}
+        self.assertEqual(sorted(variants), [64, 128])
+        self.assertEqual(Blob.objects.count(), 3)
+        for size, blob in variants.items():
+            with PIL.Image.open(os.path.join(self.mediaRoot, blob.path())) as variant:
+                self.assertEqual(variant.size, (size, size))
+
+        app = createApp('com.example.app', Category.objects.get(), Vendor.objects.get())
+        app.icon = icon
+        app.save()
+
+        # the smallest variant at least as large as requested, the original for larger sizes
+        for size, digest in ((0, icon.digest), (48, variants[64].digest),
+                             (100, variants[128].digest), (512, icon.digest)):
+            response = self.client.get('/app/icons/' + icon.digest, {'size': size})
+            self.assertEqual(response['ETag'], '"%s"' % digest)
+        apps = self.client.get('/app/list', {'size': 48, 'icons': 1}).json()
+        self.assertTrue(apps[0]['iconUrl'].endswith('/app/icons/%s?size=48' % icon.digest))
+        with open(os.path.join(self.mediaRoot, variants[64].path()), 'rb') as variant:
+            self.assertEqual(base64.b64decode(apps[0]['icon']), variant.read())
+
+        # variants are kept as long as their icon is referenced
+        Blob.objects.update(dateUsed=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(store.blobs.collectGarbage(), [])
+
+        with override_settings(APPSTORE_ICON_SIZES='64'):
+            self.assertEqual(store.iconvariants.updateIconVariants(), (0, 1))
+        self.assertEqual([path for path, size in store.blobs.collectGarbage()],
+                         [variants[128].path()])
+
+        app.delete()
+        store.blobs.collectGarbage()
+        store.blobs.collectGarbage()
+        self.assertFalse(Blob.objects.exists())
+
+    def test_collect_garbage_while_uploading(self):
+        # the package is uploaded again while collectGarbage() is about to remove it, either
+        # before its entry is removed or before its file is
+        hooks = (('store.blobs.transaction.atomic', store.blobs.transaction.atomic),
+                 ('store.blobs.os.replace', os.replace))
+        for function, original in hooks:
+            path, digest = self.upload('com.example.app')
+            App.objects.get(appid='com.example.app').delete()
+            Blob.objects.update(dateUsed=datetime.datetime(2000, 1, 1,
+                                                           tzinfo=datetime.timezone.utc))
+
+            uploads = []
+            def upload(*args, **kwargs):
+                if not uploads:
+                    uploads.append(True)
+                    self.upload('com.example.app')
+                return original(*args, **kwargs)
+            with unittest.mock.patch(function, side_effect=upload):
+                store.blobs.collectGarbage()
+            app = App.objects.get(appid='com.example.app')
+            self.assertEqual(app.package_id, digest)
+            self.assertTrue(os.path.exists(os.path.join(self.mediaRoot, app.package.path())))
+            self.assertTrue(os.path.exists(os.path.join(self.mediaRoot, app.icon.path())))
+
+    def test_concurrent_icon_variants(self):
+        image = PIL.Image.frombytes('RGB', (256, 256), os.urandom(256 * 256 * 3))
+        data = io.BytesIO()
+        image.save(data, format='png')
+        data = data.getvalue()
+        icon = store.blobs.storeBlob(store.blobs.ICON, data)
+
+        # another upload of the same icon creates the variant while this one is scaling it
+        scaleIcon = store.iconvariants.scaleIcon
+        def concurrentUpload(data, size):
+            variant = scaleIcon(data, size)
+            IconVariant.objects.create(icon=icon, size=size,
+                                       blob=store.blobs.storeBlob(store.blobs.ICON, variant))
+            return variant
+        with override_settings(APPSTORE_ICON_SIZES='64'), \
+                unittest.mock.patch('store.iconvariants.scaleIcon', side_effect=concurrentUpload), \
+                unittest.mock.patch('store.iconvariants.storeBlob') as storeBlob:
+            self.assertEqual(store.iconvariants.createIconVariants(icon, data), 0)
+        self.assertEqual(icon.variants.count(), 1)
+        # the variant is not stored a second time
+        storeBlob.assert_not_called()
+
+    def test_import_legacy_files(self):
+        path = os.path.join(self.mediaRoot, 'packages', 'com.example.app')
+        os.makedirs(os.path.dirname(path))
+        createValidPackage(path, 'com.example.app')
+        os.makedirs(os.path.join(self.mediaRoot, 'icons'))
+        with open(os.path.join(self.mediaRoot, 'icons', 'com.example.app_All_.png'), 'wb') as f:
+            f.write(ICON)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        createApp('com.example.app', Category.objects.get(), Vendor.objects.get())
+
+        call_command('collect-blobs', '--import-legacy', stdout=io.StringIO())
+        app = App.objects.get()
+        self.assertEqual(app.package_id, digest)
+        self.assertEqual(app.icon_id, hashlib.sha256(ICON).hexdigest())
+        self.assertEqual(sorted(app.icon.variants.values_list('size', flat=True)), [64, 128])
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'packages')), [])
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'icons')), [])
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class UploadSessionTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.client.force_login(user)
+        Vendor.objects.create(user=user, name='Vendor', certificate='')
+        createCategory('Category')
+        path = os.path.join(self.mediaRoot, 'app.appkg')
+        createValidPackage(path, 'com.example.app', [('data.bin', os.urandom(300000))])
+        with open(path, 'rb') as f:
+            self.package = f.read()
+
+    def put(self, sessionId, offset, data):
+        return self.client.put('/upload/session/%s?offset=%d' % (sessionId, offset), data,
+                               content_type='application/octet-stream')
+
+    def finalize(self, sessionId):
+        return self.client.post('/upload/session/%s/finalize' % sessionId,
+                                {'description': 'description', 'short-description': 'short',
+                                 'category': 'Category', 'vendor': 'Vendor'}).json()['status']
+
+    def test_resumable_upload(self):
+        size = len(self.package)
+        response = self.client.post('/upload/session', {'size': size}).json()
+        sessionId = response['id']
+        self.assertEqual(response['offset'], 0)
+
+        self.assertEqual(self.put(sessionId, 0, self.package[:100000]).json()['offset'], 100000)
+        # retried and overlapping chunks are idempotent
+        self.assertEqual(self.put(sessionId, 0, self.package[:100000]).json()['offset'], 100000)
+        self.assertEqual(self.put(sessionId, 50000, self.package[50000:150000]).json()['offset'],
+                         150000)
+        # a gap is rejected with the offset to continue at
+        response = self.put(sessionId, 200000, self.package[200000:])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 150000)
+        self.assertEqual(self.client.get('/upload/session/' + sessionId).json()['offset'], 150000)
+
+        # finalizing an incomplete upload fails, but keeps the session
+        self.assertIn('incomplete', self.finalize(sessionId))
+
+        self.assertEqual(self.put(sessionId, 150000, self.package[150000:]).json()['offset'], size)
+        self.assertEqual(self.finalize(sessionId), 'ok')
+
+        app = App.objects.get(appid='com.example.app')
+        self.assertEqual(app.package_id, hashlib.sha256(self.package).hexdigest())
+        with app.file as stored:
+            self.assertEqual(stored.read(), self.package)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'uploads')), [])
+
+    def test_resume_in_other_process(self):
+        sessionId = self.client.post('/upload/session').json()['id']
+        self.put(sessionId, 0, self.package[:1000])
+        # another server process has no hash state for the session
+        store.uploadsessions._hashes.clear()
+        self.put(sessionId, 1000, self.package[1000:])
+        self.assertEqual(self.finalize(sessionId), 'ok')
+        self.assertEqual(App.objects.get().package_id, hashlib.sha256(self.package).hexdigest())
+
+    def test_hash_states_are_bounded(self):
+        sessionIds = [self.client.post('/upload/session').json()['id'] for i in range(3)]
+        with unittest.mock.patch('store.uploadsessions.MAX_HASHES', 2):
+            for sessionId in sessionIds:
+                self.put(sessionId, 0, self.package)
+        self.assertEqual([str(i) for i in store.uploadsessions._hashes], sessionIds[1:])
+        self.assertEqual(self.finalize(sessionIds[0]), 'ok')
+
+    def test_finalize_waits_for_put(self):
+        session = store.uploadsessions.createSession(User.objects.get(), len(self.package))
+        result = []
+        with open(store.uploadsessions.sessionPath(session.id), 'ab') as f:
+            # a PUT to the same session is still writing
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(self.package[:1000])
+            f.flush()
+            thread = threading.Thread(
+                target=lambda: result.append(store.uploadsessions.finishSession(session)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            f.write(self.package[1000:])
+        thread.join()
+        self.assertEqual(result[0].digest, hashlib.sha256(self.package).hexdigest())
+        result[0].close()
+
+    def test_invalid_package(self):
+        sessionId = self.client.post('/upload/session').json()['id']
+        self.put(sessionId, 0, b'not a package' * 1000)
+        self.assertEqual(self.finalize(sessionId), 'Package validation failed')
+        self.assertFalse(App.objects.exists())
+
+    def test_expire_sessions(self):
+        sessionId = self.client.post('/upload/session').json()['id']
+        self.put(sessionId, 0, self.package[:1000])
+        self.assertEqual(store.uploadsessions.expireSessions(), [])
+
+        UploadSession.objects.update(
+            dateModified=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual([i[0] for i in store.uploadsessions.expireSessions()], [sessionId])
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'uploads')), [])
+        self.assertEqual(self.client.get('/upload/session/' + sessionId).status_code, 404)
+
+
+@override_settings(APPSTORE_NO_SECURITY=True)
+class UploadJobTest(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.client.force_login(user)
+        Vendor.objects.create(user=user, name='Vendor', certificate='')
+        createCategory('Category')
+        self.package = os.path.join(self.mediaRoot, 'app.appkg')
+        createValidPackage(self.package, 'com.example.app', [('data.bin', os.urandom(100000))])
+
+    def upload(self, path):
+        with open(path, 'rb') as package:
+            response = self.client.post('/upload?async=1', {'description': 'description',
+                                                            'short-description': 'short',
+                                                            'category': 'Category',
+                                                            'vendor': 'Vendor',
+                                                            'package': package}).json()
+        self.assertEqual(response['status'], 'queued')
+        return response['id']
+
+    def status(self, jobId):
+        return self.client.get('/upload/status', {'id': jobId}).json()
+
+    def processUploads(self):
+        call_command('process-uploads', '--once', '--nice', '0', stdout=io.StringIO())
+
+    def test_queued_upload(self):
+        # the request neither validates nor stores the package
+        with unittest.mock.patch('store.uploadhandlers.parseAndValidatePackageMetadata',
+                                 side_effect=AssertionError('validated in the request')):
+            jobId = self.upload(self.package)
+        self.assertEqual(self.status(jobId)['status'], 'queued')
+        self.assertFalse(App.objects.exists())
+
+        self.processUploads()
+        status = self.status(jobId)
+        self.assertEqual(status['status'], 'stored')
+        self.assertEqual(status['appid'], 'com.example.app')
+        self.assertEqual(set(status['timings']), {'wait', 'validate', 'stages', 'store'})
+        with open(self.package, 'rb') as f:
+            self.assertEqual(App.objects.get().package_id, hashlib.sha256(f.read()).hexdigest())
+        self.assertEqual(os.listdir(os.path.join(self.mediaRoot, 'uploads')), [])
+
+    def test_failed_upload(self):
+        broken = os.path.join(self.mediaRoot, 'broken.appkg')
+        with open(broken, 'wb') as f:
+            f.write(b'not a package' * 1000)
+        jobId = self.upload(broken)
+        self.processUploads()
+        status = self.status(jobId)
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('Package validation failed', status['error'])
+        self.assertFalse(App.objects.exists())
+
+    def test_claim_and_requeue(self):
+        jobId = self.upload(self.package)
+        job = store.uploadjobs.claimJob()
+        self.assertEqual(str(job.id), jobId)
+        self.assertIsNone(store.uploadjobs.claimJob())
+        self.assertEqual(self.status(jobId)['status'], 'validating')
+
+        # a worker that died while validating
+        self.assertEqual(store.uploadjobs.requeueStaleJobs(), 0)
+        UploadJob.objects.update(
+            dateStarted=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(store.uploadjobs.requeueStaleJobs(), 1)
+        self.processUploads()
+        self.assertEqual(self.status(jobId)['status'], 'stored')
+
+
+class TagSetTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='user', password='password')
+        self.vendor = Vendor.objects.create(user=user, name='Vendor', certificate='')
+        self.category = createCategory('Category')
+
+    def test_fingerprint(self):
+        tags = ['tag%d:%d.0' % (i, i) for i in range(300)]
+        app1 = createApp('com.example.app1', self.category, self.vendor, tags=tags)
+        app2 = createApp('com.example.app2', self.category, self.vendor, tags=tags)
+        self.assertEqual(len(app1.tagset_id), 64)
+        self.assertEqual(app1.tagset_id, store.utilities.tagSetFingerprint(app1.tags_hash))
+        self.assertEqual(app1.tagset_id, app2.tagset_id)
+        self.assertEqual(TagSet.objects.get().tags, app1.tags_hash)
+
+        # the same appid and architecture can be stored once per tag set
+        createApp('com.example.app1', self.category, self.vendor, tags=['other'])
+        self.assertEqual(App.objects.filter(appid='com.example.app1').count(), 2)
+
+
+class DatabaseTest(TestCase):
+    def test_sqlite_pragmas(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        default = connections['default']
+        wrapper = default.__class__(dict(default.settings_dict,
+                                         NAME=os.path.join(directory, 'db.sqlite3')),
+                                    alias='pragmas')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(cursor.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+
+    def test_replica_router(self):
+        router = store.database.CatalogReplicaRouter()
+        self.assertIsNone(router.db_for_read(App))
+        with store.database.catalogReads():
+            # without a replica everything stays on the default database
+            self.assertIsNone(router.db_for_read(App))
+            with unittest.mock.patch.dict(settings.DATABASES, {'replica': {}}):
+                self.assertEqual(router.db_for_read(App), 'replica')
+                self.assertIsNone(router.db_for_write(App))
+        with unittest.mock.patch.dict(settings.DATABASES, {'replica': {}}):
+            self.assertIsNone(router.db_for_read(App))
+        self.assertFalse(router.allow_migrate('replica', 'store'))
+
+    def test_replica_lag(self):
+        snapshot = store.catalog.buildSnapshot(1)
+        snapshot.fromReplica = True
+        snapshot.timestamp = snapshot.built - 1
+        self.assertTrue(snapshot.current(1))
+        self.assertFalse(snapshot.current(2))
+        # built right after a change, the replica may not have had the change yet
+        with unittest.mock.patch('time.time', return_value=snapshot.built + 60):
+            self.assertFalse(snapshot.current(1))
+            snapshot.fromReplica = False
+            self.assertTrue(snapshot.current(1))
+
+
+class BasicAuthTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='secret',
+                                             is_staff=True)
+        self.addCleanup(django.core.cache.cache.clear)
+
+    def get(self, password='secret'):
+        credentials = base64.b64encode(('uploader:' + password).encode()).decode()
+        return self.client.get('/app/purchase/metrics',
+                               HTTP_AUTHORIZATION='Basic ' + credentials).status_code
+
+    def countPasswordChecks(self, requests):
+        with unittest.mock.patch('django.contrib.auth.base_user.check_password',
+                                 wraps=django.contrib.auth.base_user.check_password) as check:
+            for i in range(requests):
+                self.assertEqual(self.get(), 200)
+            return check.call_count
+
+    def test_credentials_cached(self):
+        with override_settings(APPSTORE_AUTH_CACHE_TTL=0):
+            self.assertEqual(self.countPasswordChecks(10), 10)
+        self.assertEqual(self.countPasswordChecks(10), 1)
+        # basic auth clients do not get a session
+        self.assertFalse(Session.objects.exists())
+
+    def test_password_change(self):
+        self.assertEqual(self.get(), 200)
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEqual(self.get(), 401)
+        self.assertEqual(self.get('changed'), 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get('changed'), 401)
@@ -0,0 +1,224 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+# Validation of packages while they are uploaded.
+#
+# PackageUploadHandler writes the uploaded package to a temporary file within MEDIA_ROOT and at
+# the same time feeds it to parseAndValidatePackageMetadata() running in a separate thread. When
+# the upload is complete, the validation is (nearly) done as well and the temporary file can be
+# renamed into the blob store, instead of being read and copied again.
+#
+# Only gzip compressed packages can be validated this way. Packages using another compression
+# (which tarfile supports as well) are validated by reading the complete file after the upload.
+
+import os
+import zlib
+import hashlib
+import queue
+import logging
+import tempfile
+import threading
+
+from django.core.files.uploadedfile import UploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from store.utilities import parseAndValidatePackageMetadata, uploadPath
+
+logger = logging.getLogger(__name__)
+
+# number of uploaded chunks that may be queued for the validation thread
+STREAM_QUEUE_SIZE = 64
+# maximum amount of data decompressed at once
+DECOMPRESS_SIZE = 256 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class PackageStream:
+    """
+    Read-only file object returning the decompressed contents of a gzip stream, which is fed
+    by another thread. Concatenated gzip members (as in signed packages) are supported, which
+    tarfile's own stream mode does not do. If the stream does not start with a gzip member,
+    reading fails and unsupported is set.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.abandoned = False
+        self.pending = b''
+        self.buffer = bytearray()
+        self.decompressor = None
+        self.finished = False
+        self.started = False
+        self.unsupported = False
+
+    def feed(self, data):
+        """ Adds compressed data, None marks the end of the stream """
+        if not self.abandoned:
+            self.queue.put(data)
+
+    def abandon(self):
+        """ Called by the reader when it stops reading, so that feed() never blocks """
+        self.abandoned = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def fill(self):
+        """ Decompresses more data into the buffer, returns False at the end of the stream """
+        if not self.pending:
+            if self.finished:
+                return False
+            data = self.queue.get()
+            if data is None:
+                self.finished = True
+                if self.decompressor is not None:
+                    raise EOFError('the package is truncated')
+                return False
+            self.pending = data
+
+        if not self.started:
+            self.started = True
+            if not self.pending.startswith(GZIP_MAGIC):
+                self.unsupported = True
+                raise IOError('the package is not gzip compressed')
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer += self.decompressor.decompress(self.pending, DECOMPRESS_SIZE)
+        self.pending = self.decompressor.unconsumed_tail
+        if self.decompressor.eof:
+            # the next gzip member starts right after this one
+            self.pending = self.decompressor.unused_data
+            self.decompressor = None
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self.fill():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class PackageUploadedFile(TemporaryUploadedFile):
+    """
+    An uploaded package, stored in a temporary file below MEDIA_ROOT. pkgdata is the result of
+    the validation done during the upload, validationError the error message if it failed. Both
+    are None if the package was not validated during the upload. digest is the SHA-256 of the
+    file, as needed by the blob store.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        path = uploadPath()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        file = tempfile.NamedTemporaryFile(suffix='.upload.appkg', dir=path)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.pkgdata = None
+        self.validationError = None
+        self.digest = None
+
+
+class PackageUploadHandler(FileUploadHandler):
+    """
+    Upload handler for the package field of upload requests. Has to be installed before the
+    request data is accessed. With validate unset, the package is only stored and hashed, e.g.
+    when it is validated later by an upload job.
+    """
+
+    def __init__(self, request=None, fieldName='package', validate=True):
+        super().__init__(request)
+        self.fieldName = fieldName
+        self.validate = validate
+        self.active = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.active = field_name == self.fieldName
+        if not self.active:
+            return
+
+        self.file = PackageUploadedFile(self.file_name, self.content_type, 0, self.charset,
+                                        self.content_type_extra)
+        self.hash = hashlib.sha256()
+        self.stream = None
+        if self.validate:
+            self.stream = PackageStream()
+            self.thread = threading.Thread(target=self.validatePackage, name='upload-validation',
+                                           daemon=True)
+            self.thread.start()
+        raise StopFutureHandlers()
+
+    def validatePackage(self):
+        try:
+            self.file.pkgdata = parseAndValidatePackageMetadata(self.stream, mode='r|')
+        except Exception as error:
+            if self.stream.unsupported:
+                logger.info('%s is not gzip compressed, it is validated after the upload',
+                            self.file.name)
+            else:
+                self.file.validationError = str(error)
+        finally:
+            self.stream.abandon()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.file.write(raw_data)
+        self.hash.update(raw_data)
+        if self.stream is not None:
+            self.stream.feed(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        if self.stream is not None:
+            self.stream.feed(None)
+            self.thread.join()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.digest = self.hash.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if self.active:
+            self.active = False
+            if self.stream is not None:
+                self.stream.feed(None)
+                self.thread.join()
+            self.file.close()
@@ -0,0 +1,148 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+
+# Background processing of uploaded packages.
+#
+# With APPSTORE_ASYNC_UPLOAD enabled, upload only stores the received package in the uploads
+# directory and queues an UploadJob in the database. Validating the package and adding it to
+# the store is done by separate "manage.py process-uploads" worker processes, so that neither
+# the upload request nor the server processes serving devices spend time on it.
+#
+# The database is the queue: a worker claims the oldest queued job with a conditional update,
+# which only one of several concurrent workers can win, so any number of them can be run.
+
+import os
+import time
+import logging
+import datetime
+
+from django.core.files.move import file_move_safe
+from django.utils import timezone
+
+from store.models import UploadJob, savePackageFile
+from store.utilities import parseAndValidatePackageMetadata, uploadPath
+from store.blobs import StagedFile
+
+logger = logging.getLogger(__name__)
+
+# a job validating for longer than this has lost its worker and is queued again
+STALE_TIMEOUT = 60 * 60
+
+
+def jobPath(jobId):
+    return os.path.join(uploadPath(), 'job-%s.appkg' % jobId)
+
+
+def queueUpload(user, packageFile, package_metadata):
+    """
+    Moves the uploaded packageFile (or copies it, if it is not in a temporary file) into the
+    uploads directory and queues it for processing. Returns the UploadJob.
+    """
+    job = UploadJob(user=user, digest=getattr(packageFile, 'digest', None) or '',
+                    category=package_metadata['category'],
+                    vendor=package_metadata['vendor'],
+                    description=package_metadata['description'],
+                    briefDescription=package_metadata['short_description'])
+    path = jobPath(job.id)
+    os.makedirs(uploadPath(), exist_ok=True)
+    if hasattr(packageFile, 'temporary_file_path'):
+        packageFile.file.flush()
+        file_move_safe(packageFile.temporary_file_path(), path, allow_overwrite=True)
+    else:
+        with open(path, 'wb') as f:
+            for chunk in packageFile.chunks():
+                f.write(chunk)
+    job.save()
+    return job
+
+
+def claimJob():
+    """ Returns the oldest queued job, after marking it as being validated, or None """
+    while True:
+        job = UploadJob.objects.filter(state=UploadJob.QUEUED).order_by('dateQueued').first()
+        if job is None:
+            return None
+        now = timezone.now()
+        if UploadJob.objects.filter(id=job.id, state=UploadJob.QUEUED) \
+                .update(state=UploadJob.VALIDATING, dateStarted=now):
+            job.state = UploadJob.VALIDATING
+            job.dateStarted = now
+            return job
+        # claimed by another worker in the meantime
+
+
+def processJob(job):
+    """ Validates and stores the package of a claimed job, records the result in the job """
+    path = jobPath(job.id)
+    timings = {'wait': round((job.dateStarted - job.dateQueued).total_seconds(), 6)}
+    try:
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as package:
+                pkgdata = parseAndValidatePackageMetadata(package)
+        except Exception as error:
+            raise Exception('Package validation failed: %s' % error)
+        timings['validate'] = round(time.perf_counter() - start, 6)
+        timings['stages'] = pkgdata['timings']
+        job.appid = pkgdata['info']['id']
+
+        start = time.perf_counter()
+        package = StagedFile(path, job.digest or None)
+        try:
+            savePackageFile(pkgdata, package, {'category': job.category,
+                                               'vendor': job.vendor,
+                                               'description': job.description,
+                                               'short_description': job.briefDescription})
+        finally:
+            package.close()
+        timings['store'] = round(time.perf_counter() - start, 6)
+        job.state = UploadJob.STORED
+    except Exception as error:
+        logger.warning('upload job %s failed: %s', job.id, error)
+        job.state = UploadJob.FAILED
+        job.error = str(error)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    job.timings = timings
+    job.dateFinished = timezone.now()
+    job.save()
+    return job
+
+
+def requeueStaleJobs():
+    """ Queues jobs again, whose worker apparently died while validating them """
+    threshold = timezone.now() - datetime.timedelta(seconds=STALE_TIMEOUT)
+    return UploadJob.objects.filter(state=UploadJob.VALIDATING, dateStarted__lt=threshold) \
+        .update(state=UploadJob.QUEUED, dateStarted=None)
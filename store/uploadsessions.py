@@ -0,0 +1,194 @@
+#############################################################################
+##
+## Copyright (C) 2020 Luxoft Sweden AB
+## Copyright (C) 2018 Pelagicore AG
+## Contact: https://www.qt.io/licensing/
+##
+## This file is part of the Neptune Deployment Server
+##
+## $QT_BEGIN_LICENSE:GPL-QTAS$
+## Commercial License Usage
+## Licensees holding valid commercial Qt Automotive Suite licenses may use
+## this file in accordance with the commercial license agreement provided
+## with the Software or, alternatively, in accordance with the terms
+## contained in a written agreement between you and The Qt Company.  For
+## licensing terms and conditions see https://www.qt.io/terms-conditions.
+## For further information use the contact form at https://www.qt.io/contact-us.
+##
+## GNU General Public License Usage
+## Alternatively, this file may be used under the terms of the GNU
+## General Public License version 3 or (at your option) any later version
+## approved by the KDE Free Qt Foundation. The licenses are as published by
+## the Free Software Foundation and appearing in the file LICENSE.GPL3
+## included in the packaging of this file. Please review the following
+## information to ensure the GNU General Public License requirements will
+## be met: https://www.gnu.org/licenses/gpl-3.0.html.
+##
+## $QT_END_LICENSE$
+##
+## SPDX-License-Identifier: GPL-3.0
+##
+#############################################################################
+
+
+# Resumable uploads of large packages.
+#
+# An upload session collects a package in chunks, which are PUT with their offset in the
+# package. The data received so far is kept in a file in the uploads directory, whose size is
+# the offset at which the upload continues, also after a connection loss or a server restart.
+# Repeated chunks (e.g. retried after a timeout) are ignored, so PUTs are idempotent.
+#
+# The SHA-256 of the package, which the blob store needs, is computed while the chunks arrive,
+# so that finishing the upload does not have to read the whole file once more. The hash state
+# only lives in the server process that received the chunks: if chunks of a session were
+# received by different processes, finishSession() falls back to hashing the file.
+
+import os
+import fcntl
+import hashlib
+import datetime
+import threading
+import collections
+
+from django.conf import settings
+from django.utils import timezone
+
+from store.utilities import uploadPath
+from store.blobs import StagedFile
+
+CHUNK_SIZE = 256 * 1024
+# hash states kept per process. Sessions are also removed by other processes (expire-downloads),
+# so the least recently used ones are dropped, finishSession() then hashes the file.
+MAX_HASHES = 100
+
+
+class OffsetMismatch(Exception):
+    """ Raised when a chunk would leave a gap, offset is where the upload has to continue """
+
+    def __init__(self, offset):
+        super().__init__('chunk does not continue the upload at offset %d' % offset)
+        self.offset = offset
+
+
+_lock = threading.Lock()
+_hashes = collections.OrderedDict()    # session id -> (offset, hash of the data up to offset)
+
+
+def sessionPath(sessionId):
+    return os.path.join(uploadPath(), 'session-%s.part' % sessionId)
+
+
+def sessionOffset(session):
+    """ Returns the number of bytes received so far """
+    try:
+        return os.path.getsize(sessionPath(session.id))
+    except OSError:
+        return 0
+
+
+def createSession(user, size=None):
+    from store.models import UploadSession
+
+    os.makedirs(uploadPath(), exist_ok=True)
+    session = UploadSession.objects.create(user=user, size=size)
+    open(sessionPath(session.id), 'wb').close()
+    return session
+
+
+def writeChunk(session, offset, stream):
+    """
+    Appends the data read from stream, which starts at offset within the package. Data that
+    was already received is skipped. Returns the new offset.
+    """
+    with open(sessionPath(session.id), 'ab') as f:
+        # serializes concurrent PUTs to the same session, also across server processes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        received = os.fstat(f.fileno()).st_size
+        if offset > received:
+            raise OffsetMismatch(received)
+
+        with _lock:
+            cached = _hashes.pop(session.id, None)
+        if cached is not None and cached[0] == received:
+            hash = cached[1]
+        elif received == 0:
+            hash = hashlib.sha256()
+        else:
+            hash = None
+
+        position = offset
+        try:
+            for piece in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                end = position + len(piece)
+                if end > received:
+                    if session.size is not None and end > session.size:
+                        raise ValueError('chunk exceeds the announced size of %d bytes'
+                                         % session.size)
+                    data = piece[received - position:] if position < received else piece
+                    f.write(data)
+                    if hash is not None:
+                        hash.update(data)
+                    received = end
+                position = end
+        finally:
+            f.flush()
+            if hash is not None:
+                with _lock:
+                    _hashes[session.id] = (received, hash)
+                    while len(_hashes) > MAX_HASHES:
+                        _hashes.popitem(last=False)
+
+    session.save(update_fields=['dateModified'])
+    return received
+
+
+def finishSession(session):
+    """
+    Returns the assembled package as a StagedFile. The caller is responsible for calling
+    removeSession() afterwards.
+    """
+    path = sessionPath(session.id)
+    with open(path, 'rb') as f:
+        # waits for a PUT to the same session that is still writing, see writeChunk()
+        fcntl.flock(f, fcntl.LOCK_EX)
+        received = os.fstat(f.fileno()).st_size
+        if session.size is not None and received != session.size:
+            raise ValueError('upload incomplete: %d of %d bytes received'
+                             % (received, session.size))
+
+        with _lock:
+            cached = _hashes.get(session.id)
+        if cached is not None and cached[0] == received:
+            digest = cached[1].hexdigest()
+        else:
+            hash = hashlib.sha256()
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                hash.update(chunk)
+            digest = hash.hexdigest()
+    return StagedFile(path, digest)
+
+
+def removeSession(session):
+    with _lock:
+        _hashes.pop(session.id, None)
+    try:
+        os.remove(sessionPath(session.id))
+    except OSError:
+        pass
+    session.delete()
+
+
+def expireSessions():
+    """
+    Removes sessions without any chunk received within APPSTORE_UPLOAD_SESSION_EXPIRY minutes.
+    Returns a list of (session id, age in seconds) for the removed sessions.
+    """
+    from store.models import UploadSession
+
+    now = timezone.now()
+    threshold = now - datetime.timedelta(minutes=int(settings.APPSTORE_UPLOAD_SESSION_EXPIRY))
+    removed = []
+    for session in UploadSession.objects.filter(dateModified__lt=threshold):
+        removed.append((str(session.id), int((now - session.dateModified).total_seconds())))
+        removeSession(session)
+    return removed
@@ -32,19 +32,36 @@
 
 import tarfile
 import tempfile
+import glob
 import base64
 import os
+import io
+import errno
+import gzip
+import time
+import shutil
 import hashlib
 import hmac
+import logging
+import threading
+import collections
+import queue
+import concurrent.futures
 import yaml
-import magic
+
+try:
+    import magic
+except ImportError:
+    # only needed for binaries that store.osandarch can not identify by itself
+    magic = None
 
 from django.conf import settings
-from OpenSSL.crypto import load_pkcs12, FILETYPE_PEM, dump_privatekey, dump_certificate
-from M2Crypto import SMIME, BIO, X509
 
 from store.tags import SoftwareTagList, SoftwareTag
 import store.osandarch
+import store.crypto
+
+logger = logging.getLogger(__name__)
 
 def makeTagList(pkgdata):
     """Generates tag lists out of package data
@@ -64,6 +81,10 @@ def makeTagList(pkgdata):
     tags_hash = str(taglist) + str(tagconflicts)
     return taglist, tagconflicts, tags_hash
 
+def tagSetFingerprint(tags_hash):
+    """Returns the fixed-length fingerprint of a tag set, as returned by makeTagList"""
+    return hashlib.sha256(tags_hash.encode('utf-8')).hexdigest()
+
 def getRequestDictionary(request):
     if request.method == "POST":
         return request.POST
@@ -87,23 +108,51 @@ def iconPath(appId=None, architecture=None, tags=None):
             replace('\\', '_').replace(':', 'x3A').replace(',', 'x2C') + '.png')
     return path
 
-def writeTempIcon(appId, architecture, tags, icon):
-    try:
-        path = os.path.join(settings.MEDIA_ROOT, iconPath())
-        if not os.path.exists(path):
-            os.makedirs(path)
-        tempicon = open(os.path.join(settings.MEDIA_ROOT, iconPath(appId, architecture, tags)), 'wb')
-        tempicon.write(icon)
-        tempicon.flush()
-        tempicon.close()
-        return True, None
-    except IOError as error:
-        return False, 'Validation error: could not write icon file to media directory: %s' % \
-            str(error)
-
 def downloadPath():
     return os.path.join(settings.MEDIA_ROOT, 'downloads/')
 
+def uploadPath():
+    # uploads are spooled within MEDIA_ROOT, so that they can be renamed into the blob store
+    return os.path.join(settings.MEDIA_ROOT, 'uploads/')
+
+# path -> (file key, digest) of the most recently used files
+MAX_FILE_DIGESTS = 1000
+fileDigests = collections.OrderedDict()
+fileDigestsLock = threading.Lock()
+
+def fileDigest(path):
+    """Returns the sha256 hex digest of a file
+       The digest is cached per process for the MAX_FILE_DIGESTS most recently used files, as
+       long as inode, size and modification time of the file do not change. Raises OSError, if
+       the file does not exist.
+    """
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with fileDigestsLock:
+        cached = fileDigests.get(path)
+        if cached is not None and cached[0] == key:
+            fileDigests.move_to_end(path)
+            return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    with fileDigestsLock:
+        fileDigests[path] = (key, digest.hexdigest())
+        fileDigests.move_to_end(path)
+        while len(fileDigests) > MAX_FILE_DIGESTS:
+            fileDigests.popitem(last=False)
+    return digest.hexdigest()
+
+
+def findPackages(pattern):
+    """ Returns the package files for a file name, a directory (*.appkg) or a glob pattern """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '*.appkg')))
+    if os.path.exists(pattern):
+        return [pattern]
+    return sorted(glob.glob(pattern))
 
 def isValidFilesystemName(name, errorList):
     # see also in AM: src/common-lib/utilities.cpp / validateForFilesystemUsage
@@ -139,73 +188,122 @@ def isValidFilesystemName(name, errorList):
         return False
 
 def verifySignature(signaturePkcs7, hash, chainOfTrust):
-    # see also in AM: src/crypto-lib/signature.cpp / Signature::verify()
-
-    s = SMIME.SMIME()
-
-    bioSignature = BIO.MemoryBuffer(data = base64.decodestring(signaturePkcs7))
-    signature = SMIME.load_pkcs7_bio(bioSignature)
-    bioHash = BIO.MemoryBuffer(data = hash)
-    certChain = X509.X509_Store()
-
-    for trustedCert in chainOfTrust:
-        bioCert = BIO.MemoryBuffer(data = trustedCert)
+    store.crypto.TrustStore(chainOfTrust).verify(base64.decodebytes(signaturePkcs7.encode('ascii')),
+                                                 hash)
 
-        while len(bioCert):
-            cert = X509.load_cert_bio(bioCert, X509.FORMAT_PEM)
-            certChain.add_x509(cert)
 
-    s.set_x509_store(certChain)
-    s.set_x509_stack(X509.X509_Stack())
-
-    s.verify(signature, bioHash, SMIME.PKCS7_NOCHAIN)
+def createSignature(hash, signingCertificatePkcs12, signingCertificatePassword):
+    return store.crypto.SigningMaterial(signingCertificatePkcs12,
+                                        signingCertificatePassword).sign(hash)
 
 
-def createSignature(hash, signingCertificatePkcs12, signingCertificatePassword):
-    # see also in AM: src/crypto-lib/signature.cpp / Signature::create()
+_magic = None
 
-    s = SMIME.SMIME()
+def getOsArchWithMagic(sample, fileName):
+    """ Determines the file type of a binary with libmagic, see store.osandarch.getOsArch() """
+    global _magic
+    if magic is None:
+        raise Exception('cannot determine the binary format of %s without libmagic' % fileName)
+    if _magic is None:
+        _magic = magic.Magic()
 
-    # M2Crypto has no support for PKCS#12, so we have to use pyopenssl here
-    # to load the .p12. Since the internal structures are incompatible, we
-    # have to export from pyopenssl and import to M2Crypto via PEM BIOs.
-    pkcs12 = load_pkcs12(signingCertificatePkcs12, signingCertificatePassword)
-    signKey = BIO.MemoryBuffer(dump_privatekey(FILETYPE_PEM, pkcs12.get_privatekey()))
-    signCert = BIO.MemoryBuffer(dump_certificate(FILETYPE_PEM, pkcs12.get_certificate()))
-    caCerts = X509.X509_Stack()
-    if pkcs12.get_ca_certificates():
-        for cert in pkcs12.get_ca_certificates():
-            bio = BIO.MemoryBuffer(dump_certificate(FILETYPE_PEM, cert))
-            caCerts.push(X509.load_cert_bio(bio, X509.FORMAT_PEM))
+    # The binary headers libmagic needs are all within the first MAGIC_PREFIX_SIZE bytes.
+    fil = tempfile.NamedTemporaryFile() #This sequence is done to facilitate showing full type info
+    fil.write(sample)                   #libmagic refuses to give full information when called with
+    fil.flush()                         #from_buffer instead of from_file
+    filemagic = _magic.from_file(fil.name)
+    fil.close()
+    return store.osandarch.getOsArch(filemagic)
 
-    bioHash = BIO.MemoryBuffer(hash)
 
-    s.load_key_bio(signKey, signCert)
-    s.set_x509_stack(caCerts)
-    signature = s.sign(bioHash, SMIME.PKCS7_DETACHED + SMIME.PKCS7_BINARY)
-    bioSignature = BIO.MemoryBuffer()
-    signature.write(bioSignature)
+# entries that are read into memory by parsePackageMetadata, besides the --PACKAGE-* ones
+METADATA_FILES = ('info.yaml', 'icon.png')
+METADATA_MAX_SIZE = 16 * 1024 * 1024
+DIGEST_CHUNK_SIZE = 64 * 1024
+MAGIC_PREFIX_SIZE = 64 * 1024
 
-    data = bioSignature.read_all()
-    return data
+# number of chunks that may be queued for the digest thread
+DIGEST_QUEUE_SIZE = 16
+# threads running libmagic for binaries that store.osandarch does not know
+CLASSIFY_THREADS = 4
 
 
-def parsePackageMetadata(packageFile):
-    pkgdata = { }
+class DigestStage(threading.Thread):
+    """
+    Computes the package digest in its own thread, so that hashing runs in parallel to the
+    decompression of the package (both release the GIL). Data is hashed in the order in which
+    it is passed to update().
+    """
 
-    pkg = tarfile.open(fileobj=packageFile, mode='r:*', encoding='utf-8')
+    def __init__(self, threaded=True):
+        super().__init__(name='package-digest', daemon=True)
+        self.digest = hashlib.new('sha256')
+        self.queue = queue.Queue(maxsize=DIGEST_QUEUE_SIZE)
+        self.pending = bytearray()
+        self.busy = 0.0
+        self.threaded = threaded
+        if threaded:
+            self.start()
+        else:
+            self.update = self.hash
+
+    def hash(self, data):
+        start = time.perf_counter()
+        self.digest.update(data)
+        self.busy += time.perf_counter() - start
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.hash(data)
+
+    def update(self, data):
+        # small pieces (file names, small files) are collected, to not pay the thread
+        # hand-over for each of them
+        if not self.pending and len(data) >= DIGEST_CHUNK_SIZE:
+            self.queue.put(data)
+            return
+        self.pending += data
+        if len(self.pending) >= DIGEST_CHUNK_SIZE:
+            self.queue.put(bytes(self.pending))
+            self.pending.clear()
+
+    def finish(self):
+        """ Waits until all data is hashed, returns the digest """
+        if not self.threaded:
+            return self.digest
+        if self.pending:
+            self.queue.put(bytes(self.pending))
+            self.pending.clear()
+        self.queue.put(None)
+        self.join()
+        return self.digest
+
+
+def timed(function, *args):
+    """ Returns (result of function(*args), seconds spent) """
+    start = time.perf_counter()
+    return function(*args), time.perf_counter() - start
+
+
+def readPackageEntries(packageFile, mode, pkgdata, digestStage, classifier):
+    """
+    Checks all entries of the package in order and fills pkgdata with the header, info and
+    icon. Entry contents are passed to digestStage, binaries that need libmagic are classified
+    by the classifier executor.
+    Returns the contents of the footer entries and a list of (file name, (osarch, seconds)),
+    where the second element is a future for binaries passed to the classifier.
+    """
+    pkg = tarfile.open(fileobj=packageFile, mode=mode, encoding='utf-8')
 
     fileCount = 0
     foundFooter = False
     footerContents = ''
     foundInfo = False
     foundIcon = False
-    digest = hashlib.new('sha256')
-    #Init magic sequence checker
-    ms = magic.Magic()
-    osset = set()
-    archset = set()
-    pkgfmt = set()
+    classifications = []
 
     packageHeaders = ['am-application', 'am-package']
 
@@ -218,15 +316,29 @@ def parsePackageMetadata(packageFile):
             raise Exception('no absolute paths are allowed: %s' % entry.name)
         elif entry.name.find('..') >= 0:
             raise Exception('no non-canonical paths are allowed: %s' % entry.name)
-        elif 0 > entry.size > 2**31-1:
+        elif not 0 <= entry.size <= 2**31-1:
             raise Exception('file size > 2GiB: %s' % entry.name)
         elif entry.name.startswith('--PACKAGE-') and entry.isdir():
             raise Exception('all reserved entries (starting with --PACKAGE-) need to be files, found %s' % entry.name)
 
+        # Only the metadata entries are read completely. All other files are added to the
+        # digest chunk by chunk and only their first bytes are kept for the file type check,
+        # so that huge files do not have to fit into memory.
         contents = None
+        magicPrefix = None
         if entry.isfile():
+            isMetadata = entry.name.startswith('--PACKAGE-') or entry.name in METADATA_FILES
+            if isMetadata and entry.size > METADATA_MAX_SIZE:
+                raise Exception('file %s is larger than %d bytes' % (entry.name, METADATA_MAX_SIZE))
             try:
-                contents = pkg.extractfile(entry).read()
+                entryFile = pkg.extractfile(entry)
+                if isMetadata:
+                    contents = entryFile.read()
+                else:
+                    magicPrefix = entryFile.read(MAGIC_PREFIX_SIZE)
+                    digestStage.update(magicPrefix)
+                    for chunk in iter(lambda: entryFile.read(DIGEST_CHUNK_SIZE), b''):
+                        digestStage.update(chunk)
             except Exception as error:
                 raise Exception('Could not extract file %s: %s' % (entry.name, str(error)))
 
@@ -266,10 +378,10 @@ def parsePackageMetadata(packageFile):
                 entryName = entryName[:-1]
             addToDigest2 = str(entryName).encode('utf-8')
 
-            if entry.isfile():
-                digest.update(contents)
-            digest.update(addToDigest1)
-            digest.update(addToDigest2)
+            if contents is not None:
+                digestStage.update(contents)
+            digestStage.update(addToDigest1)
+            digestStage.update(addToDigest2)
 
         if entry.name == 'info.yaml':
             if fileCount != 2:
@@ -301,26 +413,65 @@ def parsePackageMetadata(packageFile):
             raise Exception('package does not start with info.yaml and icon.png - found %s' % entry.name)
 
         if fileCount > 2:
-            if contents and entry.isfile():
-                # check for file type here.
-                fil = tempfile.NamedTemporaryFile() #This sequence is done to facilitate showing full type info
-                fil.write(contents)                 #libmagic refuses to give full information when called with
-                fil.seek(0)                         #from_buffer instead of from_file
-                filemagic = ms.from_file(fil.name)
-                fil.close()
-                osarch = store.osandarch.getOsArch(filemagic)
-                if osarch: #[os, arch, endianness, bits, fmt]
-                    architecture = '-'.join(osarch[1:])
-                    osset.add(osarch[0])
-                    archset.add(architecture)
-                    pkgfmt.add(osarch[4])
-                    print(entry.name, osarch)
+            sample = contents if contents is not None else magicPrefix
+            if sample and entry.isfile():
+                # check for file type here. Most files are identified by their first bytes
+                # right away, libmagic runs in the classifier threads.
+                try:
+                    result = timed(store.osandarch.getOsArchFromHeader, sample)
+                except store.osandarch.UnknownBinaryFormat:
+                    result = classifier.submit(timed, getOsArchWithMagic, sample, entry.name)
+                classifications.append((entry.name, result))
+
+
+    pkg.close()
+    return footerContents, classifications
+
+
+def parsePackageMetadata(packageFile, mode='r:*'):
+    """
+    Parses and checks the package structure, computes the package digest and detects the
+    binary architecture. The work is split into stages: this thread decompresses and checks the
+    entries, a DigestStage hashes their contents and binaries are classified by a thread pool.
+    The time spent in each stage is returned in pkgdata['timings'].
+    The tarfile mode can be changed to 'r|' for reading from a non-seekable stream.
+    """
+    pkgdata = { }
+    started = time.perf_counter()
+
+    digestStage = DigestStage(threaded=(os.cpu_count() or 1) > 1)
+    classifier = concurrent.futures.ThreadPoolExecutor(max_workers=CLASSIFY_THREADS,
+                                                       thread_name_prefix='package-classify')
+    try:
+        footerContents, classifications = readPackageEntries(packageFile, mode, pkgdata,
+                                                              digestStage, classifier)
+        readTime = time.perf_counter() - started
+        digest = digestStage.finish()
+        binaries = [(name, result.result() if isinstance(result, concurrent.futures.Future)
+                     else result) for name, result in classifications]
+    finally:
+        if digestStage.is_alive():
+            digestStage.finish()
+        classifier.shutdown(wait=True, cancel_futures=True)
+
+    osset = set()
+    archset = set()
+    pkgfmt = set()
+    classifyTime = 0.0
+    for name, (osarch, seconds) in binaries:
+        classifyTime += seconds
+        if osarch: #[os, arch, endianness, bits, fmt]
+            architecture = '-'.join(osarch[1:])
+            osset.add(osarch[0])
+            archset.add(architecture)
+            pkgfmt.add(osarch[4])
+            logger.debug('%s: %s', name, osarch)
 
     # finished enumerating all files
     try:
         docs = list(yaml.safe_load_all(footerContents))
     except yaml.YAMLError as error:
-        raise Exception('Could not parse %s: %s' % (entry.name, error))
+        raise Exception('Could not parse --PACKAGE-FOOTER--: %s' % error)
 
     if len(docs) < 2:
         raise Exception('file --PACKAGE-FOOTER-- does not consist of at least 2 YAML documents')
@@ -348,12 +499,16 @@ def parsePackageMetadata(packageFile):
         pkgdata['architecture'] = list(archset)[0]
         pkgdata['binfmt'] = 'binfmt_' + list(pkgfmt)[0]
 
-    pkg.close()
+    pkgdata['timings'] = {'read': readTime,
+                          'digest': digestStage.busy,
+                          'classify': classifyTime,
+                          'total': time.perf_counter() - started}
+    logger.debug('parsed package: %s', pkgdata['timings'])
     return pkgdata
 
 
-def parseAndValidatePackageMetadata(packageFile, certificates = []):
-    pkgdata = parsePackageMetadata(packageFile)
+def parseAndValidatePackageMetadata(packageFile, certificates = [], mode='r:*'):
+    pkgdata = parsePackageMetadata(packageFile, mode)
 
     if pkgdata['packageFormat']['formatVersion'] == 1:
         packageIdKey = 'applicationId'
@@ -426,51 +581,138 @@ def parseAndValidatePackageMetadata(packageFile, certificates = []):
         if not 'developerSignature' in pkgdata['footer']:
             raise Exception('cannot upload a package without a developer signature')
 
-        certificates = []
-        for certFile in settings.APPSTORE_DEV_VERIFY_CA_CERTIFICATES:
-            with open(certFile, 'rb') as cert:
-                certificates.append(cert.read())
-
-        verifySignature(pkgdata['footer']['developerSignature'], pkgdata['rawDigest'], certificates)
+        signature = base64.decodebytes(pkgdata['footer']['developerSignature'].encode('ascii'))
+        store.crypto.verifyDeveloperSignature(signature, pkgdata['rawDigest'])
 
     return pkgdata
 
 
-def addFileToPackage(sourcePackageFile, destinationPackageFile, fileName, fileContents):
-    src = tarfile.open(sourcePackageFile, mode = 'r:*', encoding = 'utf-8')
-    dst = tarfile.open(destinationPackageFile, mode = 'w:gz', encoding = 'utf-8')
-
-    for entry in src:
-        if entry.isfile():
-            dst.addfile(entry, src.extractfile(entry))
-        else:
-            dst.addfile(entry)
-
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(fileContents)
-        tmp.seek(0)
-
-        entry = dst.gettarinfo(fileobj = tmp, arcname = fileName)
-        entry.uid = entry.gid = 0
-        entry.uname = entry.gname = ''
-        entry.mode = 0o400
-        dst.addfile(entry, fileobj = tmp)
+def signingBasePath(packageDigest=None):
+    path = os.path.join(settings.MEDIA_ROOT, 'signing')
+    if packageDigest is not None:
+        path = os.path.join(path, packageDigest + '.tar.gz')
+    return path
 
-    dst.close()
+def createSigningBase(sourcePackageFile, basePackageFile):
+    """Writes all entries of the source package as a single gzip member, but without the
+       end-of-archive marker of the tar stream.
+       Signed packages are created by appending a second gzip member to a copy of this file,
+       containing the signature footer plus the end-of-archive marker. Concatenated gzip
+       members are one continuous stream for any gzip reader, so the result is a valid package,
+       and only the small footer has to be compressed when signing.
+    """
+    src = tarfile.open(sourcePackageFile, mode = 'r:*', encoding = 'utf-8')
+    with open(basePackageFile, 'wb') as f:
+        with gzip.GzipFile(fileobj = f, mode = 'wb', mtime = 0) as gz:
+            dst = tarfile.open(fileobj = gz, mode = 'w', encoding = 'utf-8')
+            for entry in src:
+                if entry.isfile():
+                    dst.addfile(entry, src.extractfile(entry))
+                else:
+                    dst.addfile(entry)
+            # do not close dst, as this would write the end-of-archive marker
+            dst.closed = True
     src.close()
 
-def addSignatureToPackage(sourcePackageFile, destinationPackageFile, digest, deviceId, version=1):
-    signingCertificate = ''
-    with open(settings.APPSTORE_STORE_SIGN_PKCS12_CERTIFICATE) as cert:
-        signingCertificate = cert.read()
+def signingInfoPath(packageDigest):
+    return os.path.join(signingBasePath(), packageDigest + '.yaml')
+
+def signingBase(sourcePackageFile, packageDigest=None):
+    """Returns the path of the signing base for the package, creating it if needed
+       packageDigest is the sha256 hex digest of the package file, if already known.
+    """
+    if packageDigest is None:
+        packageDigest = fileDigest(sourcePackageFile)
+    path = signingBasePath(packageDigest)
+    if not os.path.exists(path):
+        if not os.path.exists(signingBasePath()):
+            os.makedirs(signingBasePath())
+        tempPath = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        try:
+            createSigningBase(sourcePackageFile, tempPath)
+            os.replace(tempPath, path)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+    return path
 
-    digestPlusId = hmac.new(deviceId, digest, hashlib.sha256).digest()
-    signature = createSignature(digestPlusId, signingCertificate,
-                                settings.APPSTORE_STORE_SIGN_PKCS12_PASSWORD)
+def signingInfo(sourcePackageFile, packageDigest=None):
+    """Returns the raw digest and the format version of the package, as needed for signing it
+       Both are parsed from the package only once and then stored next to its signing base,
+       so that signing does not have to read the whole package again.
+    """
+    if packageDigest is None:
+        packageDigest = fileDigest(sourcePackageFile)
+    path = signingInfoPath(packageDigest)
+    try:
+        with open(path, 'r') as f:
+            info = yaml.safe_load(f)
+        return bytes.fromhex(info['rawDigest']), info['formatVersion']
+    except (IOError, yaml.YAMLError, TypeError, KeyError, ValueError):
+        pass
+
+    with open(sourcePackageFile, 'rb') as package:
+        pkgdata = parsePackageMetadata(package)
+    info = {'rawDigest': pkgdata['rawDigest'].hex(),
+            'formatVersion': pkgdata['packageFormat']['formatVersion']}
+    os.makedirs(signingBasePath(), exist_ok=True)
+    tempPath = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tempPath, 'w') as f:
+            yaml.safe_dump(info, f)
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+    return pkgdata['rawDigest'], info['formatVersion']
+
+def copyFile(sourceFile, destinationFile):
+    """Copies a file without passing its contents through user space
+       On filesystems supporting reflinks (e.g. Btrfs or XFS), both files share their data
+       blocks, so that the copy does not depend on the file size.
+    """
+    try:
+        with open(sourceFile, 'rb') as src, open(destinationFile, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        return
+    except AttributeError:
+        pass  # not available on this platform
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    shutil.copyfile(sourceFile, destinationFile)
+
+def addFileToPackage(sourcePackageFile, destinationPackageFile, fileName, fileContents,
+                     packageDigest=None):
+    copyFile(signingBase(sourcePackageFile, packageDigest), destinationPackageFile)
+
+    entry = tarfile.TarInfo(fileName)
+    entry.size = len(fileContents)
+    entry.mtime = time.time()
+    entry.uid = entry.gid = 0
+    entry.uname = entry.gname = ''
+    entry.mode = 0o400
+
+    with open(destinationPackageFile, 'ab') as f:
+        with gzip.GzipFile(fileobj = f, mode = 'wb') as gz:
+            dst = tarfile.open(fileobj = gz, mode = 'w', encoding = 'utf-8')
+            dst.addfile(entry, fileobj = io.BytesIO(fileContents))
+            dst.close()
+
+def addSignatureToPackage(sourcePackageFile, destinationPackageFile, digest, deviceId, version=1,
+                          packageDigest=None):
+    digestPlusId = hmac.new(deviceId.encode('utf-8'), digest, hashlib.sha256).digest()
+    signature = store.crypto.storeSignature(digestPlusId)
 
     yamlContent = yaml.dump_all([{'formatVersion': version, 'formatType': 'am-package-footer'},
-                                 {'storeSignature': base64.encodestring(signature)}],
+                                 {'storeSignature': base64.encodebytes(signature).decode('ascii')}],
                                 explicit_start=True)
 
     addFileToPackage(sourcePackageFile, destinationPackageFile,
-                     '--PACKAGE-FOOTER--store-signature', yamlContent)
+                     '--PACKAGE-FOOTER--store-signature', yamlContent.encode('utf-8'),
+                     packageDigest)